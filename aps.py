@@ -32,6 +32,8 @@ import requests
 import urllib
 
 import aps
+from breaker import is_outage
+from scheduler import scheduler
 
 CONSUMER_KEY = decouple.config('CONSUMER_KEY')
 CONSUMER_SECRET = decouple.config('CONSUMER_SECRET')
@@ -221,7 +223,7 @@ def get_2_legged_token(scope: Sequence[str] = None) -> Token:
     basic = base64.b64encode(bytes(f"{CONSUMER_KEY}:{CONSUMER_SECRET}".encode('utf-8'))).decode('utf-8')
     headers = {'Authorization': f'Basic {basic}',
                'Content-Type': 'application/x-www-form-urlencoded'}
-    resp = requests.post(endpoint, headers=headers, data=data)
+    resp = scheduler.post(endpoint, headers=headers, data=data)
 
     j = resp.json()
 
@@ -263,7 +265,7 @@ def get_3_legged_token(scope: Sequence[str], code: str) -> Token | str:
                'Content-Type': 'application/x-www-form-urlencoded'}
     req = {'grant_type': 'authorization_code', 'code': code, 'redirect_uri': REDIRECT_URI}
 
-    res = requests.post(endpoint, headers=headers, data=req)
+    res = scheduler.post(endpoint, headers=headers, data=req)
 
     if res.status_code == 200:
         j = res.json()
@@ -310,7 +312,14 @@ def is_token_valid() -> bool:
     }
     data = {'token': token.Access}
 
-    resp = requests.post(endpoint, headers=headers, data=data)
+    try:
+        resp = scheduler.post(endpoint, headers=headers, data=data)
+    except Exception as ex:
+        if not is_outage(ex):
+            raise
+        # fail fast while the authentication service is unavailable
+        logging.warning(f'Token introspection failed: {ex}')
+        return False
 
     code = resp.status_code
     if code == 401:
@@ -344,7 +353,13 @@ def refresh_token() -> Token | None:
         data = {'grant_type': 'client_credentials',
                 'scope': '+'.join([urllib.parse.quote(s) for s in token.Scope])}
 
-    res = requests.post(endpoint, headers=headers, data=data)
+    try:
+        res = scheduler.post(endpoint, headers=headers, data=data)
+    except Exception as ex:
+        if not is_outage(ex):
+            raise
+        logging.warning(f'Token refresh failed: {ex}')
+        return None
     if res.status_code == 200:
         j = res.json()
         token.CreationTime = str(datetime.datetime.now())
@@ -362,9 +377,13 @@ def is_token_3_legged() -> bool:
     return token.Legs == 3
 
 
+_user_infos: Dict[str, Dict[str, Any]] = {}
+
+
 def get_user_info() -> Any:
     """
-    Returns the Autodesk Account user Info
+    Returns the Autodesk Account user Info, the last one obtained with the same token flagged as "stale" while the
+    profile service is unavailable
     :return:
     """
     global token
@@ -374,9 +393,19 @@ def get_user_info() -> Any:
         'Authorization': token.Value,
     }
 
-    resp = requests.get(endpoint, headers=headers)
+    try:
+        resp = scheduler.get(endpoint, headers=headers)
+    except Exception as ex:
+        if not is_outage(ex):
+            raise
+        if token.Access in _user_infos:
+            return {**_user_infos[token.Access], 'stale': True}
+        return {503: str(ex)}
     if resp.status_code == 200:
-        return resp.json()
+        _user_infos[token.Access] = resp.json()
+        return _user_infos[token.Access]
+    if resp.status_code >= 500 and token.Access in _user_infos:
+        return {**_user_infos[token.Access], 'stale': True}
     return {resp.status_code: resp.text}
 
 
@@ -435,3 +464,26 @@ def validate_token(*scope: str | Tuple[str], three_legged: bool = False) -> Toke
         token = get_2_legged_token(new_scope)
     return token
 
+
+
+_user_ids: Dict[str, str] = {}
+
+
+def get_user_id() -> Optional[str]:
+    """
+    Returns the Autodesk Account id of the user bound to the current token, cached per access token. The callers must
+    not share cached data between the users whose id is unknown, they call APS directly.
+    :return: The user id or None for tokens without user context and when the user profile is not available
+    """
+    global token
+
+    if token.Access is None:
+        return None
+    if not is_token_3_legged():
+        return None
+    if token.Access not in _user_ids:
+        info = get_user_info()
+        if 'sub' not in info:
+            return None
+        _user_ids[token.Access] = info['sub']
+    return _user_ids[token.Access]
@@ -1,5 +1,104 @@
 import React from 'react';
 
+// the dbId sets shared with the followers, see sessions.CHANNELS
+const CHANNELS = ['selected', 'isolated', 'hidden'];
+
+// the sorted unique dbIds of a that are not in b
+const difference = (a, b) => {
+  const result = [];
+  let j = 0;
+  for (const id of a) {
+    while (j < b.length && b[j] < id) {
+      j++;
+    }
+    if (j >= b.length || b[j] !== id) {
+      result.push(id);
+    }
+  }
+  return result;
+};
+
+const union = (a, b) => {
+  const result = [];
+  let i = 0, j = 0;
+  while (i < a.length || j < b.length) {
+    if (j >= b.length || (i < a.length && a[i] < b[j])) {
+      result.push(a[i++]);
+    } else if (i >= a.length || b[j] < a[i]) {
+      result.push(b[j++]);
+    } else {
+      result.push(a[i++]);
+      j++;
+    }
+  }
+  return result;
+};
+
+const sortedSet = (ids) => Array.from(new Set(ids)).sort((a, b) => a - b);
+
+// encodes sorted unique dbIds as runs or as a bitset, whichever is shorter, see dbid_sets.encode
+const encodeIds = (ids) => {
+  if (ids.length === 0) {
+    return '';
+  }
+  const runs = [];
+  let start = ids[0], last = ids[0], end = 0;
+  for (let i = 1; i <= ids.length; i++) {
+    if (i < ids.length && ids[i] === last + 1) {
+      last = ids[i];
+      continue;
+    }
+    runs.push(start - end, last + 1 - start);
+    end = last + 1;
+    if (i < ids.length) {
+      start = last = ids[i];
+    }
+  }
+  const text = 'r' + runs.join(',');
+  const span = ids[ids.length - 1] - ids[0] + 1;
+  if (Math.ceil(span / 24) * 4 >= text.length) {
+    return text;
+  }
+  const bytes = new Uint8Array(Math.ceil(span / 8));
+  ids.forEach((id) => {
+    bytes[(id - ids[0]) >> 3] |= 1 << ((id - ids[0]) & 7);
+  });
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 8192) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 8192));
+  }
+  const bitset = 'b' + ids[0] + ':' + btoa(binary);
+  return bitset.length < text.length ? bitset : text;
+};
+
+const decodeIds = (text) => {
+  const ids = [];
+  if (text.startsWith('r')) {
+    const values = text.slice(1).split(',').map(Number);
+    let end = 0;
+    for (let i = 0; i + 1 < values.length; i += 2) {
+      const start = end + values[i];
+      end = start + values[i + 1];
+      for (let id = start; id < end; id++) {
+        ids.push(id);
+      }
+    }
+  } else if (text.startsWith('b')) {
+    const separator = text.indexOf(':');
+    const first = Number(text.slice(1, separator));
+    const binary = atob(text.slice(separator + 1));
+    for (let i = 0; i < binary.length; i++) {
+      const byte = binary.charCodeAt(i);
+      for (let bit = 0; bit < 8; bit++) {
+        if (byte & (1 << bit)) {
+          ids.push(first + i * 8 + bit);
+        }
+      }
+    }
+  }
+  return ids;
+};
+
 
 class Viewer extends React.Component {
   constructor(props) {
@@ -7,6 +106,17 @@ class Viewer extends React.Component {
     this.viewer = null;
     this.md_ViewerDocument = null;
     this.md_viewables = null;    
+    // the camera frame last sent by the presenter or received by a follower, see sessions.encode
+    this.cameraFrame = [];
+    this.cameraSeq = 0;
+    this.cameraDirty = false;
+    this.cameraTimer = null;
+    // the selected, isolated and hidden dbIds last sent by the presenter or received by a follower
+    this.selectionSets = {};
+    this.selectionSeq = 0;
+    this.selectionDirty = false;
+    // the bounds URL last reported, see spatial_index.receive
+    this.boundsReported = null;
   }
 
   componentDidMount() {
@@ -14,6 +124,7 @@ class Viewer extends React.Component {
   }
 
   componentWillUnmount() {
+    this.stopCameraSync();
     this.setState({urn: '', access: '', expires: ''});
     if (this.viewer != null){
         this.viewer.finish();
@@ -36,8 +147,307 @@ class Viewer extends React.Component {
       this.changeDocument();
       return;
     }
+    if (prevProps.selection !== this.props.selection || prevProps.selectionMode !== this.props.selectionMode) {
+      this.applySelection();
+    }
+    if (prevProps.theming !== this.props.theming) {
+      this.applyTheming();
+    }
+    if (prevProps.cameraRole !== this.props.cameraRole || prevProps.cameraInterval !== this.props.cameraInterval) {
+      if (prevProps.cameraRole !== this.props.cameraRole) {
+        // the first update received in a session is a snapshot
+        this.cameraFrame = [];
+        this.selectionSets = {};
+      }
+      this.startCameraSync();
+    }
+    if (prevProps.cameraUpdate !== this.props.cameraUpdate) {
+      this.applyCameraUpdate();
+    }
+    if (prevProps.selectionUpdate !== this.props.selectionUpdate) {
+      this.applySelectionUpdate();
+    }
+    if (prevProps.boundsUrl !== this.props.boundsUrl) {
+      this.reportBounds();
+    }
   }
 
+  onCameraChanged = () => {
+    this.cameraDirty = true;
+  };
+
+  onSelectionChanged = () => {
+    this.selectionDirty = true;
+  };
+
+  startCameraSync = () => {
+    this.stopCameraSync();
+    if (!this.viewer || this.props.cameraRole !== 'presenter') {
+      return;
+    }
+    // the first updates are snapshots
+    this.cameraFrame = [];
+    this.selectionSets = {};
+    // the camera changes at every frame while moving, only the latest state is sent at the configured rate
+    this.viewer.addEventListener(Autodesk.Viewing.CAMERA_CHANGE_EVENT, this.onCameraChanged);
+    this.viewer.addEventListener(Autodesk.Viewing.CUTPLANES_CHANGE_EVENT, this.onCameraChanged);
+    this.selectionEvents().forEach((e) => this.viewer.addEventListener(e, this.onSelectionChanged));
+    this.cameraDirty = true;
+    this.selectionDirty = true;
+    this.cameraTimer = setInterval(() => {
+      this.sendCamera();
+      this.sendSelection();
+    }, this.props.cameraInterval || 100);
+  };
+
+  selectionEvents = () => [
+    Autodesk.Viewing.SELECTION_CHANGED_EVENT,
+    Autodesk.Viewing.ISOLATE_EVENT,
+    Autodesk.Viewing.HIDE_EVENT,
+    Autodesk.Viewing.SHOW_EVENT,
+  ];
+
+  stopCameraSync = () => {
+    if (this.cameraTimer !== null) {
+      clearInterval(this.cameraTimer);
+      this.cameraTimer = null;
+    }
+    if (this.viewer) {
+      this.viewer.removeEventListener(Autodesk.Viewing.CAMERA_CHANGE_EVENT, this.onCameraChanged);
+      this.viewer.removeEventListener(Autodesk.Viewing.CUTPLANES_CHANGE_EVENT, this.onCameraChanged);
+      this.selectionEvents().forEach((e) => this.viewer.removeEventListener(e, this.onSelectionChanged));
+    }
+  };
+
+  readCamera = () => {
+    const step = this.props.cameraStep || 0.001;
+    const nav = this.viewer.navigation;
+    const p = (v) => Math.round(v / step);
+    const d = (v) => Math.round(v * 10000);
+    const position = nav.getPosition();
+    const target = nav.getTarget();
+    const up = nav.getCameraUpVector();
+    const frame = [
+      p(position.x), p(position.y), p(position.z),
+      p(target.x), p(target.y), p(target.z),
+      d(up.x), d(up.y), d(up.z),
+      Math.round(nav.getVerticalFov() * 100),
+    ];
+    (this.viewer.getCutPlanes() || []).forEach((plane) => {
+      frame.push(d(plane.x), d(plane.y), d(plane.z), p(plane.w));
+    });
+    return frame;
+  };
+
+  sendCamera = () => {
+    if (!this.cameraDirty || !this.viewer || !this.viewer.model || !this.props.onCameraChange) {
+      return;
+    }
+    this.cameraDirty = false;
+    const frame = this.readCamera();
+    const update = [++this.cameraSeq, frame.length];
+    frame.forEach((v, i) => {
+      if (i >= this.cameraFrame.length || this.cameraFrame[i] !== v) {
+        update.push(i, v);
+      }
+    });
+    if (update.length === 2 && frame.length === this.cameraFrame.length) {
+      return;
+    }
+    this.cameraFrame = frame;
+    this.props.onCameraChange(update);
+  };
+
+  readSelection = () => {
+    const isolated = sortedSet(this.viewer.getIsolatedNodes());
+    return {
+      selected: sortedSet(this.viewer.getSelection()),
+      isolated: isolated,
+      // isolating hides everything else, the followers isolate the same dbIds
+      hidden: isolated.length > 0 ? [] : sortedSet(this.viewer.getHiddenNodes()),
+    };
+  };
+
+  sendSelection = () => {
+    if (!this.selectionDirty || !this.viewer || !this.viewer.model || !this.props.onSelectionChange) {
+      return;
+    }
+    this.selectionDirty = false;
+    const sets = this.readSelection();
+    const update = {};
+    CHANNELS.forEach((channel) => {
+      const old = this.selectionSets[channel] || [];
+      const added = difference(sets[channel], old);
+      const removed = difference(old, sets[channel]);
+      if (added.length > 0 || removed.length > 0) {
+        update[channel] = [encodeIds(added), encodeIds(removed)];
+      }
+    });
+    this.selectionSets = sets;
+    if (Object.keys(update).length > 0) {
+      update.seq = [String(++this.selectionSeq)];
+      this.props.onSelectionChange(update);
+    }
+  };
+
+  applySelectionUpdate = () => {
+    const update = this.props.selectionUpdate || {};
+    if (this.props.cameraRole !== 'follower') {
+      return;
+    }
+    const changes = {};
+    CHANNELS.forEach((channel) => {
+      if (update[channel]) {
+        const added = decodeIds(update[channel][0]);
+        const removed = decodeIds(update[channel][1]);
+        changes[channel] = {added: added, removed: removed};
+        this.selectionSets[channel] = union(difference(this.selectionSets[channel] || [], removed), added);
+      }
+    });
+    this.showSelection(changes);
+  };
+
+  showSelection = (changes) => {
+    if (!this.viewer || !this.viewer.model) {
+      return;
+    }
+    const sets = this.selectionSets;
+    if (changes === null || changes.isolated) {
+      this.viewer.isolate(sets.isolated || []);
+      this.viewer.hide(sets.hidden || []);
+    } else if (changes.hidden) {
+      this.viewer.show(changes.hidden.removed);
+      this.viewer.hide(changes.hidden.added);
+    }
+    if (changes === null || changes.selected) {
+      this.viewer.select(sets.selected || []);
+    }
+  };
+
+  applyCameraUpdate = () => {
+    const update = this.props.cameraUpdate || [];
+    if (this.props.cameraRole !== 'follower' || update.length < 2) {
+      return;
+    }
+    const frame = this.cameraFrame.slice(0, update[1]);
+    while (frame.length < update[1]) {
+      frame.push(0);
+    }
+    for (let i = 2; i + 1 < update.length; i += 2) {
+      frame[update[i]] = update[i + 1];
+    }
+    this.cameraFrame = frame;
+    this.moveCamera();
+  };
+
+  moveCamera = () => {
+    const f = this.cameraFrame;
+    if (!this.viewer || !this.viewer.model || f.length < 10) {
+      return;
+    }
+    const step = this.props.cameraStep || 0.001;
+    const nav = this.viewer.navigation;
+    nav.setVerticalFov(f[9] / 100, false);
+    nav.setView(
+      new THREE.Vector3(f[0] * step, f[1] * step, f[2] * step),
+      new THREE.Vector3(f[3] * step, f[4] * step, f[5] * step)
+    );
+    nav.setCameraUpVector(new THREE.Vector3(f[6] / 10000, f[7] / 10000, f[8] / 10000));
+    const planes = [];
+    for (let i = 10; i + 3 < f.length; i += 4) {
+      planes.push(new THREE.Vector4(f[i] / 10000, f[i + 1] / 10000, f[i + 2] / 10000, f[i + 3] * step));
+    }
+    this.viewer.setCutPlanes(planes);
+  };
+
+  applyTheming = () => {
+    if (!this.viewer || !this.viewer.model) {
+      return;
+    }
+    const model = this.viewer.model;
+    this.viewer.clearThemingColors(model);
+    const theming = this.props.theming || {};
+    for (const [color, ids] of Object.entries(theming)) {
+      // the colors are "rgb(r, g, b)" strings
+      const [r, g, b] = color.match(/\d+/g).map(Number);
+      const vector = new THREE.Vector4(r / 255, g / 255, b / 255, 1);
+      ids.forEach((id) => this.viewer.setThemingColor(id, vector, model, true));
+    }
+    this.viewer.impl.invalidate(true);
+  };
+
+  applySelection = () => {
+    if (!this.viewer || !this.viewer.model) {
+      return;
+    }
+    const ids = this.props.selection || [];
+    switch (this.props.selectionMode) {
+      case 'isolate':
+        this.viewer.isolate(ids);
+        this.viewer.fitToView(ids);
+        break;
+      case 'highlight':
+        this.viewer.isolate([]);
+        this.viewer.select(ids);
+        break;
+      case 'fit':
+        this.viewer.fitToView(ids);
+        break;
+      default:
+        this.viewer.isolate([]);
+        this.viewer.clearSelection();
+    }
+  };
+
+  // posts the world bounding box of every element with geometry, once per model version, see spatial_index.parse_bounds
+  reportBounds = () => {
+    const url = this.props.boundsUrl;
+    const model = this.viewer ? this.viewer.model : null;
+    if (!url || !model || !model.isLoadDone() || this.boundsReported === url) {
+      return;
+    }
+    const tree = model.getInstanceTree();
+    if (!tree) {
+      return;
+    }
+    this.boundsReported = url;
+    const fragments = model.getFragmentList();
+    const ids = [];
+    const boxes = [];
+    const box = new THREE.Box3();
+    const fragmentBox = new THREE.Box3();
+    tree.enumNodeChildren(tree.getRootId(), (dbId) => {
+      box.makeEmpty();
+      tree.enumNodeFragments(dbId, (fragId) => {
+        fragments.getWorldBounds(fragId, fragmentBox);
+        box.union(fragmentBox);
+      }, false);
+      if (!box.isEmpty()) {
+        ids.push(dbId);
+        boxes.push(box.min.x, box.min.y, box.min.z, box.max.x, box.max.y, box.max.z);
+      }
+    }, true);
+    const offset = model.getData().globalOffset || {x: 0, y: 0, z: 0};
+    const n = ids.length;
+    // a float64 header (count, meters per model unit, global offset), then the int32 dbIds and the float32 boxes
+    const body = new ArrayBuffer(40 + 28 * n);
+    new Float64Array(body, 0, 5).set([n, model.getUnitScale(), offset.x, offset.y, offset.z]);
+    new Int32Array(body, 40, n).set(ids);
+    new Float32Array(body, 40 + 4 * n, 6 * n).set(boxes);
+    fetch(url, {
+      method: 'POST',
+      headers: {'Authorization': 'Bearer ' + this.props.access, 'Content-Type': 'application/octet-stream'},
+      body: body,
+    }).then((resp) => resp.ok ? resp.json() : Promise.reject(resp.status)).then((result) => {
+      if (this.props.onBoundsReport) {
+        this.props.onBoundsReport(result.elements);
+      }
+    }).catch((e) => {
+      console.error('Bounds not reported: ' + e);
+      this.boundsReported = null;
+    });
+  };
+
   initializeViewer = () => {
     var options = {
           env: 'AutodeskProduction2',
@@ -46,8 +456,16 @@ class Viewer extends React.Component {
             onTokenReady(this.props.access, this.props.expires);
           }
         };
+    if (this.props.derivativeProxy) {
+      // the SVF derivatives are loaded through the caching proxy of the backend, SVF2 is streamed from APS only
+      options.env = 'AutodeskProduction';
+      options.api = 'modelDerivativeV2';
+    }
 
     Autodesk.Viewing.Initializer(options, () => {
+      if (this.props.derivativeProxy) {
+        Autodesk.Viewing.endpoint.setEndpointAndApi(this.props.derivativeProxy, 'modelDerivativeV2');
+      }
       if (this.props.urn === '') {
         return;
       }
@@ -87,7 +505,18 @@ class Viewer extends React.Component {
       console.error('Document contains no viewables.');
       return;
     }
-    this.viewer.loadDocumentNode(viewerDocument, this.md_viewables[0]);
+    this.viewer.loadDocumentNode(viewerDocument, this.md_viewables[0]).then(() => {
+      this.viewer.waitForLoadDone().then(() => {
+        this.applySelection();
+        this.applyTheming();
+        this.startCameraSync();
+        this.moveCamera();
+        this.reportBounds();
+        if (this.props.cameraRole === 'follower') {
+          this.showSelection(null);
+        }
+      });
+    });
   };
 
   onDocumentLoadFailure = () => {
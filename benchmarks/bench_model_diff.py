@@ -0,0 +1,116 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Benchmarks the model diff on synthetic versions of a model.
+
+Run it from the project folder with `python -m benchmarks.bench_model_diff --elements 500000`.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import time
+
+import numpy as np
+
+from shared_reflex_viewer.model_diff import diff
+from shared_reflex_viewer.property_store import PropertyStore
+
+
+def synthetic_model(elements: int, properties: int, distinct: int, seed: int = 0) -> PropertyStore:
+    """
+    Returns a store where every element has the same attributes with random values
+    @param elements: The number of elements
+    @param properties: The number of properties per element
+    @param distinct: The number of distinct values
+    @param seed: The random seed
+    @return: The store
+    """
+    rng = np.random.default_rng(seed)
+    objects = np.arange(1, elements + 1, dtype=np.int32)
+    return PropertyStore(
+        dbids=np.repeat(objects, properties),
+        attrs=np.tile(np.arange(properties, dtype=np.int32), elements),
+        values=rng.integers(0, distinct, elements * properties, dtype=np.int32),
+        attr_names=[f'Attribute {i}' for i in range(properties)],
+        value_names=[f'Value {i}' for i in range(distinct)],
+        objects=objects,
+        external_ids=[f'{i:08x}-0000-0000-0000-000000000000' for i in objects],
+    )
+
+
+def next_version(store: PropertyStore, removed: float, added: float, changed: float, seed: int = 1) -> PropertyStore:
+    """
+    Returns a new version of a synthetic model with some elements removed, added and changed
+    @param store: The store of the old version
+    @param removed: The fraction of removed elements
+    @param added: The fraction of added elements
+    @param changed: The fraction of elements with one changed property
+    @param seed: The random seed
+    @return: The store of the new version
+    """
+    rng = np.random.default_rng(seed)
+    n = len(store.objects)
+    properties = len(store.attr_names)
+    keep = np.sort(rng.choice(n, n - int(n * removed), replace=False))
+    extra = int(n * added)
+    values = store.values[np.argsort(store.dbids, kind='stable')].reshape(n, properties)[keep]
+    values = np.concatenate((values, rng.integers(0, len(store.value_names), (extra, properties), dtype=np.int32)))
+    touched = rng.choice(len(keep), int(n * changed), replace=False)
+    values[touched, 0] = (values[touched, 0] + 1) % len(store.value_names)
+    # the dbIds are renumbered as it happens when a model is translated again
+    objects = np.arange(1, len(values) + 1, dtype=np.int32)
+    external_ids = [store.external_ids[i] for i in keep] + [f'{n + i:08x}-ffff-0000-0000-000000000000' for i in range(extra)]
+    return PropertyStore(
+        dbids=np.repeat(objects, properties),
+        attrs=np.tile(np.arange(properties, dtype=np.int32), len(objects)),
+        values=values.ravel(),
+        attr_names=store.attr_names,
+        value_names=store.value_names,
+        objects=objects,
+        external_ids=external_ids,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, nargs='+', default=[10_000, 100_000, 500_000])
+    parser.add_argument('--properties', type=int, default=20)
+    parser.add_argument('--distinct', type=int, default=5_000)
+    parser.add_argument('--changes', type=int, default=1_000, help='number of elements whose property changes are listed')
+    args = parser.parse_args()
+
+    print(f'{"elements":>10} {"rows":>11} {"diff s":>8} {"changes s":>10} {"added":>8} {"removed":>8} {"changed":>8}')
+    for n in args.elements:
+        old = synthetic_model(n, args.properties, args.distinct)
+        new = next_version(old, removed=0.01, added=0.01, changed=0.02)
+        start = time.perf_counter()
+        result = diff(old, new)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        changes = result.property_changes(limit=args.changes)
+        changes_elapsed = time.perf_counter() - start
+        assert all(len(c) == 1 for c in changes.values())
+        s = result.summary()
+        print(f'{n:>10} {len(new):>11} {elapsed:>8.2f} {changes_elapsed:>10.2f} '
+              f'{s["added"]:>8} {s["removed"]:>8} {s["changed"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
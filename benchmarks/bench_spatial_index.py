@@ -0,0 +1,109 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Benchmarks the spatial index on the synthetic bounds of a building and checks the answers against a full scan.
+
+Run it from the project folder with `python -m benchmarks.bench_spatial_index --elements 1000000`.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import time
+from typing import Callable
+
+import numpy as np
+
+from shared_reflex_viewer.spatial_index import SpatialIndex, box_distance, ray_entry
+
+
+def synthetic_bounds(elements: int, floors: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Returns the boxes of the elements of a building of 100 x 60 m with floors of 4 m, from bolts to long pipes
+    @param elements: The number of elements
+    @param floors: The number of floors
+    @param seed: The random seed
+    @return: The (n, 6) boxes in meters
+    """
+    rng = np.random.default_rng(seed)
+    floor = rng.integers(0, floors, elements)
+    low = np.column_stack((rng.uniform(0, 100, elements), rng.uniform(0, 60, elements),
+                           floor * 4 + rng.uniform(0, 3.5, elements)))
+    size = rng.lognormal(-1.5, 1.0, (elements, 3))
+    # one element in ten is a long pipe or beam along x or y
+    long = rng.random(elements) < 0.1
+    size[long, rng.integers(0, 2, int(long.sum()))] *= 40
+    return np.concatenate((low, low + size), axis=1).astype(np.float32)
+
+
+def timed(run: Callable[[int], int], queries: int) -> tuple:
+    """Returns the average milliseconds and results of a query"""
+    start = time.perf_counter()
+    found = sum(run(i) for i in range(queries))
+    return (time.perf_counter() - start) * 1000 / queries, found / queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--elements', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--distance', type=float, default=2.0, help='the distance of the near queries in meters')
+    parser.add_argument('--k', type=int, default=10, help='the number of nearest elements')
+    args = parser.parse_args()
+
+    print(f'{"elements":>10} {"build s":>8} {"box ms":>8} {"found":>8} {"near ms":>8} {"found":>8} '
+          f'{"ray ms":>8} {"found":>8} {"knn ms":>8} {"scan ms":>8}')
+    rng = np.random.default_rng(1)
+    for n in args.elements:
+        boxes = synthetic_bounds(n)
+        dbids = np.arange(1, n + 1, dtype=np.int32)
+        start = time.perf_counter()
+        index = SpatialIndex(dbids, boxes)
+        build = time.perf_counter() - start
+
+        # rooms of 6 x 5 x 3.5 m
+        corners = rng.uniform((0, 0, 0), (94, 55, 76), (args.queries, 3)).astype(np.float32)
+        rooms = np.concatenate((corners, corners + np.float32((6, 5, 3.5))), axis=1)
+        references = boxes[rng.integers(0, n, args.queries)]
+        origins = rng.uniform((0, 0, 0), (100, 60, 80), (args.queries, 3))
+        directions = rng.normal(size=(args.queries, 3))
+
+        box_ms, box_found = timed(lambda i: len(index.query_box(rooms[i], contained=True)), args.queries)
+        near_ms, near_found = timed(lambda i: len(index.within(references[i], args.distance)[0]), args.queries)
+        ray_ms, ray_found = timed(lambda i: len(index.ray(origins[i], directions[i], 50)[0]), args.queries)
+        knn_ms, _ = timed(lambda i: len(index.nearest(origins[i], args.k)[0]), args.queries)
+        scan_ms, _ = timed(lambda i: int((box_distance(boxes, references[i]) <= args.distance).sum()), args.queries)
+
+        # the index answers like a full scan
+        for i in range(min(args.queries, 10)):
+            inside = np.all((boxes[:, :3] >= rooms[i, :3]) & (boxes[:, 3:] <= rooms[i, 3:]), axis=1)
+            assert np.array_equal(index.query_box(rooms[i], contained=True), dbids[inside])
+            near = dbids[box_distance(boxes, references[i]) <= args.distance]
+            assert np.array_equal(np.sort(index.within(references[i], args.distance)[0]), near)
+            point = np.concatenate((origins[i], origins[i])).astype(np.float32)
+            closest = np.sort(box_distance(boxes, point))[:args.k]
+            assert np.allclose(index.nearest(origins[i], args.k)[1], closest)
+            crossed = ray_entry(boxes, origins[i], 1 / (directions[i] / np.linalg.norm(directions[i])), 50) < np.inf
+            assert np.array_equal(np.sort(index.ray(origins[i], directions[i], 50)[0]), dbids[crossed])
+        print(f'{n:>10} {build:>8.2f} {box_ms:>8.2f} {box_found:>8.0f} {near_ms:>8.2f} {near_found:>8.0f} '
+              f'{ray_ms:>8.2f} {ray_found:>8.0f} {knn_ms:>8.2f} {scan_ms:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
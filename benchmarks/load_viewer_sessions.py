@@ -0,0 +1,280 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Drives simulated viewer sessions against a running backend over the Reflex websocket, ramping up the number of clients.
+
+Every client logs in, switches between the models and expands the project tree, and sends back the events chained by
+the handlers like the browser does. Start the mock APS and the backend pointed to it first, e.g.
+
+    python -m mock_aps --port 8765 --latency 0.15
+    APS_BASE_URL=http://localhost:8765 reflex run --env prod
+    python -m benchmarks.load_viewer_sessions --steps 10,50,100,200 --step-seconds 30 --backend-pid <pid>
+
+The calls received by the mock are reported with every step, the run fails if the backend expanded the tree without
+listing a folder from the mock, e.g. when it is not started with APS_BASE_URL.
+
+It needs `pip install "python-socketio[asyncio_client]" psutil`.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import asyncio
+import base64
+import json
+import pathlib
+import random
+import time
+import urllib.request
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import psutil
+import socketio
+
+from mock_aps import ROOT_FOLDER
+
+
+NAMESPACE = '/_event'
+# the full names of the event handlers, the names of the state classes in snake case
+HYDRATE = 'state.hydrate'
+LOGIN = 'state.state.login'
+SET_URN = 'state.state.set_urn'
+SET_PROJECT_ID = 'state.tree_weave_state.set_project_id'
+GET_PROJECT_FILES_FOLDER = 'state.tree_weave_state.get_project_files_folder'
+NODE_SELECT = 'state.tree_weave_state.handle_on_node_select'
+TREE_STATE = 'state.tree_weave_state'
+
+
+def model_urn(path: str) -> str:
+    """Returns the derivative URN of an item of the mock project, see mock_aps.MockAPS.contents"""
+    version_id = f'urn:adsk.wipprod:fs.file:vf.{path}?version=1'
+    return base64.urlsafe_b64encode(version_id.encode()).decode().rstrip('=')
+
+
+class Stats:
+    """The round trips and the errors of the events of a ramp step"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.round_trips: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.cpu: List[float] = []
+        self.rss: List[int] = []
+
+    def report(self, clients: int) -> Dict[str, Any]:
+        seconds = time.monotonic() - self.started
+        events = sum(len(r) for r in self.round_trips.values())
+        errors = sum(self.errors.values())
+        handlers = {}
+        for name, rtt in sorted(self.round_trips.items()):
+            p = np.percentile(np.array(rtt) * 1000, [50, 90, 99]).tolist() if len(rtt) > 0 else [0, 0, 0]
+            handlers[name.split('.')[-1]] = {'count': len(rtt), 'p50_ms': round(p[0], 1), 'p90_ms': round(p[1], 1),
+                                             'p99_ms': round(p[2], 1), 'errors': self.errors.get(name, 0)}
+        return {
+            'clients': clients,
+            'seconds': round(seconds, 1),
+            'events_per_second': round(events / seconds, 1),
+            'error_rate': round(errors / max(events + errors, 1), 4),
+            'errors': dict(self.errors),
+            'backend_cpu_percent': round(float(np.mean(self.cpu)), 1) if len(self.cpu) > 0 else None,
+            'backend_rss_mb': round(max(self.rss) / 2 ** 20, 1) if len(self.rss) > 0 else None,
+            'handlers': handlers,
+        }
+
+
+class SimulatedClient:
+    """
+    A browser session: one websocket, one event at a time. The round trip of an event lasts until its final update,
+    the updates pushed by the background handlers in the meantime may end it early.
+    """
+
+    def __init__(self, url: str, models: List[str], project_id: str, think: float, timeout: float):
+        self.url = url
+        self.models = models
+        self.project_id = project_id
+        self.think = think
+        self.timeout = timeout
+        self.token = str(uuid.uuid4())
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.folders: List[str] = []
+        self.stats: Optional[Stats] = None
+        self.sio.on('event', self._on_update, namespace=NAMESPACE)
+
+    async def _on_update(self, data: str) -> None:
+        await self.updates.put(json.loads(data))
+
+    def _router_data(self, path: str) -> Dict[str, Any]:
+        pathname, _, query = path.partition('?')
+        return {'pathname': pathname, 'query': dict(q.split('=', 1) for q in query.split('&') if '=' in q),
+                'asPath': path}
+
+    async def send(self, name: str, payload: Dict[str, Any] = None, path: str = '/?code=mock') -> None:
+        """Sends an event, waits for its final update and sends the events it chained"""
+        pending = [(name, payload or {})]
+        while len(pending) > 0:
+            name, payload = pending.pop(0)
+            event = {'token': self.token, 'name': name, 'payload': payload, 'router_data': self._router_data(path)}
+            started = time.perf_counter()
+            try:
+                await self.sio.emit('event', json.dumps(event), namespace=NAMESPACE)
+                while True:
+                    update = await asyncio.wait_for(self.updates.get(), self.timeout)
+                    self._learn(update)
+                    for e in update.get('events', []):
+                        if e['name'] == '_alert':
+                            raise RuntimeError(e['payload'].get('message', 'alert'))
+                        if not e['name'].startswith('_'):
+                            pending.append((e['name'], e.get('payload', {})))
+                    if update.get('final', True):
+                        break
+            except asyncio.TimeoutError:
+                self.stats.errors[name] += 1
+                self.stats.errors['timeout'] += 1
+                return
+            except Exception:
+                self.stats.errors[name] += 1
+                return
+            self.stats.round_trips[name].append(time.perf_counter() - started)
+
+    def _learn(self, update: Dict[str, Any]) -> None:
+        """Collects the folders of the tree the client can expand"""
+        data = update.get('delta', {}).get(TREE_STATE, {}).get('data')
+        if data is not None:
+            self.folders = [k for k, v in data.items() if v.get('is_folder')]
+
+    async def run(self, stop: asyncio.Event) -> None:
+        try:
+            await self.sio.connect(self.url, socketio_path='_event', namespaces=[NAMESPACE], transports=['websocket'])
+        except Exception:
+            self.stats.errors['connect'] += 1
+            return
+        try:
+            await self.send(HYDRATE)
+            await self.send(LOGIN)
+            if self.project_id != '':
+                await self.send(SET_PROJECT_ID, {'value': self.project_id}, path='/tree?code=mock')
+                await self.send(GET_PROJECT_FILES_FOLDER, path='/tree?code=mock')
+            while not stop.is_set() and self.sio.connected:
+                await asyncio.sleep(random.expovariate(1 / self.think) if self.think > 0 else 0)
+                if len(self.folders) > 0 and random.random() < 0.7:
+                    await self.send(NODE_SELECT, {'oid': random.choice(self.folders)}, path='/tree?code=mock')
+                else:
+                    await self.send(SET_URN, {'e': random.choice(self.models)})
+            if not self.sio.connected:
+                self.stats.errors['disconnect'] += 1
+        finally:
+            await self.sio.disconnect()
+
+
+def mock_calls(aps_url: str) -> Dict[str, int]:
+    """Returns the number of calls received by every endpoint of the mock APS, see mock_aps.MockAPS.count"""
+    with urllib.request.urlopen(f'{aps_url.rstrip("/")}/mock/calls', timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def backend_processes(pid: int) -> List[psutil.Process]:
+    process = psutil.Process(pid)
+    return [process] + process.children(recursive=True)
+
+
+async def sample(pid: Optional[int], stats: Stats, stop: asyncio.Event) -> None:
+    """Samples the CPU and the memory of the backend and of its workers every second"""
+    if pid is None:
+        return
+    processes = backend_processes(pid)
+    for p in processes:
+        p.cpu_percent()
+    while not stop.is_set():
+        await asyncio.sleep(1)
+        cpu, rss = 0.0, 0
+        for p in processes:
+            try:
+                cpu += p.cpu_percent()
+                rss += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        stats.cpu.append(cpu)
+        stats.rss.append(rss)
+
+
+async def ramp(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    models = [model_urn(f'root.{i}') for i in range(5)]
+    clients: List[SimulatedClient] = []
+    tasks: List[asyncio.Task] = []
+    stop = asyncio.Event()
+    reports = []
+    started = await asyncio.to_thread(mock_calls, args.aps_url)
+    calls = started
+    for count in [int(c) for c in args.steps.split(',')]:
+        stats = Stats()
+        for client in clients:
+            client.stats = stats
+        while len(clients) < count:
+            client = SimulatedClient(args.url, models, args.project, args.think, args.timeout)
+            client.stats = stats
+            clients.append(client)
+            tasks.append(asyncio.create_task(client.run(stop)))
+            await asyncio.sleep(1 / args.connect_rate)
+        step_stop = asyncio.Event()
+        sampler = asyncio.create_task(sample(args.backend_pid, stats, step_stop))
+        await asyncio.sleep(args.step_seconds)
+        step_stop.set()
+        await sampler
+        report = stats.report(count)
+        previous, calls = calls, await asyncio.to_thread(mock_calls, args.aps_url)
+        report['aps_calls'] = {k: v - previous.get(k, 0) for k, v in calls.items() if v > previous.get(k, 0)}
+        reports.append(report)
+        print(json.dumps({k: v for k, v in report.items() if k != 'handlers'}))
+        for name, h in report['handlers'].items():
+            print(f'    {name}: {h}')
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    expanded = sum(r['handlers'].get(n.split('.')[-1], {}).get('count', 0) for r in reports
+                   for n in (GET_PROJECT_FILES_FOLDER, NODE_SELECT))
+    listed = calls.get('contents', 0) - started.get('contents', 0)
+    # the folders are listed from the cache after the first expansion, at least one listing must reach the mock
+    assert expanded == 0 or listed > 0, f'{expanded} tree events and no folder listed by the mock APS at {args.aps_url}'
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000', help='the backend URL')
+    parser.add_argument('--aps-url', default='http://localhost:8765', help='the mock APS URL the backend is pointed to')
+    parser.add_argument('--steps', default='10,25,50,100', help='the numbers of clients of the ramp')
+    parser.add_argument('--step-seconds', type=float, default=30)
+    parser.add_argument('--connect-rate', type=float, default=20, help='the clients connected per second')
+    parser.add_argument('--think', type=float, default=1.0, help='the average seconds between two events of a client')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--project', default='', help='the project whose root folder is ' + ROOT_FOLDER)
+    parser.add_argument('--backend-pid', type=int, default=None, help='the backend process, to sample its CPU and memory')
+    parser.add_argument('--output', type=pathlib.Path, default=None, help='the JSON file the reports are saved to')
+    args = parser.parse_args()
+
+    reports = asyncio.run(ramp(args))
+    if args.output is not None:
+        args.output.write_text(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+import decouple
+import requests
+
+
+BREAKER_ERROR_RATE = decouple.config('BREAKER_ERROR_RATE', default=0.5, cast=float)
+BREAKER_MIN_REQUESTS = decouple.config('BREAKER_MIN_REQUESTS', default=10, cast=int)
+BREAKER_WINDOW_SECONDS = decouple.config('BREAKER_WINDOW_SECONDS', default=30, cast=float)
+BREAKER_OPEN_SECONDS = decouple.config('BREAKER_OPEN_SECONDS', default=15, cast=float)
+BREAKER_HALF_OPEN_TRIALS = decouple.config('BREAKER_HALF_OPEN_TRIALS', default=2, cast=int)
+# the requests slower than this count as failures
+BREAKER_TIMEOUT_SECONDS = decouple.config('BREAKER_TIMEOUT_SECONDS', default=10, cast=float)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+
+def is_outage(ex: BaseException) -> bool:
+    """
+    Returns True if an error means that APS is unavailable rather than that the request is wrong
+    @param ex: The error
+    @return: True for open circuits, connection errors, timeouts and 5xx responses
+    """
+    if isinstance(ex, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status = getattr(getattr(ex, 'response', None), 'status_code', None)
+    return status is not None and status >= 500
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the requests to an endpoint over a sliding window.
+
+    The circuit opens when at least `min_requests` requests were made in the window and the share of failures reaches
+    `error_rate`; the calls then fail immediately for `open_seconds`. After that up to `trials` requests are let through
+    and the circuit closes if they all succeed, or opens again at the first failure.
+    """
+
+    def __init__(self, name: str, error_rate: float = BREAKER_ERROR_RATE, min_requests: int = BREAKER_MIN_REQUESTS,
+                 window: float = BREAKER_WINDOW_SECONDS, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 trials: int = BREAKER_HALF_OPEN_TRIALS):
+        self.name = name
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.trials = trials
+        self.state = CLOSED
+        self.opened = 0.0
+        self._lock = threading.Lock()
+        # (time, success) of the requests in the window
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._trials_started = 0
+        self._trials_passed = 0
+
+    def allow(self) -> None:
+        """
+        Reserves a request, raises CircuitOpenError if the circuit is open
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened < self.open_seconds:
+                    raise CircuitOpenError(f'APS {self.name} is unavailable, retrying in '
+                                           f'{self.open_seconds - (time.monotonic() - self.opened):.0f}s')
+                self.state = HALF_OPEN
+                self._trials_started = 0
+                self._trials_passed = 0
+            if self.state == HALF_OPEN:
+                if self._trials_started >= self.trials:
+                    raise CircuitOpenError(f'APS {self.name} is being probed')
+                self._trials_started += 1
+
+    def record(self, success: bool) -> None:
+        """
+        Records the outcome of a request reserved by allow
+        @param success: False for connection errors, timeouts and 5xx responses
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if not success:
+                    self._open(now)
+                    return
+                self._trials_passed += 1
+                if self._trials_passed >= self.trials:
+                    logging.info(f'APS {self.name} is available again')
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                return
+            self._outcomes.append((now, success))
+            self._failures += not success
+            while len(self._outcomes) > 0 and now - self._outcomes[0][0] > self.window:
+                self._failures -= not self._outcomes.popleft()[1]
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_requests
+                    and self._failures / len(self._outcomes) >= self.error_rate):
+                self._open(now)
+
+    def abandon(self) -> None:
+        """Gives back a request reserved by allow that was not sent"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials_started > self._trials_passed:
+                self._trials_started -= 1
+
+    def _open(self, now: float) -> None:
+        logging.warning(f'APS {self.name} is failing, the circuit is open for {self.open_seconds}s')
+        self.state = OPEN
+        self.opened = now
+        self._outcomes.clear()
+        self._failures = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'state': self.state, 'requests': len(self._outcomes), 'failures': self._failures}
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """
+    Returns the process-wide circuit breaker of an endpoint
+    @param name: The endpoint name
+    @return: The breaker
+    """
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def open_circuits() -> Dict[str, str]:
+    """Returns the state of the circuits that are not closed"""
+    with _lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.state for b in breakers if b.state != CLOSED}
@@ -0,0 +1,331 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Downloads OSS objects and derivatives in parallel byte ranges.
+
+Run it from the project folder with `python -m downloads oss <bucket> <object key> <file>` or
+`python -m downloads derivative <urn> <derivative urn> <file>`, an interrupted download continues when the same
+command is run again.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pathlib
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Optional
+
+import decouple
+import requests
+from requests.adapters import HTTPAdapter
+
+import aps
+import model_derivative
+import oss
+from scheduler import scheduler
+
+
+DOWNLOAD_RANGE_SIZE = decouple.config('DOWNLOAD_RANGE_SIZE', default=8 * 1024 * 1024, cast=int)
+DOWNLOAD_WORKERS = decouple.config('DOWNLOAD_WORKERS', default=8, cast=int)
+DOWNLOAD_RETRIES = decouple.config('DOWNLOAD_RETRIES', default=5, cast=int)
+
+CHUNK_SIZE = 1 << 20
+
+
+@dataclass
+class DownloadSource:
+    """A signed URL that accepts ranged requests, with the size and the optional SHA-1 of the content."""
+    url: str
+    size: int
+    sha1: str = ''
+    cookies: Dict[str, str] = field(default_factory=dict)
+
+
+def oss_source(bucket: str, object_key: str) -> DownloadSource:
+    """
+    Returns a signed S3 URL of an OSS object
+    @param bucket: The bucket key
+    @param object_key: The object key
+    @return: The source
+    """
+    resp = scheduler.get(f'{oss.OSS_ENDPOINT}/buckets/{bucket}/objects/{urllib.parse.quote(object_key, safe="")}/signeds3download',
+                        headers={'Authorization': aps.token.Value}, params={'minutesExpiration': 60})
+    resp.raise_for_status()
+    j = resp.json()
+    if j.get('status') != 'complete':
+        raise ValueError(f'{bucket}/{object_key} is not available: {j.get("status")}')
+    return DownloadSource(url=j['url'], size=int(j['size']), sha1=j.get('sha1') or '')
+
+
+def derivative_source(urn: str, derivative_urn: str) -> DownloadSource:
+    """
+    Returns the URL and the signed cookies of a derivative like a property database or an exported IFC
+    @param urn: The base64 encoded URN of the source file
+    @param derivative_urn: The URN of the derivative in the manifest
+    @return: The source
+    """
+    resp = scheduler.get(f'{model_derivative.ENDPOINT}/{urn}/manifest/{urllib.parse.quote(derivative_urn, safe="")}/signedcookies',
+                        headers={'Authorization': aps.token.Value})
+    resp.raise_for_status()
+    j = resp.json()
+    return DownloadSource(url=j['url'], size=int(j['size']), cookies=resp.cookies.get_dict())
+
+
+@dataclass
+class DownloadProgress:
+    """The progress of a download, the throughput only counts the bytes received by this run."""
+    size: int = 0
+    ranges: int = 0
+    completed: int = 0
+    downloaded: int = 0
+    received: int = 0
+    retries: int = 0
+    started: float = field(default_factory=time.time)
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second"""
+        return self.received / max(self.elapsed, 1e-6)
+
+    def __str__(self) -> str:
+        return (f'{self.completed}/{self.ranges} ranges, {self.downloaded / 2 ** 20:.1f}/{self.size / 2 ** 20:.1f} MB, '
+                f'{self.throughput / 2 ** 20:.1f} MB/s, {self.retries} retries')
+
+
+@dataclass
+class DownloadState:
+    """The ranges already written to the partial file with their SHA-1, saved after every range."""
+    size: int
+    sha1: str
+    range_size: int
+    completed: Dict[str, str] = field(default_factory=dict)
+
+    def save(self, path: pathlib.Path) -> None:
+        temp = path.with_suffix(f'.{os.getpid()}.tmp')
+        temp.write_text(json.dumps(asdict(self)))
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional['DownloadState']:
+        if not path.exists():
+            return None
+        try:
+            return cls(**json.loads(path.read_text()))
+        except Exception as ex:
+            logging.warning(f'ignoring the download state {path}: {ex}')
+            return None
+
+
+class Downloader:
+    """
+    Downloads a source into a file in byte ranges.
+
+    The file is preallocated and memory-mapped, every range is streamed by a pooled connection straight into its slice
+    of the map. The SHA-1 of every range is saved, so that an interrupted download checks the ranges already on disk and
+    fetches only the missing ones, and the whole file is checked against the SHA-1 of the source when there is one.
+    """
+
+    def __init__(self, source: Callable[[], DownloadSource], target: pathlib.Path,
+                 range_size: int = DOWNLOAD_RANGE_SIZE, workers: int = DOWNLOAD_WORKERS,
+                 retries: int = DOWNLOAD_RETRIES, on_progress: Optional[Callable[[DownloadProgress], None]] = None):
+        """
+        @param source: Returns a signed source, it is called again when the signature expires
+        @param target: The downloaded file
+        """
+        self.source = source
+        self.target = pathlib.Path(target)
+        self.range_size = range_size
+        self.workers = workers
+        self.retries = retries
+        self.on_progress = on_progress
+        self.progress = DownloadProgress()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._current: Optional[DownloadSource] = None
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @property
+    def partial(self) -> pathlib.Path:
+        return self.target.with_name(self.target.name + '.part')
+
+    @property
+    def state_path(self) -> pathlib.Path:
+        return self.target.with_name(self.target.name + '.download.json')
+
+    def stop(self) -> None:
+        """Stops the download after the ranges being received, it can be resumed later"""
+        self._stop.set()
+
+    def run(self) -> pathlib.Path:
+        """
+        Downloads the file
+        @return: The downloaded file
+        """
+        self._current = self.source()
+        size = self._current.size
+        state = DownloadState.load(self.state_path)
+        if state is None or state.size != size or state.sha1 != self._current.sha1 or not self.partial.exists():
+            state = DownloadState(size=size, sha1=self._current.sha1, range_size=self.range_size)
+        self.target.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.partial, 'a+b') as f:
+            f.truncate(size)
+        if size == 0:
+            os.replace(self.partial, self.target)
+            return self.target
+
+        ranges = -(-size // state.range_size)
+        with open(self.partial, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+            try:
+                # the ranges written before the interruption are kept only if they are still intact
+                for index, digest in list(state.completed.items()):
+                    start, end = self._range(state, int(index))
+                    if hashlib.sha1(mm[start:end]).hexdigest() != digest:
+                        logging.warning(f'range {index} of {self.partial} is corrupted, downloading it again')
+                        del state.completed[index]
+                missing = [i for i in range(ranges) if str(i) not in state.completed]
+                self.progress = DownloadProgress(size=size, ranges=ranges, completed=ranges - len(missing),
+                                                 downloaded=sum(self._range(state, int(i))[1] - self._range(state, int(i))[0]
+                                                                for i in state.completed))
+                if len(state.completed) > 0:
+                    logging.info(f'resuming the download of {self.target}: {self.progress}')
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='download') as executor:
+                    futures = [executor.submit(self._download_range, state, mm, i) for i in missing]
+                    for future in as_completed(futures):
+                        if future.exception() is not None:
+                            self._stop.set()
+                            raise future.exception()
+                if self._stop.is_set():
+                    raise InterruptedError(f'The download of {self.target} was stopped: {self.progress}')
+                mm.flush()
+                if state.sha1 != '':
+                    digest = hashlib.sha1()
+                    for start in range(0, size, CHUNK_SIZE * 16):
+                        digest.update(mm[start:start + CHUNK_SIZE * 16])
+                    if digest.hexdigest() != state.sha1:
+                        self.state_path.unlink(missing_ok=True)
+                        raise ValueError(f'The SHA-1 of {self.target} does not match the source')
+            finally:
+                mm.close()
+        os.replace(self.partial, self.target)
+        self.state_path.unlink(missing_ok=True)
+        logging.info(f'downloaded {self.target}: {self.progress}')
+        return self.target
+
+    def _range(self, state: DownloadState, index: int) -> tuple:
+        start = index * state.range_size
+        return start, min(start + state.range_size, state.size)
+
+    def _refresh(self, expired: DownloadSource) -> DownloadSource:
+        with self._lock:
+            if self._current is expired:
+                self._current = self.source()
+            return self._current
+
+    def _download_range(self, state: DownloadState, mm: mmap.mmap, index: int) -> None:
+        start, end = self._range(state, index)
+        for attempt in range(self.retries):
+            if self._stop.is_set():
+                return
+            source = self._current
+            pos = start
+            digest = hashlib.sha1()
+            try:
+                with self._session.get(source.url, headers={'Range': f'bytes={start}-{end - 1}'},
+                                       cookies=source.cookies, stream=True, timeout=60) as resp:
+                    if resp.status_code == 403:
+                        # the signature expired
+                        source = self._refresh(source)
+                        raise requests.HTTPError(f'403 {resp.text[:200]}', response=resp)
+                    resp.raise_for_status()
+                    if resp.status_code != 206 and (start, end) != (0, state.size):
+                        raise ValueError(f'{resp.url} does not support ranged requests')
+                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                        if pos + len(chunk) > end:
+                            raise ValueError(f'range {index} is longer than expected')
+                        mm[pos:pos + len(chunk)] = chunk
+                        digest.update(chunk)
+                        pos += len(chunk)
+                        with self._lock:
+                            self.progress.received += len(chunk)
+                        if self._stop.is_set():
+                            return
+                if pos != end:
+                    raise requests.ConnectionError(f'range {index} ended after {pos - start} of {end - start} bytes')
+                break
+            except (requests.RequestException, ValueError) as ex:
+                if attempt == self.retries - 1 or (isinstance(ex, ValueError) and 'ranged' in str(ex)):
+                    raise
+                with self._lock:
+                    self.progress.retries += 1
+                logging.warning(f'range {index} of {self.target} failed, retrying: {ex}')
+                time.sleep(min(2 ** attempt, 30))
+        with self._lock:
+            state.completed[str(index)] = digest.hexdigest()
+            state.save(self.state_path)
+            self.progress.completed += 1
+            self.progress.downloaded += end - start
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('kind', choices=('oss', 'derivative'))
+    parser.add_argument('key', help='the bucket key or the URN of the source file')
+    parser.add_argument('object', help='the object key or the URN of the derivative')
+    parser.add_argument('file', type=pathlib.Path)
+    parser.add_argument('--range-size', type=int, default=DOWNLOAD_RANGE_SIZE)
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.kind == 'oss':
+        source = lambda: oss_source(args.key, args.object)
+    else:
+        source = lambda: derivative_source(args.key, args.object)
+    last = [0.0]
+
+    def report(progress: DownloadProgress):
+        if time.time() - last[0] > 1 or progress.completed == progress.ranges:
+            last[0] = time.time()
+            print(progress)
+
+    downloader = Downloader(source, args.file, range_size=args.range_size, workers=args.workers, on_progress=report)
+    print(downloader.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+A local mock of the APS endpoints used by the project, to try the uploads, the downloads and the load tests without
+an APS account.
+
+Run it from the project folder with `python -m mock_aps --port 8765` and set `APS_BASE_URL=http://localhost:8765`
+in the `.env` file. The objects are kept in memory, the project tree, the manifests and the properties are synthetic.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+SIGNED_UPLOAD = re.compile(r'^/oss/v2/buckets/([^/]+)/objects/([^/]+)/signeds3upload$')
+SIGNED_DOWNLOAD = re.compile(r'^/oss/v2/buckets/([^/]+)/objects/([^/]+)/signeds3download$')
+OBJECT = re.compile(r'^/s3/download/([^/]+)/([^/]+)$')
+RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+PART = re.compile(r'^/s3/upload/([^/]+)/(\d+)$')
+BUCKETS = re.compile(r'^/oss/v2/buckets$')
+BUCKET_DETAILS = re.compile(r'^/oss/v2/buckets/([^/]+)/details$')
+TOKEN = re.compile(r'^/authentication/v2/(token|introspect)$')
+USERINFO = re.compile(r'^/userinfo$')
+MANIFEST = re.compile(r'^/modelderivative/v2/designdata/([^/]+)/manifest$')
+ASSET = re.compile(r'^/modelderivative/v2/designdata/([^/]+)/manifest/([^/]+)$')
+METADATA = re.compile(r'^/modelderivative/v2/designdata/([^/]+)/metadata$')
+PROPERTIES = re.compile(r'^/modelderivative/v2/designdata/([^/]+)/metadata/([^/]+)/properties$')
+THUMBNAIL = re.compile(r'^/modelderivative/v2/designdata/([^/]+)/thumbnail$')
+CONTENTS = re.compile(r'^/data/v1/projects/([^/]+)/folders/([^/]+)/contents$')
+SEARCH = re.compile(r'^/data/v1/projects/([^/]+)/folders/([^/]+)/search$')
+HUBS = re.compile(r'^/project/v1/hubs$')
+PROJECTS = re.compile(r'^/project/v1/hubs/([^/]+)/projects$')
+TOP_FOLDERS = re.compile(r'^/project/v1/hubs/([^/]+)/projects/([^/]+)/topFolders$')
+CALLS = re.compile(r'^/mock/calls$')
+# the names the calls are counted by, see MockAPS.count
+ROUTES: Tuple[Tuple[str, re.Pattern], ...] = (
+    ('signed_upload', SIGNED_UPLOAD), ('signed_download', SIGNED_DOWNLOAD), ('object', OBJECT), ('part', PART),
+    ('buckets', BUCKETS), ('bucket_details', BUCKET_DETAILS), ('token', TOKEN), ('userinfo', USERINFO),
+    ('manifest', MANIFEST), ('asset', ASSET), ('metadata', METADATA), ('properties', PROPERTIES),
+    ('thumbnail', THUMBNAIL), ('contents', CONTENTS), ('search', SEARCH), ('hubs', HUBS), ('projects', PROJECTS),
+    ('top_folders', TOP_FOLDERS),
+)
+
+ROOT_FOLDER = 'urn:adsk.wipprod:fs.folder:co.root'
+HUB = 'b.mock-hub'
+# a 1x1 transparent PNG
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+class MockAPS(ThreadingHTTPServer):
+    """
+    Serves the OSS signed upload and download endpoints, the signed URLs point back to the server itself, and the
+    authentication, user profile, model derivative, derivative assets, hubs, projects, folder contents and search
+    endpoints used by the viewer. GET /mock/calls returns the number of calls received by every endpoint, the load
+    tests check with it that the backend is pointed to the mock.
+    @param fail_rate: The fraction of the part uploads and ranged downloads that fail with a 500, to exercise the
+    retries
+    @param latency: The average seconds every response is delayed by
+    @param breadth: The number of sub folders and of items of every folder of the synthetic project
+    @param depth: The depth of the folders of the synthetic project
+    @param elements: The number of elements of every synthetic model
+    """
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: Tuple[str, int], fail_rate: float = 0.0, latency: float = 0.0, breadth: int = 5,
+                 depth: int = 4, elements: int = 1000):
+        super().__init__(address, Handler)
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.breadth = breadth
+        self.depth = depth
+        self.elements = elements
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Dict[str, Any]] = {}
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        # the parts received for every upload key
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self.calls: Dict[str, int] = {}
+
+    def handle_error(self, request: Any, client_address: Tuple[str, int]) -> None:
+        # the clients close the connections of the transfers they stop
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, path: str) -> None:
+        """Counts a call by the name of its endpoint, see ROUTES"""
+        name = next((n for n, pattern in ROUTES if pattern.match(path) is not None), 'other')
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def contents(self, folder_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the JSON:API contents of a folder of the synthetic project, the folder ids encode their path
+        @param folder_id: The folder id
+        @return: The contents or None if the folder does not exist
+        """
+        path = folder_id.removeprefix('urn:adsk.wipprod:fs.folder:co.')
+        parts = path.split('.')
+        if parts[0] != 'root' or len(parts) > self.depth + 1 or not all(p.isdigit() for p in parts[1:]):
+            return None
+        data, included = [], []
+        if len(parts) <= self.depth:
+            for i in range(self.breadth):
+                data.append({'type': 'folders', 'id': f'{folder_id}.{i}', 'attributes': {'name': f'Folder {path}.{i}'}})
+        for i in range(self.breadth):
+            item_id = f'urn:adsk.wipprod:dm.lineage:{path}.{i}'
+            version_id = f'urn:adsk.wipprod:fs.file:vf.{path}.{i}?version=1'
+            data.append({'type': 'items', 'id': item_id, 'attributes': {'displayName': f'Model {path}.{i}.rvt'}})
+            included.append({
+                'type': 'versions',
+                'id': version_id,
+                'attributes': {'name': f'Model {path}.{i}.rvt', 'versionNumber': 1},
+                'relationships': {
+                    'item': {'data': {'type': 'items', 'id': item_id}},
+                    'derivatives': {'data': {'type': 'derivatives',
+                                             'id': base64.urlsafe_b64encode(version_id.encode()).decode().rstrip('=')}},
+                },
+            })
+        return {'data': data, 'included': included, 'links': {}}
+
+    def search(self, folder_id: str, text: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the tip versions of the items of a folder and of its sub folders whose names contain a text
+        @param folder_id: The folder id
+        @param text: The text, case insensitive
+        @return: The JSON:API versions or None if the folder does not exist
+        """
+        if self.contents(folder_id) is None:
+            return None
+        data, folders = [], [folder_id]
+        while len(folders) > 0:
+            contents = self.contents(folders.pop())
+            folders.extend(d['id'] for d in contents['data'] if d['type'] == 'folders')
+            data.extend(v for v in contents['included'] if text.lower() in v['attributes']['name'].lower())
+        for v in data:
+            v['attributes'] = {**v['attributes'], 'displayName': v['attributes']['name'],
+                               'lastModifiedTime': '2024-01-01T00:00:00.0000000Z'}
+        return {'data': data, 'links': {}}
+
+    def projects(self, hub_id: str, page: int, limit: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns a JSON:API page of the projects of the hub, `breadth` projects sharing the synthetic folders
+        @param hub_id: The hub id
+        @param page: The page number
+        @param limit: The projects per page
+        @return: The page or None if the hub does not exist
+        """
+        if hub_id != HUB:
+            return None
+        data = [{
+            'type': 'projects',
+            'id': f'b.mock-project-{i}',
+            'attributes': {'name': f'Project {i}'},
+            'relationships': {'rootFolder': {'data': {'type': 'folders', 'id': ROOT_FOLDER}}},
+        } for i in range(page * limit, min((page + 1) * limit, self.breadth))]
+        links = {}
+        if (page + 1) * limit < self.breadth:
+            links['next'] = {'href': f'{self.base_url}/project/v1/hubs/{hub_id}/projects?page[number]={page + 1}'
+                                     f'&page[limit]={limit}'}
+        return {'data': data, 'links': links}
+
+    def properties(self, urn: str) -> Dict[str, Any]:
+        """Returns the properties of a synthetic model, the same for every URN"""
+        categories = ('Revit Walls', 'Revit Doors', 'Revit Ducts', 'Revit Pipes', 'Revit Floors')
+        return {'data': {'type': 'properties', 'collection': [
+            {
+                'objectid': i,
+                'name': f'Element [{i}]',
+                'externalId': f'{i:08x}-0000-0000-0000-000000000000',
+                'properties': {
+                    'Identity Data': {'Category': categories[i % len(categories)], 'Mark': str(i)},
+                    'Dimensions': {'Length': f'{i % 97 * 0.1:.1f} m'},
+                },
+            }
+            for i in range(1, self.elements + 1)
+        ]}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: MockAPS
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: Optional[Dict[str, Any]] = None) -> None:
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_range(self, data: bytes, match: Optional[re.Match]) -> None:
+        start, end = 0, len(data) - 1
+        if match is not None:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) != '' else end
+        self.send_response(206 if match is not None else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        if match is not None:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _delay(self) -> None:
+        if self.server.latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * self.server.latency)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if CALLS.match(url.path) is not None:
+            with self.server.lock:
+                return self._send(200, dict(self.server.calls))
+        self.server.count(url.path)
+        self._delay()
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if USERINFO.match(url.path) is not None:
+            return self._send(200, {'sub': 'MOCKUSER', 'name': 'Mock User', 'email': 'mock.user@example.com'})
+        if (m := MANIFEST.match(url.path)) is not None:
+            return self._send(200, {
+                'urn': m.group(1),
+                'status': 'success',
+                'progress': 'complete',
+                'derivatives': [{'outputType': 'svf2', 'status': 'success', 'progress': 'complete', 'children': [
+                    {'guid': 'mock-3d', 'role': '3d', 'type': 'geometry', 'name': '{3D}'}
+                ]}],
+            })
+        if (m := ASSET.match(url.path)) is not None:
+            # a synthetic asset of 1MB, the same for the same URN and derivative URN
+            seed = hashlib.sha1(f'{m.group(1)}/{m.group(2)}'.encode()).digest()
+            return self._send_range(seed * (2 ** 20 // len(seed)), RANGE.match(self.headers.get('Range', '')))
+        if METADATA.match(url.path) is not None:
+            return self._send(200, {'data': {'type': 'metadata', 'metadata': [
+                {'guid': 'mock-3d', 'role': '3d', 'name': '{3D}'}
+            ]}})
+        if (m := PROPERTIES.match(url.path)) is not None:
+            return self._send(200, self.server.properties(m.group(1)))
+        if THUMBNAIL.match(url.path) is not None:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(PNG)))
+            self.end_headers()
+            self.wfile.write(PNG)
+            return
+        if (m := SEARCH.match(url.path)) is not None:
+            found = self.server.search(m.group(2), query.get('filter[attributes.displayName]-contains', ''))
+            if found is None:
+                return self._send(404, {'errors': [{'detail': 'Folder not found'}]})
+            return self._send(200, found)
+        if HUBS.match(url.path) is not None:
+            return self._send(200, {'data': [{'type': 'hubs', 'id': HUB, 'attributes': {'name': 'Mock Hub'}}],
+                                    'links': {}})
+        if (m := PROJECTS.match(url.path)) is not None:
+            projects = self.server.projects(m.group(1), int(query.get('page[number]', 0)),
+                                            int(query.get('page[limit]', 200)))
+            if projects is None:
+                return self._send(404, {'errors': [{'detail': 'Hub not found'}]})
+            return self._send(200, projects)
+        if TOP_FOLDERS.match(url.path) is not None:
+            folders = [f for f in self.server.contents(ROOT_FOLDER)['data'] if f['type'] == 'folders']
+            return self._send(200, {'data': folders})
+        if (m := CONTENTS.match(url.path)) is not None:
+            contents = self.server.contents(m.group(2))
+            if contents is None:
+                return self._send(404, {'errors': [{'detail': 'Folder not found'}]})
+            if query.get('filter[type]') == 'items':
+                contents['data'] = [d for d in contents['data'] if d['type'] == 'items']
+            return self._send(200, contents)
+        if (m := SIGNED_UPLOAD.match(url.path)) is not None:
+            upload_key = query.get('uploadKey') or uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads.setdefault(upload_key, {})
+            first = int(query.get('firstPart', 1))
+            urls = [f'{self.server.base_url}/s3/upload/{upload_key}/{p}'
+                    for p in range(first, first + int(query.get('parts', 1)))]
+            return self._send(200, {'uploadKey': upload_key, 'urls': urls})
+        if (m := SIGNED_DOWNLOAD.match(url.path)) is not None:
+            data = self.server.objects.get((m.group(1), m.group(2)))
+            if data is None:
+                return self._send(404, {'reason': 'Object not found'})
+            return self._send(200, {
+                'status': 'complete',
+                'url': f'{self.server.base_url}/s3/download/{m.group(1)}/{m.group(2)}',
+                'size': len(data),
+                'sha1': hashlib.sha1(data).hexdigest(),
+            })
+        if (m := OBJECT.match(url.path)) is not None:
+            data = self.server.objects.get((m.group(1), m.group(2)))
+            if data is None:
+                return self._send(404, {'reason': 'Object not found'})
+            if random.random() < self.server.fail_rate:
+                return self._send(500, {'reason': 'Simulated failure'})
+            return self._send_range(data, RANGE.match(self.headers.get('Range', '')))
+        if (m := BUCKET_DETAILS.match(url.path)) is not None:
+            if m.group(1) not in self.server.buckets:
+                return self._send(404, {'reason': 'Bucket not found'})
+            return self._send(200, self.server.buckets[m.group(1)])
+        self._send(404, {'reason': f'{url.path} not found'})
+
+    def do_PUT(self) -> None:
+        url = urlparse(self.path)
+        self.server.count(url.path)
+        self._delay()
+        if (m := PART.match(url.path)) is not None:
+            data = self._body()
+            if random.random() < self.server.fail_rate:
+                return self._send(500, {'reason': 'Simulated failure'})
+            with self.server.lock:
+                if m.group(1) not in self.server.uploads:
+                    return self._send(403, {'reason': 'Request has expired'})
+                self.server.uploads[m.group(1)][int(m.group(2))] = data
+            return self._send(200)
+        self._send(404, {'reason': f'{url.path} not found'})
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        self.server.count(url.path)
+        self._delay()
+        raw = self._body()
+        if (m := TOKEN.match(url.path)) is not None:
+            if m.group(1) == 'introspect':
+                return self._send(200, {'active': True, 'exp': int(time.time()) + 3600})
+            return self._send(200, {'access_token': f'mock-{uuid.uuid4().hex}', 'refresh_token': 'mock-refresh',
+                                    'token_type': 'Bearer', 'expires_in': 3599})
+        body = json.loads(raw or b'{}')
+        if BUCKETS.match(url.path) is not None:
+            with self.server.lock:
+                if body['bucketKey'] in self.server.buckets:
+                    return self._send(409, {'reason': 'Bucket already exists'})
+                self.server.buckets[body['bucketKey']] = {'bucketKey': body['bucketKey'], 'policyKey': body['policyKey']}
+            return self._send(200, self.server.buckets[body['bucketKey']])
+        if (m := SIGNED_UPLOAD.match(url.path)) is not None:
+            bucket, key = m.group(1), m.group(2)
+            with self.server.lock:
+                parts = self.server.uploads.pop(body.get('uploadKey'), None)
+                if parts is None:
+                    return self._send(400, {'reason': 'Invalid upload key'})
+                if sorted(parts) != list(range(1, len(parts) + 1)):
+                    return self._send(400, {'reason': 'Missing parts'})
+                data = b''.join(parts[p] for p in sorted(parts))
+                self.server.objects[(bucket, key)] = data
+            return self._send(200, {
+                'bucketKey': bucket,
+                'objectKey': key,
+                'objectId': f'urn:adsk.objects:os.object:{bucket}/{key}',
+                'size': len(data),
+                'contentType': 'application/octet-stream',
+                'location': f'{self.server.base_url}/oss/v2/buckets/{bucket}/objects/{key}',
+            })
+        self._send(404, {'reason': f'{url.path} not found'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='average seconds every response is delayed by')
+    parser.add_argument('--breadth', type=int, default=5)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--elements', type=int, default=1000)
+    args = parser.parse_args()
+    server = MockAPS((args.host, args.port), fail_rate=args.fail_rate, latency=args.latency, breadth=args.breadth,
+                     depth=args.depth, elements=args.elements)
+    print(f'serving the mock APS endpoints on {server.base_url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
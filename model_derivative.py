@@ -0,0 +1,218 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import codecs
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import decouple
+
+import aps
+from scheduler import scheduler
+from shared_reflex_viewer.cache import SharedCache
+
+
+ENDPOINT = 'https://developer.api.autodesk.com/modelderivative/v2/designdata'
+
+PROPERTIES_DIR = pathlib.Path(decouple.config(
+    'PROPERTIES_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.properties')
+))
+
+manifest_cache = SharedCache('manifests', ttl=decouple.config('MANIFEST_CACHE_TTL', default=60, cast=int))
+
+
+def get_manifest(urn: str) -> Tuple[Dict[str, Any], bool]:
+    """
+    Returns the manifest of a derivative, the cached one flagged as stale while APS is not answering
+    @param urn: The base64 encoded URN
+    @return: The manifest and True if it is stale and being revalidated
+    """
+    def fetch():
+        resp = scheduler.get(f'{ENDPOINT}/{urn}/manifest', headers={'Authorization': aps.token.Value})
+        resp.raise_for_status()
+        return resp.json()
+
+    user = aps.get_user_id()
+    # the users without an id cannot be told apart, they never share the cached manifests
+    if user is None:
+        return fetch(), False
+    return manifest_cache.get(urn, fetch, user=user)
+
+
+def get_derivative_version(urn: str) -> str:
+    """
+    Returns a digest of the derivatives in the manifest, it changes when the model is translated again
+    @param urn: The base64 encoded URN
+    @return: The digest
+    """
+    return derivative_version(get_manifest(urn)[0])
+
+
+def derivative_version(manifest: Dict[str, Any]) -> str:
+    """
+    Returns the digest of the derivatives of a manifest, see get_derivative_version
+    @param manifest: The manifest
+    @return: The digest
+    """
+    derivatives = manifest.get('derivatives', [])
+    return hashlib.sha1(json.dumps(derivatives, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def get_metadata(urn: str) -> List[Dict[str, Any]]:
+    """
+    Returns the viewables of a derivative
+    @param urn: The base64 encoded URN
+    @return: The list of {"name", "role", "guid"}
+    """
+    def fetch():
+        resp = scheduler.get(f'{ENDPOINT}/{urn}/metadata', headers={'Authorization': aps.token.Value})
+        resp.raise_for_status()
+        return resp.json().get('data', {}).get('metadata', [])
+
+    user = aps.get_user_id()
+    if user is None:
+        return fetch()
+    return manifest_cache.get((urn, 'metadata'), fetch, user=user)[0]
+
+
+def get_viewable_guid(urn: str) -> Optional[str]:
+    """
+    Returns the GUID of the first 3D viewable, or of the first viewable if there is no 3D one
+    @param urn: The base64 encoded URN
+    @return: The GUID or None if the derivative has no viewables
+    """
+    views = get_metadata(urn)
+    for v in views:
+        if v.get('role') == '3d':
+            return v['guid']
+    return views[0]['guid'] if len(views) > 0 else None
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str) -> Iterator[Any]:
+    """
+    Yields the items of the first array found under a key of a JSON document, parsing the document as it arrives
+    so that only one item at a time is held in memory
+    @param chunks: The bytes of the document
+    @param key: The name of the array
+    @return: The items
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    start = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+    found = False
+    buffer = ''
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        if not found:
+            match = start.search(buffer)
+            if match is None:
+                # keep enough of the tail to match a key split across two chunks
+                buffer = buffer[-(len(key) + 64):]
+                continue
+            buffer = buffer[match.end():]
+            found = True
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the item continues in the next chunk
+                break
+            yield item
+        buffer = buffer[pos:]
+
+
+def iter_properties(urn: str, guid: str, retries: int = 10) -> Iterator[Dict[str, Any]]:
+    """
+    Streams the objects of a viewable with their properties, waiting while APS extracts them
+    @param urn: The base64 encoded URN
+    @param guid: The viewable GUID
+    @param retries: The number of times to wait for the extraction
+    @return: The {"objectid", "name", "externalId", "properties"} objects
+    """
+    url = f'{ENDPOINT}/{urn}/metadata/{guid}/properties'
+    for attempt in range(retries):
+        resp = scheduler.get(url, headers={'Authorization': aps.token.Value}, params={'forceget': 'true'}, stream=True)
+        if resp.status_code == 202:
+            resp.close()
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        resp.raise_for_status()
+        with resp:
+            yield from iter_json_array(resp.iter_content(chunk_size=1 << 16), 'collection')
+        return
+    raise TimeoutError(f'The properties of {urn} are still being extracted')
+
+
+def properties_path(urn: str, guid: str, version: str) -> pathlib.Path:
+    key = hashlib.sha1(f'{urn}:{guid}:{version}'.encode('utf-8')).hexdigest()
+    return PROPERTIES_DIR / f'{key}.jsonl.gz'
+
+
+def cache_properties(urn: str, guid: str = None) -> pathlib.Path:
+    """
+    Downloads the properties of a viewable into the compressed disk cache, one JSON object per line
+    @param urn: The base64 encoded URN
+    @param guid: The viewable GUID, the first 3D viewable if None
+    @return: The cached file
+    """
+    if guid is None:
+        guid = get_viewable_guid(urn)
+        if guid is None:
+            raise ValueError(f'{urn} has no viewables')
+    path = properties_path(urn, guid, get_derivative_version(urn))
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_suffix(f'.{os.getpid()}.tmp')
+    count = 0
+    try:
+        with gzip.open(temp, 'wt', encoding='utf-8') as f:
+            for obj in iter_properties(urn, guid):
+                f.write(json.dumps(obj, separators=(',', ':')) + '\n')
+                count += 1
+        os.replace(temp, path)
+    finally:
+        temp.unlink(missing_ok=True)
+    logging.info(f'cached {count} objects of {urn} in {path}')
+    return path
+
+
+def read_properties(path: pathlib.Path) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the objects of a file written by cache_properties
+    @param path: The cached file
+    @return: The objects
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
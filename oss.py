@@ -0,0 +1,364 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Uploads files to OSS buckets with the signed S3 upload endpoints.
+
+Run it from the project folder with `python -m oss <bucket> <file>`, an interrupted upload continues when the same
+command is run again.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import decouple
+import requests
+from requests.adapters import HTTPAdapter
+
+import aps
+from scheduler import scheduler
+
+
+OSS_ENDPOINT = decouple.config('OSS_ENDPOINT', default='https://developer.api.autodesk.com/oss/v2')
+# S3 requires at least 5MB for every part but the last one
+OSS_UPLOAD_PART_SIZE = max(decouple.config('OSS_UPLOAD_PART_SIZE', default=16 * 1024 * 1024, cast=int), 5 * 1024 * 1024)
+OSS_UPLOAD_WORKERS = decouple.config('OSS_UPLOAD_WORKERS', default=4, cast=int)
+OSS_UPLOAD_RETRIES = decouple.config('OSS_UPLOAD_RETRIES', default=5, cast=int)
+UPLOADS_DIR = pathlib.Path(decouple.config(
+    'UPLOADS_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.uploads')
+))
+
+# the signed upload endpoint returns at most 25 URLs per request
+MAX_URLS = 25
+# an upload key can be used for 24 hours
+UPLOAD_KEY_SECONDS = 23 * 3600
+
+
+def object_urn(object_id: str) -> str:
+    """
+    Returns the URN used by the Model Derivative service for an OSS object
+    @param object_id: The object id like "urn:adsk.objects:os.object:bucket/key"
+    @return: The URL safe base64 encoded URN without padding
+    """
+    return base64.urlsafe_b64encode(object_id.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def create_bucket(bucket_key: str, policy: str = 'persistent') -> Dict[str, Any]:
+    """
+    Creates a bucket if it does not exist
+    @param bucket_key: The bucket key, lower case letters, numbers, "-" and "_"
+    @param policy: "transient", "temporary" or "persistent"
+    @return: The bucket details
+    """
+    resp = scheduler.post(f'{OSS_ENDPOINT}/buckets', headers={'Authorization': aps.token.Value},
+                         json={'bucketKey': bucket_key, 'policyKey': policy})
+    if resp.status_code == 409:
+        resp = scheduler.get(f'{OSS_ENDPOINT}/buckets/{bucket_key}/details', headers={'Authorization': aps.token.Value})
+    resp.raise_for_status()
+    return resp.json()
+
+
+@dataclass
+class UploadProgress:
+    """The progress of an upload, the throughput only counts the bytes sent by this run."""
+    size: int = 0
+    parts: int = 0
+    completed: int = 0
+    uploaded: int = 0
+    sent: int = 0
+    retries: int = 0
+    started: float = field(default_factory=time.time)
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second"""
+        return self.sent / max(self.elapsed, 1e-6)
+
+    def __str__(self) -> str:
+        return (f'{self.completed}/{self.parts} parts, {self.uploaded / 2 ** 20:.1f}/{self.size / 2 ** 20:.1f} MB, '
+                f'{self.throughput / 2 ** 20:.1f} MB/s, {self.retries} retries')
+
+
+@dataclass
+class ResumeManifest:
+    """The state of an upload saved after every part, so that an interrupted upload continues where it stopped."""
+    bucket: str
+    object_key: str
+    file: str
+    size: int
+    mtime: float
+    part_size: int
+    upload_key: str = ''
+    created: float = field(default_factory=time.time)
+    completed: List[int] = field(default_factory=list)
+
+    @property
+    def path(self) -> pathlib.Path:
+        key = hashlib.sha1(f'{self.bucket}/{self.object_key}:{self.file}'.encode('utf-8')).hexdigest()
+        return UPLOADS_DIR / f'{key}.json'
+
+    @property
+    def parts(self) -> int:
+        return max(1, -(-self.size // self.part_size))
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        temp.write_text(json.dumps(asdict(self)))
+        os.replace(temp, self.path)
+
+    def matches(self, other: 'ResumeManifest') -> bool:
+        """Returns True if the saved upload is for the same content and the upload key is still valid"""
+        return (self.size == other.size and self.mtime == other.mtime and self.part_size == other.part_size
+                and time.time() - self.created < UPLOAD_KEY_SECONDS)
+
+    @classmethod
+    def open(cls, bucket: str, object_key: str, file: pathlib.Path, part_size: int) -> 'ResumeManifest':
+        """
+        Returns the saved state of the upload of a file, or a new one if the file changed or the upload is too old
+        @param bucket: The bucket key
+        @param object_key: The object key
+        @param file: The file
+        @param part_size: The size of the parts
+        @return: The manifest
+        """
+        stat = file.stat()
+        manifest = cls(bucket, object_key, str(file.resolve()), stat.st_size, stat.st_mtime, part_size)
+        if manifest.path.exists():
+            try:
+                saved = cls(**json.loads(manifest.path.read_text()))
+                if saved.matches(manifest):
+                    return saved
+            except Exception as ex:
+                logging.warning(f'ignoring the upload manifest {manifest.path}: {ex}')
+        return manifest
+
+
+class Uploader:
+    """
+    Uploads a file to an OSS bucket in parts.
+
+    The parts are read from a memory map of the file and sent concurrently by a bounded pool over pooled connections,
+    the signed URLs are requested in batches just before their parts are sent. A failed part is retried on its own
+    with a new URL, and the completed parts are saved in a resume manifest.
+    """
+
+    def __init__(self, bucket: str, object_key: str, file: pathlib.Path, part_size: int = OSS_UPLOAD_PART_SIZE,
+                 workers: int = OSS_UPLOAD_WORKERS, retries: int = OSS_UPLOAD_RETRIES,
+                 on_progress: Optional[Callable[[UploadProgress], None]] = None):
+        self.bucket = bucket
+        self.object_key = object_key
+        self.file = pathlib.Path(file)
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        self.on_progress = on_progress
+        self.progress = UploadProgress()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @property
+    def _url(self) -> str:
+        return f'{OSS_ENDPOINT}/buckets/{self.bucket}/objects/{self.object_key}/signeds3upload'
+
+    def stop(self) -> None:
+        """Stops the upload after the parts being sent, it can be resumed later"""
+        self._stop.set()
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Uploads the file
+        @return: The details of the object, including its "objectId"
+        """
+        manifest = ResumeManifest.open(self.bucket, self.object_key, self.file, self.part_size)
+        completed = set(manifest.completed)
+        missing = [p for p in range(1, manifest.parts + 1) if p not in completed]
+        self.progress = UploadProgress(size=manifest.size, parts=manifest.parts, completed=len(completed),
+                                       uploaded=sum(self._part_range(manifest, p)[1] for p in completed))
+        if len(completed) > 0:
+            logging.info(f'resuming the upload of {self.file}: {self.progress}')
+        errors = []
+        with open(self.file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if manifest.size > 0 else b''
+            executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload')
+            # at most two parts per worker are queued, so that the signed URLs do not expire before they are used
+            slots = threading.BoundedSemaphore(self.workers * 2)
+            try:
+                for i in range(0, len(missing), MAX_URLS):
+                    if self._stop.is_set() or len(errors) > 0:
+                        break
+                    batch = missing[i:i + MAX_URLS]
+                    urls = self._signed_urls(manifest, batch)
+                    for part in batch:
+                        slots.acquire()
+                        if self._stop.is_set() or len(errors) > 0:
+                            slots.release()
+                            break
+                        future = executor.submit(self._upload_part, manifest, mm, part, urls[part])
+                        future.add_done_callback(lambda ft, p=part: self._done(ft, manifest, p, slots, errors))
+            finally:
+                # the memory map is closed only after the parts being sent
+                executor.shutdown(wait=True)
+                if isinstance(mm, mmap.mmap):
+                    mm.close()
+        if len(errors) > 0:
+            raise errors[0]
+        if self._stop.is_set():
+            raise InterruptedError(f'The upload of {self.file} was stopped: {self.progress}')
+        result = self._complete(manifest)
+        manifest.path.unlink(missing_ok=True)
+        logging.info(f'uploaded {self.file} to {result.get("objectId")}: {self.progress}')
+        return result
+
+    def _part_range(self, manifest: ResumeManifest, part: int) -> tuple:
+        start = (part - 1) * manifest.part_size
+        return start, min(manifest.part_size, manifest.size - start)
+
+    def _signed_urls(self, manifest: ResumeManifest, parts: Sequence[int]) -> Dict[int, str]:
+        """Requests the signed URLs of some parts, one request per run of consecutive parts"""
+        urls = {}
+        runs = []
+        for p in parts:
+            if len(runs) > 0 and runs[-1][-1] == p - 1:
+                runs[-1].append(p)
+            else:
+                runs.append([p])
+        for run in runs:
+            params = {'parts': len(run), 'firstPart': run[0], 'minutesExpiration': 60}
+            if manifest.upload_key != '':
+                params['uploadKey'] = manifest.upload_key
+            resp = scheduler.get(self._url, headers={'Authorization': aps.token.Value}, params=params)
+            resp.raise_for_status()
+            j = resp.json()
+            with self._lock:
+                if manifest.upload_key == '':
+                    manifest.upload_key = j['uploadKey']
+                    manifest.save()
+            urls.update(zip(run, j['urls']))
+        return urls
+
+    def _upload_part(self, manifest: ResumeManifest, mm, part: int, url: str) -> None:
+        start, length = self._part_range(manifest, part)
+        for attempt in range(self.retries):
+            if self._stop.is_set():
+                return
+            try:
+                # the slice of the memory map is the only copy of the part in memory
+                resp = self._session.put(url, data=mm[start:start + length], timeout=300)
+                if resp.status_code in (400, 403):
+                    # the signed URL expired
+                    raise requests.HTTPError(f'{resp.status_code} {resp.text[:200]}', response=resp)
+                resp.raise_for_status()
+                return
+            except requests.RequestException as ex:
+                if attempt == self.retries - 1:
+                    raise
+                with self._lock:
+                    self.progress.retries += 1
+                logging.warning(f'part {part} of {self.file} failed, retrying: {ex}')
+                time.sleep(min(2 ** attempt, 30))
+                url = self._signed_urls(manifest, [part])[part]
+
+    def _done(self, future: Future, manifest: ResumeManifest, part: int, slots: threading.BoundedSemaphore,
+              errors: list) -> None:
+        slots.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+            return
+        if self._stop.is_set():
+            return
+        length = self._part_range(manifest, part)[1]
+        with self._lock:
+            manifest.completed.append(part)
+            manifest.save()
+            self.progress.completed += 1
+            self.progress.uploaded += length
+            self.progress.sent += length
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+    def _complete(self, manifest: ResumeManifest) -> Dict[str, Any]:
+        resp = scheduler.post(self._url, headers={'Authorization': aps.token.Value},
+                                  json={'uploadKey': manifest.upload_key})
+        resp.raise_for_status()
+        return resp.json()
+
+
+def upload(bucket: str, file: pathlib.Path, object_key: str = None, **kwargs) -> Dict[str, Any]:
+    """
+    Uploads a file to a bucket, resuming a previous upload of the same file if there is one
+    @param bucket: The bucket key
+    @param file: The file
+    @param object_key: The object key, the name of the file if None
+    @param kwargs: The options of the Uploader
+    @return: The details of the object, including its "objectId"
+    """
+    file = pathlib.Path(file)
+    return Uploader(bucket, object_key or file.name, file, **kwargs).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('bucket')
+    parser.add_argument('file', type=pathlib.Path)
+    parser.add_argument('--object-key')
+    parser.add_argument('--part-size', type=int, default=OSS_UPLOAD_PART_SIZE)
+    parser.add_argument('--workers', type=int, default=OSS_UPLOAD_WORKERS)
+    parser.add_argument('--create-bucket', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.create_bucket:
+        create_bucket(args.bucket)
+    last = [0.0]
+
+    def report(progress: UploadProgress):
+        if time.time() - last[0] > 1 or progress.completed == progress.parts:
+            last[0] = time.time()
+            print(progress)
+
+    result = upload(args.bucket, args.file, args.object_key, part_size=args.part_size, workers=args.workers,
+                    on_progress=report)
+    print(json.dumps(result, indent=4))
+    print(f'URN: {object_urn(result["objectId"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import decouple
+import requests
+from requests.adapters import HTTPAdapter
+
+from breaker import BREAKER_TIMEOUT_SECONDS, get_breaker, is_outage
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+SCHEDULER_MAX_CONCURRENCY = decouple.config('SCHEDULER_MAX_CONCURRENCY', default=16, cast=int)
+SCHEDULER_RETRIES = decouple.config('SCHEDULER_RETRIES', default=4, cast=int)
+# the fraction of the APS quotas the backend uses, lower it when several backends share the same client id
+SCHEDULER_QUOTA_SHARE = decouple.config('SCHEDULER_QUOTA_SHARE', default=1.0, cast=float)
+# sends the APS requests to another server, e.g. http://localhost:8765 for mock_aps
+APS_BASE_URL = decouple.config('APS_BASE_URL', default='').rstrip('/')
+APS_HOSTS = ('https://developer.api.autodesk.com', 'https://api.userprofile.autodesk.com')
+
+# (fragment of the URL, endpoint name, requests per minute), the first matching fragment wins
+# https://aps.autodesk.com/en/docs/oauth/v2/developers_guide/rate-limiting/
+ENDPOINTS: List[Tuple[str, str, int]] = [
+    ('/authentication/', 'authentication', 500),
+    ('userprofile.autodesk.com', 'userinfo', 300),
+    ('/modelderivative/v2/designdata/job', 'translation', 50),
+    ('/properties', 'properties', 60),
+    ('/modelderivative/', 'modelderivative', 300),
+    ('/data/v1/', 'data', 300),
+    ('/project/v1/', 'project', 300),
+    ('/oss/', 'oss', 500),
+    ('/webhooks/', 'webhooks', 300),
+]
+DEFAULT_ENDPOINT = ('', 'other', 300)
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar('priority', default=INTERACTIVE)
+# the (endpoint, seconds) of the APS calls made by the current task are appended to this list when set, see profiling
+aps_calls: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar('aps_calls', default=None)
+
+
+@contextlib.contextmanager
+def _timed(name: str) -> Iterator[None]:
+    calls = aps_calls.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if calls is not None:
+            calls.append((name, time.perf_counter() - started))
+
+
+@contextlib.contextmanager
+def background() -> Iterator[None]:
+    """Runs the APS calls made by the current thread or task at background priority"""
+    reset = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(reset)
+
+
+def endpoint_of(url: str) -> str:
+    for fragment, name, _ in ENDPOINTS:
+        if fragment in url:
+            return name
+    return DEFAULT_ENDPOINT[1]
+
+
+def rewrite(url: str) -> str:
+    """Returns the URL on APS_BASE_URL of an APS URL when it is set"""
+    if APS_BASE_URL != '':
+        for host in APS_HOSTS:
+            if url.startswith(host):
+                return APS_BASE_URL + url[len(host):]
+    return url
+
+
+def retry_after(resp: Any) -> Optional[float]:
+    """
+    Returns the seconds to wait from the Retry-After header of a response, either a number or an HTTP date
+    @param resp: The requests or httpx response
+    @return: The seconds or None if there is no header
+    """
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date is not None else None
+
+
+@dataclass
+class Endpoint:
+    """
+    The admission state of an endpoint: a token bucket refilled at the quota rate, an AIMD concurrency limit and the
+    queue of the requests waiting for it, ordered by priority and then by arrival.
+    """
+    name: str
+    rate: float
+    capacity: float
+    max_concurrency: int
+    tokens: float = 0
+    updated: float = field(default_factory=time.monotonic)
+    limit: float = 1
+    active: int = 0
+    blocked_until: float = 0
+    last_decrease: float = 0
+    queue: List[Tuple[int, int]] = field(default_factory=list)
+    throttled: int = 0
+    completed: int = 0
+
+    def __post_init__(self):
+        self.tokens = self.capacity
+        self.limit = float(self.max_concurrency)
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'limit': round(self.limit, 2), 'active': self.active, 'queued': len(self.queue),
+            'tokens': round(self.tokens, 2), 'throttled': self.throttled, 'completed': self.completed,
+        }
+
+
+class RequestScheduler:
+    """
+    Admits the outbound APS calls of the backend.
+
+    Every endpoint has a token bucket sized to its quota and a concurrency limit that grows by one request per round
+    trip and halves when APS answers 429, at most once per second so that a burst of 429s counts as one signal.
+    A 429 also blocks the endpoint until its Retry-After expires. Interactive requests are admitted before the
+    background ones waiting for the same endpoint.
+    """
+
+    def __init__(self, max_concurrency: int = SCHEDULER_MAX_CONCURRENCY, retries: int = SCHEDULER_RETRIES,
+                 quota_share: float = SCHEDULER_QUOTA_SHARE):
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.quota_share = quota_share
+        self._cond = threading.Condition()
+        self._endpoints: Dict[str, Endpoint] = {}
+        self._tickets = itertools.count()
+        # the (loop, event) of the coroutines waiting in aacquire, woken up with the threads waiting on the condition
+        self._waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(ENDPOINTS) + 1, pool_maxsize=max_concurrency)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def _endpoint(self, name: str) -> Endpoint:
+        endpoint = self._endpoints.get(name)
+        if endpoint is None:
+            per_minute = next((r for _, n, r in ENDPOINTS if n == name), DEFAULT_ENDPOINT[2]) * self.quota_share
+            # a burst of up to a tenth of the quota is allowed
+            endpoint = Endpoint(name=name, rate=per_minute / 60, capacity=max(1.0, per_minute / 10),
+                                max_concurrency=self.max_concurrency)
+            self._endpoints[name] = endpoint
+        return endpoint
+
+    def _notify(self) -> None:
+        """Wakes up the threads and the coroutines waiting for an endpoint, called with the lock held"""
+        self._cond.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _enqueue(self, name: str, priority: int) -> Tuple[Endpoint, Tuple[int, int]]:
+        endpoint = self._endpoint(name)
+        ticket = (priority, next(self._tickets))
+        heapq.heappush(endpoint.queue, ticket)
+        return endpoint, ticket
+
+    def _admit(self, endpoint: Endpoint, ticket: Tuple[int, int]) -> Tuple[bool, Optional[float]]:
+        """
+        Admits a queued request when its turn came, called with the lock held
+        @param endpoint: The endpoint
+        @param ticket: The ticket of the request in the queue of the endpoint
+        @return: True if admitted, otherwise False and the seconds to wait, None to wait for a notification
+        """
+        now = time.monotonic()
+        endpoint.refill(now)
+        if endpoint.queue[0] != ticket or endpoint.active >= int(endpoint.limit):
+            return False, None
+        if now < endpoint.blocked_until:
+            return False, endpoint.blocked_until - now
+        if endpoint.tokens < 1:
+            return False, (1 - endpoint.tokens) / endpoint.rate
+        heapq.heappop(endpoint.queue)
+        endpoint.tokens -= 1
+        endpoint.active += 1
+        # the next request in the queue may be admitted too
+        self._notify()
+        return True, None
+
+    def _withdraw(self, endpoint: Endpoint, ticket: Tuple[int, int]) -> None:
+        if ticket in endpoint.queue:
+            endpoint.queue.remove(ticket)
+            heapq.heapify(endpoint.queue)
+            self._notify()
+
+    def acquire(self, name: str, priority: int = None, timeout: float = None) -> None:
+        """
+        Waits until a request to an endpoint can be sent
+        @param name: The endpoint name
+        @param priority: INTERACTIVE or BACKGROUND, the priority of the current context if None
+        @param timeout: The maximum wait in seconds
+        """
+        priority = _priority.get() if priority is None else priority
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            endpoint, ticket = self._enqueue(name, priority)
+            try:
+                while True:
+                    admitted, wait = self._admit(endpoint, ticket)
+                    if admitted:
+                        return
+                    if deadline is not None:
+                        now = time.monotonic()
+                        if now >= deadline:
+                            raise TimeoutError(f'The {name} endpoint is saturated')
+                        wait = min(wait, deadline - now) if wait is not None else deadline - now
+                    self._cond.wait(wait)
+            except BaseException:
+                self._withdraw(endpoint, ticket)
+                raise
+
+    async def aacquire(self, name: str, priority: int = None) -> None:
+        """
+        Waits on the event loop until a request to an endpoint can be sent, without holding a thread while the
+        endpoint is saturated or throttled
+        @param name: The endpoint name
+        @param priority: INTERACTIVE or BACKGROUND, the priority of the current task if None
+        """
+        priority = _priority.get() if priority is None else priority
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            endpoint, ticket = self._enqueue(name, priority)
+            self._waiters.add(waiter)
+        try:
+            while True:
+                with self._cond:
+                    # cleared with the lock held, a notification made after the check is not lost
+                    waiter[1].clear()
+                    admitted, wait = self._admit(endpoint, ticket)
+                if admitted:
+                    return
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._withdraw(endpoint, ticket)
+            raise
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+
+    def release(self, name: str, throttled: bool = False, delay: float = None) -> None:
+        """
+        Reports the outcome of a request admitted by acquire
+        @param name: The endpoint name
+        @param throttled: True if APS answered 429
+        @param delay: The Retry-After of the response in seconds
+        """
+        with self._cond:
+            endpoint = self._endpoint(name)
+            endpoint.active -= 1
+            now = time.monotonic()
+            if throttled:
+                endpoint.throttled += 1
+                if now - endpoint.last_decrease > 1:
+                    endpoint.limit = max(1.0, endpoint.limit / 2)
+                    endpoint.last_decrease = now
+                    # the bucket is emptied, so the requests already admitted do not keep the endpoint throttled
+                    endpoint.tokens = 0
+                    logging.warning(f'{name} throttled, {int(endpoint.limit)} concurrent requests allowed')
+                endpoint.blocked_until = max(endpoint.blocked_until, now + (delay if delay is not None else 1))
+            else:
+                endpoint.completed += 1
+                endpoint.limit = min(float(self.max_concurrency), endpoint.limit + 1 / endpoint.limit)
+            self._notify()
+
+    @contextlib.contextmanager
+    def slot(self, name: str, priority: int = None) -> Iterator[None]:
+        """
+        Admits a call made by a library that does not go through the scheduler, a 429 raised by the call is reported
+        @param name: The endpoint name
+        @param priority: INTERACTIVE or BACKGROUND, the priority of the current context if None
+        """
+        breaker = get_breaker(name)
+        breaker.allow()
+        try:
+            self.acquire(name, priority)
+        except BaseException:
+            breaker.abandon()
+            raise
+        try:
+            with _timed(name):
+                yield
+        except Exception as ex:
+            resp = getattr(ex, 'response', None)
+            status = getattr(resp, 'status_code', None)
+            self.release(name, throttled=status == 429, delay=retry_after(resp) if status == 429 else None)
+            breaker.record(not is_outage(ex))
+            raise
+        except BaseException:
+            self.release(name)
+            breaker.abandon()
+            raise
+        self.release(name)
+        breaker.record(True)
+
+    def request(self, method: str, url: str, priority: int = None, **kwargs) -> requests.Response:
+        with _timed(endpoint_of(url)):
+            return self._request(method, url, priority, **kwargs)
+
+    def _request(self, method: str, url: str, priority: int = None, **kwargs) -> requests.Response:
+        """
+        Sends a request once the endpoint admits it, retrying the requests throttled with 429. The requests to an
+        endpoint whose circuit is open fail immediately with CircuitOpenError.
+        @param method: The HTTP method
+        @param url: The URL
+        @param priority: INTERACTIVE or BACKGROUND, the priority of the current context if None
+        @param kwargs: The arguments of requests.request
+        @return: The response, the last 429 if the retries are exhausted
+        """
+        name = endpoint_of(url)
+        breaker = get_breaker(name)
+        url = rewrite(url)
+        kwargs.setdefault('timeout', BREAKER_TIMEOUT_SECONDS)
+        for attempt in range(self.retries + 1):
+            breaker.allow()
+            try:
+                self.acquire(name, priority)
+            except BaseException:
+                breaker.abandon()
+                raise
+            try:
+                resp = self._session.request(method, url, **kwargs)
+            except Exception:
+                self.release(name)
+                breaker.record(False)
+                raise
+            except BaseException:
+                self.release(name)
+                breaker.abandon()
+                raise
+            throttled = resp.status_code == 429
+            self.release(name, throttled=throttled, delay=retry_after(resp) if throttled else None)
+            breaker.record(resp.status_code < 500)
+            if not throttled or attempt == self.retries:
+                return resp
+            resp.close()
+        return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    async def arequest(self, client: Any, method: str, url: str, priority: int = None, **kwargs) -> Any:
+        with _timed(endpoint_of(url)):
+            return await self._arequest(client, method, url, priority, **kwargs)
+
+    async def _arequest(self, client: Any, method: str, url: str, priority: int = None, **kwargs) -> Any:
+        """
+        Sends a request with an httpx.AsyncClient once the endpoint admits it, retrying the requests throttled with 429
+        @param client: The httpx.AsyncClient
+        @param method: The HTTP method
+        @param url: The URL
+        @param priority: INTERACTIVE or BACKGROUND, the priority of the current task if None
+        @param kwargs: The arguments of client.request
+        @return: The httpx response
+        """
+        name = endpoint_of(url)
+        breaker = get_breaker(name)
+        priority = _priority.get() if priority is None else priority
+        url = rewrite(url)
+        kwargs.setdefault('timeout', BREAKER_TIMEOUT_SECONDS)
+        for attempt in range(self.retries + 1):
+            breaker.allow()
+            try:
+                await self.aacquire(name, priority)
+            except BaseException:
+                breaker.abandon()
+                raise
+            try:
+                resp = await client.request(method, url, **kwargs)
+            except Exception:
+                self.release(name)
+                breaker.record(False)
+                raise
+            except BaseException:
+                self.release(name)
+                breaker.abandon()
+                raise
+            throttled = resp.status_code == 429
+            self.release(name, throttled=throttled, delay=retry_after(resp) if throttled else None)
+            breaker.record(resp.status_code < 500)
+            if not throttled or attempt == self.retries:
+                return resp
+        return resp
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._cond:
+            return {name: e.stats() for name, e in self._endpoints.items()}
+
+
+scheduler = RequestScheduler()
@@ -0,0 +1,359 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from breaker import is_outage
+from scheduler import background
+
+
+@dataclass
+class CacheEntry:
+    """A cached value with the bookkeeping needed for TTL, LRU and permission checks."""
+    value: Any
+    size: int
+    stored: float
+    digest: str
+    users: Set[str] = field(default_factory=set)
+
+
+def _encode(value: Any) -> Tuple[str, int, str]:
+    text = json.dumps(value, separators=(',', ':'), sort_keys=True)
+    return text, len(text), hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _key_text(key: Hashable) -> str:
+    if isinstance(key, tuple):
+        return '\x1f'.join(str(k) for k in key)
+    return str(key)
+
+
+class SharedCache:
+    """
+    A process-wide cache with a TTL and a byte-size-bounded LRU.
+
+    Expired entries are served flagged as stale for up to `stale_ttl` seconds while a background worker revalidates
+    them, and for as long as APS is unavailable; a revalidation that returns identical content only refreshes the
+    timestamp. Entries remember which users loaded them, and a user that never did always goes through the loader so
+    that APS enforces its permissions.
+    When `path` is given the entries are also stored in a SQLite file shared by every backend process on the host.
+    """
+
+    def __init__(self, name: str, ttl: float = 300, max_bytes: int = 64 * 1024 * 1024, stale_ttl: float = 3600,
+                 path: Optional[pathlib.Path] = None, workers: int = 2):
+        """
+        @param name: The name of the cache, used in the logs and as the SQLite table name
+        @param ttl: The seconds an entry is considered fresh
+        @param max_bytes: The maximum size of the JSON encoded values kept in memory
+        @param stale_ttl: The seconds past the TTL an entry can be served while it is revalidated
+        @param path: The optional SQLite file used to share the entries across processes
+        @param workers: The number of background revalidation workers
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # the revalidations in flight by key
+        self._pending: Dict[Hashable, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-revalidate')
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(f'CREATE TABLE IF NOT EXISTS "{name}" '
+                             '(key TEXT PRIMARY KEY, value TEXT, stored REAL, digest TEXT, users TEXT)')
+
+    def get(self, key: Hashable, loader: Callable[[], Any], user: str = None) -> Tuple[Any, bool]:
+        """
+        Returns the value for the key, calling the loader on a miss
+        @param key: The cache key
+        @param loader: The function that fetches a fresh value
+        @param user: The user requesting the value, None skips the permission check
+        @return: The value and True if it is stale and being revalidated in the background
+        """
+        found = self.lookup(key, user, loader)
+        if found is not None:
+            return found
+        try:
+            value = loader()
+        except Exception as ex:
+            # while APS is unavailable the last good value is better than an error, however old it is
+            entry = self.peek(key)
+            if entry is not None and (user is None or user in entry.users) and is_outage(ex):
+                logging.warning(f'{self.name}: serving the stale entry of {key}: {ex}')
+                self.stale_hits += 1
+                return entry.value, True
+            raise
+        self.put(key, value, user)
+        return value, False
+
+    def lookup(self, key: Hashable, user: str = None,
+               loader: Callable[[], Any] = None) -> Optional[Tuple[Any, bool]]:
+        """
+        Returns the value for the key without loading it on a miss
+        @param key: The cache key
+        @param user: The user requesting the value, None skips the permission check
+        @param loader: The function that fetches a fresh value, a stale entry is revalidated with it when given
+        @return: The value and True if it is stale, None if the user never loaded it or it is older than the stale TTL
+        """
+        entry = self.peek(key)
+        if entry is not None and (user is None or user in entry.users):
+            age = time.time() - entry.stored
+            if age <= self.ttl:
+                self.hits += 1
+                return entry.value, False
+            if age <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                if loader is not None:
+                    self.revalidate(key, loader, user)
+                return entry.value, True
+        self.misses += 1
+        return None
+
+    def peek(self, key: Hashable) -> Optional[CacheEntry]:
+        """
+        Returns the entry for the key regardless of its age, or None
+        @param key: The cache key
+        @return: The entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._read(key)
+        if entry is not None:
+            with self._lock:
+                self._store(key, entry)
+        return entry
+
+    def put(self, key: Hashable, value: Any, user: str = None) -> CacheEntry:
+        """
+        Stores a fresh value, if the content did not change only the timestamp and the users are updated. Changed
+        content only belongs to the user that loaded it, the other users load it again to have APS check their access.
+        @param key: The cache key
+        @param value: The JSON serializable value
+        @param user: The user the value was loaded for
+        @return: The entry
+        """
+        text, size, digest = _encode(value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.digest == digest:
+                entry.stored = time.time()
+            else:
+                entry = CacheEntry(value=value, size=size, stored=time.time(), digest=digest)
+            if user is not None:
+                entry.users.add(user)
+            self._store(key, entry)
+        self._write(key, entry, text)
+        return entry
+
+    def revalidate(self, key: Hashable, loader: Callable[[], Any], user: str = None) -> Future:
+        """
+        Schedules a background refresh of the key, at most one per key is in flight
+        @param key: The cache key
+        @param loader: The function that fetches a fresh value
+        @param user: The user the value is loaded for
+        @return: The future of the refresh in flight, it never raises
+        """
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+
+            def task():
+                try:
+                    with background():
+                        self.put(key, loader(), user)
+                except Exception as ex:
+                    logging.warning(f'{self.name}: revalidation of {key} failed, keeping the stale entry: {ex}')
+                finally:
+                    with self._lock:
+                        self._pending.pop(key, None)
+
+            future = self._executor.submit(task)
+            self._pending[key] = future
+            return future
+
+    def pending(self, key: Hashable) -> Optional[Future]:
+        """Returns the future of the revalidation of the key in flight, or None"""
+        with self._lock:
+            return self._pending.get(key)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Removes the key from memory and from the shared store
+        @param key: The cache key
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (_key_text(key),))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+            }
+
+    def _store(self, key: Hashable, entry: CacheEntry) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def _read(self, key: Hashable) -> Optional[CacheEntry]:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(f'SELECT value, stored, digest, users FROM "{self.name}" WHERE key = ?',
+                                   (_key_text(key),)).fetchone()
+        if row is None:
+            return None
+        value, stored, digest, users = row
+        return CacheEntry(value=json.loads(value), size=len(value), stored=stored, digest=digest,
+                          users=set(json.loads(users)))
+
+    def _write(self, key: Hashable, entry: CacheEntry, text: str) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(f'INSERT OR REPLACE INTO "{self.name}" VALUES (?, ?, ?, ?, ?)',
+                             (_key_text(key), text, entry.stored, entry.digest, json.dumps(sorted(entry.users))))
+
+
+class DiskCache:
+    """
+    Files kept in a folder, evicted least recently used first when they exceed max_bytes. The order survives the
+    restarts through the modification times of the files.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int, suffix: str = ''):
+        """
+        @param directory: The folder of the files
+        @param max_bytes: The maximum size of the files
+        @param suffix: The extension of the files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.size = 0
+        self._lock = threading.Lock()
+        self._files: Optional[OrderedDict[str, int]] = None
+
+    def _load(self) -> OrderedDict:
+        if self._files is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            entries = sorted((e.stat().st_mtime, e.name, e.stat().st_size) for e in os.scandir(self.directory)
+                             if e.name.endswith(self.suffix) and not e.name.endswith('.tmp'))
+            self._files = OrderedDict((name, size) for _, name, size in entries)
+            self.size = sum(self._files.values())
+        return self._files
+
+    def get(self, key: str) -> Optional[pathlib.Path]:
+        """
+        Returns the file of a key and marks it as the most recently used
+        @param key: The key, a valid file name
+        @return: The file or None
+        """
+        name = f'{key}{self.suffix}'
+        with self._lock:
+            files = self._load()
+            if name not in files:
+                return None
+            files.move_to_end(name)
+        path = self.directory / name
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process
+            with self._lock:
+                self.size -= self._files.pop(name, 0)
+            return None
+        return path
+
+    def temp_path(self, key: str) -> pathlib.Path:
+        """Returns a temporary file to write the content of a key to before adopting it"""
+        self._load()
+        return self.directory / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    def put(self, key: str, data: bytes) -> pathlib.Path:
+        """
+        Stores the content of a key
+        @param key: The key
+        @param data: The content
+        @return: The file
+        """
+        temp = self.temp_path(key)
+        temp.write_bytes(data)
+        return self.adopt(key, temp)
+
+    def adopt(self, key: str, temp: pathlib.Path) -> pathlib.Path:
+        """
+        Moves a file written to temp_path into the cache and evicts the least recently used files
+        @param key: The key
+        @param temp: The complete file
+        @return: The file
+        """
+        name = f'{key}{self.suffix}'
+        path = self.directory / name
+        size = temp.stat().st_size
+        os.replace(temp, path)
+        with self._lock:
+            files = self._load()
+            self.size += size - files.pop(name, 0)
+            files[name] = size
+            evicted = []
+            while self.size > self.max_bytes and len(files) > 1:
+                old, old_size = files.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old)
+        for old in evicted:
+            (self.directory / old).unlink(missing_ok=True)
+        return path
@@ -0,0 +1,272 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import decouple
+
+import aps
+from scheduler import background, scheduler
+from shared_reflex_viewer.cache import SharedCache
+
+
+ENDPOINT = 'https://developer.api.autodesk.com/project/v1/hubs'
+DATA_ENDPOINT = 'https://developer.api.autodesk.com/data/v1/projects'
+# the largest page the data management API returns
+PAGE_LIMIT = 200
+
+CATALOG_CACHE_TTL = decouple.config('CATALOG_CACHE_TTL', default=600, cast=int)
+CATALOG_WORKERS = decouple.config('CATALOG_WORKERS', default=8, cast=int)
+CATALOG_WARM = decouple.config('CATALOG_WARM', default=True, cast=bool)
+
+catalog_cache = SharedCache('catalog', ttl=CATALOG_CACHE_TTL)
+
+_executor = ThreadPoolExecutor(max_workers=CATALOG_WORKERS, thread_name_prefix='catalog')
+
+
+def _pages(url: str, params: Dict[str, Any] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Returns the pages of a data management listing, the next page is only known from the links of the previous one
+    @param url: The listing URL
+    @param params: The query parameters of the first page
+    @return: The JSON:API pages
+    """
+    params = {'page[limit]': PAGE_LIMIT, **(params or {})}
+    while url is not None:
+        resp = scheduler.get(url, headers={'Authorization': aps.token.Value}, params=params)
+        resp.raise_for_status()
+        j = resp.json()
+        yield j
+        url = j.get('links', {}).get('next', {}).get('href')
+        params = None
+
+
+def fetch_hubs() -> List[Dict[str, str]]:
+    """
+    Lists the hubs the user can access
+    @return: The {"id", "name"} of the hubs
+    """
+    return [{'id': h['id'], 'name': h.get('attributes', {}).get('name', h['id'])}
+            for page in _pages(ENDPOINT) for h in page.get('data', [])]
+
+
+def fetch_projects(hub_id: str) -> List[Dict[str, str]]:
+    """
+    Lists the projects of a hub the user can access
+    @param hub_id: The hub id
+    @return: The {"id", "name", "hub_id", "root_folder"} of the projects
+    """
+    projects = []
+    for page in _pages(f'{ENDPOINT}/{hub_id}/projects'):
+        for p in page.get('data', []):
+            root = p.get('relationships', {}).get('rootFolder', {}).get('data', {}).get('id', '')
+            projects.append({'id': p['id'], 'name': p.get('attributes', {}).get('name', p['id']), 'hub_id': hub_id,
+                             'root_folder': root})
+    return projects
+
+
+def fetch_top_folders(hub_id: str, project_id: str) -> List[Dict[str, str]]:
+    """
+    Lists the top folders of a project the user can access, e.g. "Project Files"
+    @param hub_id: The hub id
+    @param project_id: The project id with the "b." prefix
+    @return: The {"id", "name"} of the folders
+    """
+    resp = scheduler.get(f'{ENDPOINT}/{hub_id}/projects/{project_id}/topFolders',
+                         headers={'Authorization': aps.token.Value})
+    resp.raise_for_status()
+    return [{'id': f['id'], 'name': f.get('attributes', {}).get('displayName', f.get('attributes', {}).get('name', ''))}
+            for f in resp.json().get('data', [])]
+
+
+def fetch_models(project_id: str, folder_id: str) -> List[Dict[str, str]]:
+    """
+    Lists the items of a folder whose tip version has derivatives
+    @param project_id: The project id with the "b." prefix
+    @param folder_id: The folder id
+    @return: The {"id", "name", "urn"} of the items, the urn is the base64 derivative URN of the tip version
+    """
+    models = []
+    for page in _pages(f'{DATA_ENDPOINT}/{project_id}/folders/{folder_id}/contents', {'filter[type]': 'items'}):
+        names = {i['id']: i.get('attributes', {}).get('displayName', '') for i in page.get('data', [])}
+        for version in page.get('included', []):
+            if version.get('type') != 'versions':
+                continue
+            relationships = version.get('relationships', {})
+            item_id = relationships.get('item', {}).get('data', {}).get('id')
+            urn = relationships.get('derivatives', {}).get('data', {}).get('id', '')
+            if item_id is None or urn == '':
+                continue
+            name = names.get(item_id) or version.get('attributes', {}).get('name', item_id)
+            models.append({'id': item_id, 'name': name, 'urn': urn})
+    return models
+
+
+def _get(key: Tuple[str, ...], loader: Any, user: Optional[str]) -> List[Dict[str, str]]:
+    """
+    Returns a listing from the cache, the users without an id list it from APS every time
+    @param key: The name of the listing followed by its arguments, the cache key is prefixed by the user
+    @param loader: The function that fetches the listing
+    @param user: The id of the user, None if unknown
+    @return: The listing
+    """
+    if user is None:
+        return loader()
+    # the listings depend on the permissions of the user, every user has its own entries
+    return catalog_cache.get((user, *key), loader, user=user)[0]
+
+
+def _list(name: str, loader: Any, args: List[Tuple[str, ...]],
+          user: Optional[str]) -> List[Optional[List[Dict[str, str]]]]:
+    """
+    Calls a listing concurrently on every argument tuple through the cache
+    @param name: The name of the listing, the cache keys are the user, the name and the arguments
+    @param loader: The fetch function
+    @param args: The arguments of every call
+    @param user: The id of the user, None if unknown
+    @return: The listings in the order of the arguments, None for the failed ones
+    """
+
+    def call(a: Tuple[str, ...]) -> Optional[List[Dict[str, str]]]:
+        try:
+            return _get((name, *a), lambda: loader(*a), user)
+        except Exception as ex:
+            logging.warning(f'catalog: {name} of {a} not listed: {ex}')
+            return None
+
+    return list(_executor.map(call, args))
+
+
+def list_catalog(user: Optional[str]) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Lists the hubs, the projects and the models in the top folders of the projects the user can access. The listings
+    of every level are fetched concurrently and cached per user for CATALOG_CACHE_TTL seconds.
+    @param user: The id of the user, the catalog of a user without id is not cached
+    @return: The "hubs", "projects", top "folders" and "models", the folders and the models also have the "project_id"
+    """
+    hubs = _get(('hubs',), fetch_hubs, user)
+    listings = _list('projects', fetch_projects, [(h['id'],) for h in hubs], user)
+    projects = [p for ps in listings if ps is not None for p in ps]
+    listings = _list('top_folders', fetch_top_folders, [(p['hub_id'], p['id']) for p in projects], user)
+    folders = [(p['id'], f) for p, fs in zip(projects, listings) if fs is not None for f in fs]
+    listings = _list('models', fetch_models, [(p, f['id']) for p, f in folders], user)
+    models = [{**m, 'project_id': p} for (p, _), ms in zip(folders, listings) if ms is not None for m in ms]
+    return {'hubs': hubs, 'projects': projects, 'folders': [{**f, 'project_id': p} for p, f in folders],
+            'models': models}
+
+
+def peek_catalog(user: Optional[str]) -> Optional[Dict[str, List[Dict[str, str]]]]:
+    """
+    Returns the catalog of the user only if every listing is cached, without waiting for APS. The listings older than
+    CATALOG_CACHE_TTL are returned and revalidated in the background, those past the stale TTL are not returned.
+    @param user: The id of the user
+    @return: The catalog or None, always None for a user without id
+    """
+    if user is None:
+        return None
+
+    def peek(key: Tuple[str, ...], loader: Any) -> Optional[Any]:
+        found = catalog_cache.lookup((user, *key), user, lambda: loader(*key[1:]))
+        return found[0] if found is not None else None
+
+    hubs = peek(('hubs',), fetch_hubs)
+    if hubs is None:
+        return None
+    projects = []
+    for h in hubs:
+        ps = peek(('projects', h['id']), fetch_projects)
+        if ps is None:
+            return None
+        projects.extend(ps)
+    folders, models = [], []
+    for p in projects:
+        for f in peek(('top_folders', p['hub_id'], p['id']), fetch_top_folders) or []:
+            folders.append({**f, 'project_id': p['id']})
+            models.extend({**m, 'project_id': p['id']} for m in peek(('models', p['id'], f['id']), fetch_models) or [])
+    return {'hubs': hubs, 'projects': projects, 'folders': folders, 'models': models}
+
+
+def model_choices(catalog: Dict[str, List[Dict[str, str]]]) -> List[Tuple[str, str]]:
+    """Returns the (label, urn) of the models of a catalog for the model pickers"""
+    names = {p['id']: p['name'] for p in catalog['projects']}
+    return sorted((f'{names.get(m["project_id"], "")} / {m["name"]}', m['urn']) for m in catalog['models'])
+
+
+def project_choices(catalog: Dict[str, List[Dict[str, str]]]) -> List[Tuple[str, str]]:
+    """Returns the (name, id) of the projects of a catalog without the "b." prefix"""
+    return sorted((p['name'], p['id'].removeprefix('b.')) for p in catalog['projects'])
+
+
+def root_folder(user: Optional[str], project_id: str) -> str:
+    """
+    Returns the root folder of a project from the cached catalog
+    @param user: The id of the user
+    @param project_id: The project id with or without the "b." prefix
+    @return: The folder id, empty if the project is not in the catalog
+    """
+    catalog = peek_catalog(user) or {'projects': []}
+    project_id = project_id.removeprefix('b.')
+    return next((p['root_folder'] for p in catalog['projects'] if p['id'].removeprefix('b.') == project_id), '')
+
+
+def warm() -> None:
+    """
+    Lists the catalog of the user of the stored token in the background, so that the first page has it cached. Every
+    backend process warms its own memory, the token is shared through the temp folder.
+    """
+    if not CATALOG_WARM or aps.token.Access is None:
+        return
+
+    def task():
+        started = time.perf_counter()
+        try:
+            with background():
+                if not aps.is_token_valid():
+                    logging.info('catalog: the stored token expired, the catalog is listed at the first login')
+                    return
+                user = aps.get_user_id()
+                if user is None:
+                    logging.info('catalog: the stored token has no user, there is no catalog to cache')
+                    return
+                catalog = list_catalog(user)
+        except Exception as ex:
+            logging.warning(f'catalog: warm up failed: {ex}')
+            return
+        logging.info(f'catalog: {len(catalog["projects"])} projects and {len(catalog["models"])} models listed in '
+                     f'{time.perf_counter() - started:.1f}s')
+
+    threading.Thread(target=task, name='catalog-warm', daemon=True).start()
+
+
+def install(app: Any) -> None:
+    """
+    Warms the catalog when the backend starts
+    @param app: The reflex app
+    """
+    register = getattr(app, 'register_lifespan_task', None)
+    if register is not None:
+        register(warm)
+    else:
+        # before reflex 0.4.3 the app has no lifespan tasks
+        app.api.add_event_handler('startup', warm)
@@ -0,0 +1,176 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import decouple
+
+from scheduler import background
+from shared_reflex_viewer.folders import fetch_folder_contents, folder_cache
+from shared_reflex_viewer.snapshot import Nodes, Snapshot, checkpoint_path, read_nodes, write_nodes
+
+
+CRAWLER_WORKERS = decouple.config('CRAWLER_WORKERS', default=4, cast=int)
+# the seconds between two checkpoints of a running crawl
+CRAWLER_CHECKPOINT_SECONDS = decouple.config('CRAWLER_CHECKPOINT_SECONDS', default=30, cast=int)
+# the attempts to list a folder before the crawl gives up on it
+CRAWLER_ATTEMPTS = decouple.config('CRAWLER_ATTEMPTS', default=3, cast=int)
+
+
+@dataclass
+class CrawlProgress:
+    """A progress event of a crawl."""
+    project_id: str
+    folders: int = 0
+    items: int = 0
+    pending: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    done: bool = False
+
+
+class ProjectCrawler:
+    """
+    Walks the folder hierarchy of a project on a bounded worker pool and writes a snapshot.
+
+    The crawl is checkpointed every `checkpoint_seconds`, a crawl of the same project started later continues from
+    the last checkpoint. Every listing also lands in the folder cache. A failed listing is queued again up to
+    `attempts` times, the folders that still fail make the snapshot partial and stay in the checkpoint, so that the
+    next crawl lists only them.
+    """
+
+    def __init__(self, project_id: str, root_id: str, user: str, workers: int = CRAWLER_WORKERS,
+                 checkpoint_seconds: float = CRAWLER_CHECKPOINT_SECONDS, attempts: int = CRAWLER_ATTEMPTS,
+                 on_progress: Callable[[CrawlProgress], None] = None):
+        """
+        @param project_id: The ACC project id
+        @param root_id: The id of the root folder of the project
+        @param user: The id of the user the crawl runs for
+        @param workers: The maximum number of concurrent listings
+        @param checkpoint_seconds: The seconds between two checkpoints
+        @param attempts: The attempts to list a folder
+        @param on_progress: The function called after every listed folder
+        """
+        self.project_id = project_id
+        self.root_id = root_id
+        self.user = user
+        self.workers = workers
+        self.checkpoint_seconds = checkpoint_seconds
+        self.attempts = attempts
+        self.on_progress = on_progress
+        self.progress = CrawlProgress(project_id)
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        """Stops the crawl after the running listings, the next crawl resumes from the checkpoint"""
+        self._stop.set()
+
+    def run(self) -> Optional[Snapshot]:
+        """
+        Crawls the project
+        @return: The snapshot or None if the crawl was stopped
+        """
+        nodes, listed, frontier = self._resume()
+        attempts: Dict[str, int] = {}
+        failed = set()
+        start = time.time()
+        last_checkpoint = start
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='crawler') as executor:
+            running = {}
+            while (frontier or running) and not self._stop.is_set():
+                while frontier and len(running) < self.workers:
+                    folder_id = frontier.pop()
+                    running[executor.submit(self._fetch, folder_id)] = folder_id
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    folder_id = running.pop(future)
+                    try:
+                        contents = future.result()
+                    except Exception as ex:
+                        attempts[folder_id] = attempts.get(folder_id, 0) + 1
+                        if attempts[folder_id] < self.attempts:
+                            logging.info(f'crawler: listing {folder_id} failed, retrying later: {ex}')
+                            # the frontier is popped from the end, the folder is retried after the queued ones
+                            frontier.insert(0, folder_id)
+                        else:
+                            logging.warning(f'crawler: listing {folder_id} failed {attempts[folder_id]} times: {ex}')
+                            failed.add(folder_id)
+                            self.progress.errors = len(failed)
+                        continue
+                    folder_cache.put((self.project_id, folder_id), contents, self.user)
+                    for k, v in contents['folders'].items():
+                        nodes[k] = (folder_id, v['name'], True)
+                        frontier.append(k)
+                    for k, v in contents['items'].items():
+                        nodes[k] = (folder_id, v['name'], False)
+                    listed.add(folder_id)
+                    self.progress.folders = len(listed)
+                    self.progress.items += len(contents['items'])
+                self.progress.pending = len(frontier) + len(running)
+                self.progress.elapsed = time.time() - start
+                if self.on_progress is not None:
+                    self.on_progress(self.progress)
+                if time.time() - last_checkpoint >= self.checkpoint_seconds:
+                    self._checkpoint(nodes, listed, frontier + list(running.values()) + sorted(failed))
+                    last_checkpoint = time.time()
+            if self._stop.is_set():
+                self._checkpoint(nodes, listed, frontier + list(running.values()) + sorted(failed))
+                return None
+
+        snapshot = Snapshot.create(self.project_id, self.root_id, self.user, nodes, listed, failed)
+        snapshot.save()
+        if snapshot.complete:
+            checkpoint_path(self.project_id).unlink(missing_ok=True)
+        else:
+            logging.warning(f'crawler: the snapshot of {self.project_id} misses {len(failed)} folders')
+            self._checkpoint(nodes, listed, sorted(failed))
+        self.progress.done = True
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+        return snapshot
+
+    def _fetch(self, folder_id: str):
+        # a crawl only uses the quota the interactive requests leave
+        with background():
+            return fetch_folder_contents(self.project_id, folder_id)
+
+    def _resume(self) -> Tuple[Nodes, set, List[str]]:
+        path = checkpoint_path(self.project_id)
+        if path.exists():
+            try:
+                header, nodes = read_nodes(path)
+                if header['user'] == self.user and header['root_id'] == self.root_id:
+                    logging.info(f'crawler: resuming {self.project_id} with {len(nodes)} nodes')
+                    self.progress.folders = len(header['listed'])
+                    self.progress.items = sum(1 for n in nodes.values() if not n[2])
+                    return nodes, set(header['listed']), header['frontier']
+            except Exception as ex:
+                logging.warning(f'crawler: ignoring the checkpoint of {self.project_id}: {ex}')
+        return {self.root_id: (None, 'Project Files', True)}, set(), [self.root_id]
+
+    def _checkpoint(self, nodes: Nodes, listed: set, frontier: List[str]) -> None:
+        header = {'project_id': self.project_id, 'root_id': self.root_id, 'user': self.user,
+                  'listed': sorted(listed), 'frontier': frontier}
+        write_nodes(checkpoint_path(self.project_id), header, nodes)
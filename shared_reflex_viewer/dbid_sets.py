@@ -0,0 +1,107 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Compact text encoding of dbId sets, shared with assets/viewer.js.
+
+A set is encoded either as runs, "r" followed by the comma separated gap before each run of consecutive dbIds and its
+length, or as a bitset, "b<first dbId>:" followed by the base64 of the bits from the first dbId, least significant bit
+first. The shorter of the two is used, and the empty set is the empty string.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import base64
+from typing import Iterable, Tuple
+
+import numpy as np
+
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def to_set(ids: Iterable[int]) -> np.ndarray:
+    """Returns the sorted unique dbIds"""
+    return np.unique(np.fromiter(ids, dtype=np.int32))
+
+
+def encode(ids: np.ndarray) -> str:
+    """
+    Encodes a set of dbIds
+    @param ids: The sorted unique dbIds
+    @return: The shorter of the run and of the bitset encodings
+    """
+    if len(ids) == 0:
+        return ''
+    ids = ids.astype(np.int64)
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = ids[np.r_[0, breaks]]
+    ends = ids[np.r_[breaks - 1, len(ids) - 1]] + 1
+    gaps = starts - np.r_[0, ends[:-1]]
+    runs = 'r' + ','.join(map(str, np.column_stack((gaps, ends - starts)).ravel().tolist()))
+    span = int(ids[-1] - ids[0] + 1)
+    if (span + 23) // 24 * 4 >= len(runs):
+        # the base64 of the bits cannot be shorter, and the bits of sparse sets are not even allocated
+        return runs
+    bits = np.zeros(span, dtype=bool)
+    bits[ids - ids[0]] = True
+    bitset = f'b{ids[0]}:' + base64.b64encode(np.packbits(bits, bitorder='little')).decode('ascii')
+    return bitset if len(bitset) < len(runs) else runs
+
+
+def decode(text: str) -> np.ndarray:
+    """
+    Decodes a set of dbIds
+    @param text: The encoded set
+    @return: The sorted unique dbIds
+    """
+    if text == '':
+        return EMPTY
+    if text[0] == 'r':
+        values = np.array(text[1:].split(','), dtype=np.int64).reshape(-1, 2)
+        gaps, lengths = values[:, 0], values[:, 1]
+        ends = np.cumsum(gaps + lengths)
+        starts = ends - lengths
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return (np.arange(lengths.sum()) + offsets).astype(np.int32)
+    if text[0] == 'b':
+        first, data = text[1:].split(':', 1)
+        bits = np.unpackbits(np.frombuffer(base64.b64decode(data), dtype=np.uint8), bitorder='little')
+        return (np.flatnonzero(bits) + int(first)).astype(np.int32)
+    raise ValueError(f'Invalid dbId set encoding: {text[:16]}')
+
+
+def diff(old: np.ndarray, new: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the dbIds added and removed from a set to another
+    @param old: The sorted unique dbIds of the old set
+    @param new: The sorted unique dbIds of the new set
+    @return: The added and the removed dbIds
+    """
+    return np.setdiff1d(new, old, assume_unique=True), np.setdiff1d(old, new, assume_unique=True)
+
+
+def patch(ids: np.ndarray, added: np.ndarray, removed: np.ndarray) -> np.ndarray:
+    """
+    Applies the changes returned by diff
+    @param ids: The sorted unique dbIds
+    @param added: The dbIds to add
+    @param removed: The dbIds to remove
+    @return: The new set
+    """
+    return np.union1d(np.setdiff1d(ids, removed, assume_unique=True), added).astype(np.int32)
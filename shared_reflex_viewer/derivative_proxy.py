@@ -0,0 +1,259 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+A caching proxy of the model derivative endpoints used by the viewer to load SVF models, enabled by
+DERIVATIVE_PROXY=True.
+
+The viewer sends the token of the user with every request. The manifest is fetched with it, so APS decides whether the
+user can open the model, and the assets of the model are then served from a disk cache shared by all the users and
+keyed by URN, derivative version and asset. The assets of a version never change. A miss downloads the asset once
+however many browsers request it at the same time.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import pathlib
+import re
+import tempfile
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import decouple
+import requests
+
+import model_derivative
+from scheduler import endpoint_of, rewrite, scheduler
+from shared_reflex_viewer.cache import DiskCache, SharedCache
+
+
+DERIVATIVE_PROXY = decouple.config('DERIVATIVE_PROXY', default=False, cast=bool)
+DERIVATIVE_PROXY_DIR = pathlib.Path(decouple.config(
+    'DERIVATIVE_PROXY_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.derivatives')
+))
+DERIVATIVE_PROXY_MAX_BYTES = decouple.config('DERIVATIVE_PROXY_MAX_BYTES', default=10 * 1024 ** 3, cast=int)
+DERIVATIVE_PROXY_WORKERS = decouple.config('DERIVATIVE_PROXY_WORKERS', default=8, cast=int)
+# the seconds the access of a token to a model is trusted before its manifest is fetched again
+DERIVATIVE_PROXY_AUTH_TTL = decouple.config('DERIVATIVE_PROXY_AUTH_TTL', default=60, cast=int)
+
+PREFIX = '/api/derivatives'
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 1 << 20
+
+# the manifests by URN, the users are the digests of the tokens allowed to read them
+manifests = SharedCache('proxy_manifests', ttl=DERIVATIVE_PROXY_AUTH_TTL, stale_ttl=0)
+assets = DiskCache(DERIVATIVE_PROXY_DIR, DERIVATIVE_PROXY_MAX_BYTES)
+
+_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_PROXY_WORKERS, thread_name_prefix='derivative-proxy')
+_pending: Dict[str, asyncio.Future] = {}
+stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'bytes_served': 0, 'bytes_downloaded': 0}
+
+
+def token_digest(authorization: str) -> str:
+    return hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:16]
+
+
+def fetch_manifest(urn: str, authorization: str) -> Dict[str, Any]:
+    resp = scheduler.get(f'{model_derivative.ENDPOINT}/{urn}/manifest', headers={'Authorization': authorization})
+    resp.raise_for_status()
+    return resp.json()
+
+
+def authorize(urn: str, authorization: str) -> Dict[str, Any]:
+    """
+    Returns the manifest of a model if the token can read it
+    @param urn: The base64 encoded URN
+    @param authorization: The Authorization header of the viewer
+    @return: The manifest
+    @raise requests.HTTPError: If APS refuses the token
+    """
+    return manifests.get(urn, lambda: fetch_manifest(urn, authorization), user=token_digest(authorization))[0]
+
+
+def asset_key(urn: str, version: str, derivative_urn: str) -> str:
+    return hashlib.sha1(f'{urn}:{version}:{derivative_urn}'.encode('utf-8')).hexdigest()
+
+
+def download(urn: str, derivative_urn: str, authorization: str, key: str) -> pathlib.Path:
+    """
+    Downloads an asset into the cache
+    @param urn: The base64 encoded URN
+    @param derivative_urn: The URN of the asset
+    @param authorization: The Authorization header of the viewer
+    @param key: The cache key
+    @return: The cached file
+    """
+    url = f'{model_derivative.ENDPOINT}/{urn}/manifest/{urllib.parse.quote(derivative_urn, safe="")}'
+    temp = assets.temp_path(key)
+    try:
+        with scheduler.slot(endpoint_of(url)):
+            with requests.get(rewrite(url), headers={'Authorization': authorization}, stream=True, timeout=60) as resp:
+                resp.raise_for_status()
+                with temp.open('wb') as f:
+                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+        stats['bytes_downloaded'] += temp.stat().st_size
+        return assets.adopt(key, temp)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+async def get_asset(urn: str, derivative_urn: str, authorization: str) -> Tuple[pathlib.Path, str]:
+    """
+    Returns an asset from the cache, downloading it on a miss. The concurrent misses of the same asset share the
+    download, which completes even if the requests that started it are cancelled.
+    @param urn: The base64 encoded URN
+    @param derivative_urn: The URN of the asset
+    @param authorization: The Authorization header of the viewer
+    @return: The cached file and its key
+    """
+    manifest = await asyncio.to_thread(authorize, urn, authorization)
+    key = asset_key(urn, model_derivative.derivative_version(manifest), derivative_urn)
+    path = await asyncio.to_thread(assets.get, key)
+    if path is not None:
+        stats['hits'] += 1
+        return path, key
+    if key in _pending:
+        stats['coalesced'] += 1
+    else:
+        stats['misses'] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, download, urn, derivative_urn, authorization, key)
+        _pending[key] = future
+        future.add_done_callback(lambda _: _pending.pop(key, None))
+    return await asyncio.shield(_pending[key]), key
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single byte range
+    @param header: The Range header
+    @param size: The size of the file
+    @return: The first and the last byte, None if the header is not a single satisfiable range
+    """
+    m = RANGE.match(header.strip())
+    if m is None or (m.group(1) == '' and m.group(2) == ''):
+        return None
+    if m.group(1) == '':
+        # the last bytes
+        return max(0, size - int(m.group(2))), size - 1
+    start = int(m.group(1))
+    end = min(int(m.group(2)), size - 1) if m.group(2) != '' else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+def _read(path: pathlib.Path, start: int, length: int) -> bytes:
+    with path.open('rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+
+def _error(ex: Exception) -> Any:
+    from starlette.responses import Response
+
+    status = getattr(getattr(ex, 'response', None), 'status_code', None)
+    if status in (401, 403, 404):
+        return Response(status_code=status)
+    logging.warning(f'derivative proxy: {ex}')
+    return Response(status_code=502)
+
+
+async def serve_manifest(request: Any) -> Any:
+    """
+    The manifest endpoint, fetched with the token of the user
+    @param request: The starlette request
+    @return: The JSON response
+    """
+    from starlette.responses import JSONResponse, Response
+
+    authorization = request.headers.get('authorization', '')
+    if authorization == '':
+        return Response(status_code=401)
+    try:
+        manifest = await asyncio.to_thread(authorize, request.path_params['urn'], authorization)
+    except Exception as ex:
+        return _error(ex)
+    return JSONResponse(manifest, headers={'Cache-Control': 'private, no-cache'})
+
+
+async def serve_asset(request: Any) -> Any:
+    """
+    The asset endpoint, the whole file or a single byte range
+    @param request: The starlette request
+    @return: The response
+    """
+    from starlette.responses import FileResponse, Response
+
+    authorization = request.headers.get('authorization', '')
+    if authorization == '':
+        return Response(status_code=401)
+    derivative_urn = request.path_params['derivative_urn']
+    try:
+        path, key = await get_asset(request.path_params['urn'], derivative_urn, authorization)
+    except Exception as ex:
+        return _error(ex)
+    media_type = mimetypes.guess_type(derivative_urn)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': f'"{key}"',
+        # the users are authorized by the backend, the shared caches must not serve the assets
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+    }
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    size = path.stat().st_size
+    header = request.headers.get('range')
+    if header is None:
+        stats['bytes_served'] += size
+        return FileResponse(path, media_type=media_type, headers=headers)
+    byte_range = parse_range(header, size)
+    if byte_range is None:
+        return Response(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+    start, end = byte_range
+    data = await asyncio.to_thread(_read, path, start, end - start + 1)
+    stats['bytes_served'] += len(data)
+    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return Response(data, status_code=206, media_type=media_type, headers=headers)
+
+
+def proxy_url() -> str:
+    """Returns the URL the viewer loads the models from, empty when the proxy is disabled"""
+    if not DERIVATIVE_PROXY:
+        return ''
+    import reflex as rx
+
+    return f'{rx.config.get_config().api_url}{PREFIX}'
+
+
+def install(app: Any) -> None:
+    """
+    Adds the proxy endpoints to the app if DERIVATIVE_PROXY is True
+    @param app: The reflex app
+    """
+    if not DERIVATIVE_PROXY:
+        return
+    base = f'{PREFIX}/modelderivative/v2/designdata/{{urn}}/manifest'
+    app.api.add_api_route(base, serve_manifest, methods=['GET'])
+    app.api.add_api_route(f'{base}/{{derivative_urn:path}}', serve_asset, methods=['GET'])
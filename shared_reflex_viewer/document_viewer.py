@@ -14,6 +14,30 @@ class Viewer(rx.NoSSRComponent):
     width: rx.Var[str] = "100%"
     height: rx.Var[str] = "600px"
     position: rx.Var[str] = 'relative'
+    # the dbIds the selection mode is applied to
+    selection: rx.Var[list[int]]
+    # one of "isolate", "highlight", "fit" or "" to clear the selection
+    selection_mode: rx.Var[str] = ''
+    # the dbIds to color by "rgb(r, g, b)" color
+    theming: rx.Var[dict[str, list[int]]]
+    # "presenter" sends the camera changes, "follower" applies the camera updates
+    camera_role: rx.Var[str] = ''
+    # the camera update to apply, see sessions.encode
+    camera_update: rx.Var[list[int]]
+    # the minimum milliseconds between two camera updates sent by the presenter
+    camera_interval: rx.Var[int] = 100
+    # the positions are rounded to this step in model units
+    camera_step: rx.Var[float] = 0.001
+    # the selection update to apply, see sessions.encode_sets
+    selection_update: rx.Var[dict[str, list[str]]]
+    # the URL of the backend derivative proxy the SVF models are loaded from, APS when empty
+    derivative_proxy: rx.Var[str] = ''
+    # the URL the bounding boxes of the elements are posted to once the model is loaded, not reported when empty
+    bounds_url: rx.Var[str] = ''
+
+    on_camera_change: rx.EventHandler[lambda update: [update]]
+    on_selection_change: rx.EventHandler[lambda update: [update]]
+    on_bounds_report: rx.EventHandler[lambda elements: [elements]]
 
 
 viewer = Viewer.create
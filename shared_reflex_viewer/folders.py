@@ -0,0 +1,131 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import pathlib
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import decouple
+
+import aps
+from scheduler import scheduler
+from shared_reflex_viewer.cache import SharedCache
+from shared_reflex_viewer.snapshot import Snapshot
+
+
+ENDPOINT = 'https://developer.api.autodesk.com/data/v1/projects'
+
+FOLDER_CACHE_TTL = decouple.config('FOLDER_CACHE_TTL', default=300, cast=int)
+FOLDER_CACHE_STALE_TTL = decouple.config('FOLDER_CACHE_STALE_TTL', default=3600, cast=int)
+FOLDER_CACHE_MAX_BYTES = decouple.config('FOLDER_CACHE_MAX_BYTES', default=64 * 1024 * 1024, cast=int)
+# share the listings with the other backend workers on this host
+FOLDER_CACHE_SHARED = decouple.config('FOLDER_CACHE_SHARED', default=False, cast=bool)
+
+folder_cache = SharedCache(
+    'folders',
+    ttl=FOLDER_CACHE_TTL,
+    max_bytes=FOLDER_CACHE_MAX_BYTES,
+    stale_ttl=FOLDER_CACHE_STALE_TTL,
+    path=pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.folders.db' if FOLDER_CACHE_SHARED else None,
+)
+
+
+def fetch_folder_contents(project_id: str, folder_id: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Lists the sub folders and the items of a folder from APS, one request per page of the folder contents. The requests
+    go through the scheduler, that sends them to APS_BASE_URL when it is set.
+    @param project_id: The ACC project id, with or without the "b." prefix
+    @param folder_id: The folder id
+    @return: A dictionary with the "folders" and "items" maps, the {"name"} of the sub folders and the {"name",
+    "version", "urn"} of the items by id, the urn is the base64 derivative URN of the tip version, see versions
+    """
+    project_id = project_id if project_id.startswith('b.') else f'b.{project_id}'
+    url = f'{ENDPOINT}/{project_id}/folders/{folder_id}/contents'
+    params = {'page[limit]': 200}
+    contents = {'folders': {}, 'items': {}}
+    while url is not None:
+        resp = scheduler.get(url, headers={'Authorization': aps.token.Value}, params=params)
+        resp.raise_for_status()
+        j = resp.json()
+        for d in j.get('data', []):
+            if d.get('type') in contents:
+                attributes = d.get('attributes', {})
+                name = attributes.get('displayName') or attributes.get('name', d['id'])
+                # the items without a tip version in "included" cannot be viewed
+                entry = {'name': name, 'version': '', 'urn': ''} if d['type'] == 'items' else {'name': name}
+                contents[d['type']][d['id']] = entry
+        # the tip versions of the items in the page are in the "included" section
+        for version in j.get('included', []):
+            relationships = version.get('relationships', {})
+            item = contents['items'].get(relationships.get('item', {}).get('data', {}).get('id'))
+            if version.get('type') == 'versions' and item is not None:
+                item['version'] = version['id']
+                item['urn'] = relationships.get('derivatives', {}).get('data', {}).get('id', '')
+        url = j.get('links', {}).get('next', {}).get('href')
+        params = None
+    return contents
+
+
+def _load(project_id: str, folder_id: str, user: str) -> Dict[str, Dict[str, Any]]:
+    """Lists a folder from APS and merges the listing into the snapshot of the project, see Snapshot.merge_listing"""
+    contents = fetch_folder_contents(project_id, folder_id)
+    snapshot = Snapshot.load(project_id)
+    if snapshot is not None:
+        snapshot.merge_listing(folder_id, contents, user)
+    return contents
+
+
+def refresh_folder_contents(project_id: str, folder_id: str, user: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Lists a folder from APS and stores the listing in the shared cache, e.g. after a webhook event changed it. Unlike
+    get_folder_contents it never answers from the crawled snapshot, which is older than the event.
+    @param project_id: The ACC project id
+    @param folder_id: The folder id
+    @param user: The id of the user the folder is listed for
+    @return: A dictionary with the "folders" and "items" maps
+    """
+    contents = _load(project_id, folder_id, user)
+    if user is not None:
+        folder_cache.put((project_id, folder_id), contents, user)
+    return contents
+
+
+def get_folder_contents(project_id: str, folder_id: str, user: Optional[str]) -> Tuple[Dict[str, Dict[str, Any]], bool]:
+    """
+    Returns the contents of a folder from the shared cache, the user must have loaded the folder once from APS.
+    Folders the user did not load yet are served from the crawled snapshot of the project while they are refreshed,
+    the refreshed listings are merged back into the snapshot.
+    @param project_id: The ACC project id
+    @param folder_id: The folder id
+    @param user: The id of the user browsing the folder, the folders of a user without id are always listed from APS
+    @return: The contents and True if they are stale and being revalidated
+    """
+    if user is None:
+        return fetch_folder_contents(project_id, folder_id), False
+    key = (project_id, folder_id)
+    loader = lambda: _load(project_id, folder_id, user)
+    entry = folder_cache.peek(key)
+    if entry is None or user not in entry.users:
+        snapshot = Snapshot.load(project_id)
+        contents = snapshot.listing(folder_id, user) if snapshot is not None else None
+        if contents is not None:
+            folder_cache.revalidate(key, loader, user)
+            return contents, True
+    return folder_cache.get(key, loader, user=user)
@@ -0,0 +1,187 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared_reflex_viewer.property_store import PropertyStore
+
+
+_MASK = (1 << 64) - 1
+
+
+def hash_strings(strings: Sequence[str]) -> np.ndarray:
+    """
+    Hashes strings to uint64, the hashes are only comparable within the same process
+    @param strings: The strings
+    @return: The hashes
+    """
+    return np.fromiter((hash(s) & _MASK for s in strings), dtype=np.uint64, count=len(strings))
+
+
+def mix(a: np.ndarray) -> np.ndarray:
+    """Applies the splitmix64 finalizer, so that hashes can be combined by addition without cancelling out"""
+    with np.errstate(over='ignore'):
+        a = a.astype(np.uint64, copy=True)
+        a ^= a >> np.uint64(30)
+        a *= np.uint64(0xbf58476d1ce4e5b9)
+        a ^= a >> np.uint64(27)
+        a *= np.uint64(0x94d049bb133111eb)
+        a ^= a >> np.uint64(31)
+    return a
+
+
+def row_hashes(store: PropertyStore) -> np.ndarray:
+    """
+    Returns the hash of the (attribute, value) pair of every row of a store
+    @param store: The store
+    @return: The row hashes
+    """
+    attr_hashes = hash_strings(store.attr_names)[store.attrs]
+    value_hashes = hash_strings(store.value_names)[store.values]
+    return mix(attr_hashes ^ mix(value_hashes))
+
+
+def element_digests(store: PropertyStore) -> np.ndarray:
+    """
+    Returns a digest of the properties of every object of a store, in the order of store.objects
+    @param store: The store
+    @return: The digests, independent of the order of the properties
+    """
+    order = np.argsort(store.dbids, kind='stable')
+    dbids = store.dbids[order]
+    digests = np.zeros(len(store.objects), dtype=np.uint64)
+    if len(dbids) == 0:
+        return digests
+    starts = np.flatnonzero(np.concatenate(([True], dbids[1:] != dbids[:-1])))
+    with np.errstate(over='ignore'):
+        sums = np.add.reduceat(row_hashes(store)[order], starts)
+    unique = dbids[starts]
+    pos = np.minimum(np.searchsorted(unique, store.objects), len(unique) - 1)
+    found = unique[pos] == store.objects
+    digests[found] = sums[pos[found]]
+    return digests
+
+
+def match_keys(store: PropertyStore) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the keys the elements of a store are matched by. The key is the hash of the external id combined with the
+    rank of the element among the elements sharing the same external id in dbId order, so that duplicated external ids
+    are matched one to one. The elements without external id have no key.
+    @param store: The store
+    @return: The keys and the positions in store.objects of the elements they belong to
+    """
+    positions = np.array([i for i, e in enumerate(store.external_ids) if e != ''], dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.uint64), positions
+    hashes = hash_strings([store.external_ids[i] for i in positions])
+    order = np.lexsort((store.objects[positions], hashes))
+    first = np.concatenate(([True], hashes[order][1:] != hashes[order][:-1]))
+    starts = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+    ranks = np.empty(len(order), dtype=np.uint64)
+    ranks[order] = np.arange(len(order)) - starts
+    return mix(hashes ^ mix(ranks)), positions
+
+
+def _element_rows(store: PropertyStore, ids: np.ndarray, owners: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Returns the rows of the given objects keyed by (owner, attribute), the owner being the dbId in the new version"""
+    mask = np.isin(store.dbids, ids)
+    dbids, attrs, values = store.dbids[mask], store.attrs[mask], store.values[mask]
+    order = np.argsort(ids)
+    owner = owners[order][np.searchsorted(ids[order], dbids)]
+    keys = mix(owner.astype(np.uint64) ^ mix(hash_strings(store.attr_names)[attrs]))
+    # an attribute repeated in several groups of the same element is compared once
+    keys, first = np.unique(keys, return_index=True)
+    return keys, owner[first], attrs[first], values[first]
+
+
+@dataclass
+class ModelDiff:
+    """The differences between two versions of a model, the elements are matched by external id, see match_keys."""
+    old: PropertyStore
+    new: PropertyStore
+    # dbIds of the new version
+    added: np.ndarray
+    # dbIds of the old version
+    removed: np.ndarray
+    # dbIds of the changed elements in the new version and in the old version, in the same order
+    changed: np.ndarray
+    changed_old: np.ndarray
+    # dbIds of the elements without external id in the new version and in the old version, they cannot be compared
+    unmatched: np.ndarray
+    unmatched_old: np.ndarray
+
+    def summary(self) -> Dict[str, int]:
+        return {'added': len(self.added), 'removed': len(self.removed), 'changed': len(self.changed),
+                'unmatched': len(self.unmatched) + len(self.unmatched_old)}
+
+    def property_changes(self, limit: int = None) -> Dict[int, List[Tuple[str, Optional[str], Optional[str]]]]:
+        """
+        Returns the changed properties of the changed elements
+        @param limit: The maximum number of elements, all if None
+        @return: The (attribute, old value, new value) triples by dbId of the new version, a missing value is None
+        """
+        new_ids = self.changed[:limit]
+        old_keys, old_owner, old_attrs, old_values = _element_rows(self.old, self.changed_old[:limit], new_ids)
+        new_keys, new_owner, new_attrs, new_values = _element_rows(self.new, new_ids, new_ids)
+        _, io, inew = np.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+        old_hashes = hash_strings(self.old.value_names)[old_values[io]]
+        different = old_hashes != hash_strings(self.new.value_names)[new_values[inew]]
+
+        changes: Dict[int, List[Tuple[str, Optional[str], Optional[str]]]] = {}
+        for i, j in zip(io[different], inew[different]):
+            changes.setdefault(int(new_owner[j]), []).append(
+                (self.new.attr_names[new_attrs[j]], self.old.value_names[old_values[i]],
+                 self.new.value_names[new_values[j]]))
+        for i in np.setdiff1d(np.arange(len(old_keys)), io, assume_unique=True):
+            changes.setdefault(int(old_owner[i]), []).append(
+                (self.old.attr_names[old_attrs[i]], self.old.value_names[old_values[i]], None))
+        for j in np.setdiff1d(np.arange(len(new_keys)), inew, assume_unique=True):
+            changes.setdefault(int(new_owner[j]), []).append(
+                (self.new.attr_names[new_attrs[j]], None, self.new.value_names[new_values[j]]))
+        return changes
+
+
+def diff(old: PropertyStore, new: PropertyStore) -> ModelDiff:
+    """
+    Compares two versions of a model. The elements are matched by the hash of their external id and compared by a
+    digest of their properties, the per-property changes are only computed on demand. The elements without external
+    id are reported as unmatched rather than added or removed.
+    @param old: The store of the old version
+    @param new: The store of the new version
+    @return: The differences
+    """
+    old_keys, old_positions = match_keys(old)
+    new_keys, new_positions = match_keys(new)
+    _, io, inew = np.intersect1d(old_keys, new_keys, return_indices=True)
+    io, inew = old_positions[io], new_positions[inew]
+    changed = element_digests(old)[io] != element_digests(new)[inew]
+    return ModelDiff(
+        old=old,
+        new=new,
+        added=new.objects[np.setdiff1d(new_positions, inew, assume_unique=True)],
+        removed=old.objects[np.setdiff1d(old_positions, io, assume_unique=True)],
+        changed=new.objects[inew[changed]],
+        changed_old=old.objects[io[changed]],
+        unmatched=new.objects[np.setdiff1d(np.arange(len(new.objects)), new_positions, assume_unique=True)],
+        unmatched_old=old.objects[np.setdiff1d(np.arange(len(old.objects)), old_positions, assume_unique=True)],
+    )
@@ -0,0 +1,106 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import decouple
+
+from scheduler import background
+from shared_reflex_viewer.folders import folder_cache, get_folder_contents
+
+
+PREFETCH_WORKERS = decouple.config('PREFETCH_WORKERS', default=4, cast=int)
+PREFETCH_PER_USER = decouple.config('PREFETCH_PER_USER', default=8, cast=int)
+
+
+class Prefetcher:
+    """
+    Speculatively loads folders into the folder cache on a bounded worker pool.
+
+    The pool size is the global concurrency cap, and each user can have at most `per_user` prefetches queued or
+    running. A new request from a session cancels the prefetches the session queued before.
+    """
+
+    def __init__(self, workers: int = PREFETCH_WORKERS, per_user: int = PREFETCH_PER_USER):
+        self.per_user = per_user
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.RLock()
+        self._futures: Dict[str, List[Future]] = {}
+        self._outstanding: Dict[str, int] = {}
+
+    def prefetch(self, session: str, user: Optional[str], project_id: str, folder_ids: Sequence[str]) -> int:
+        """
+        Queues the folders that are not cached yet for the user, replacing what the session queued before
+        @param session: The client token of the browser session
+        @param user: The id of the user the folders are loaded for
+        @param project_id: The ACC project id
+        @param folder_ids: The folders likely to be expanded next
+        @return: The number of queued prefetches
+        """
+        self.cancel(session)
+        # the folders of a user without id are not cached, there is nothing to prefetch
+        if user is None:
+            return 0
+        futures = []
+        with self._lock:
+            for folder_id in folder_ids:
+                if self._outstanding.get(user, 0) >= self.per_user:
+                    break
+                entry = folder_cache.peek((project_id, folder_id))
+                if entry is not None and user in entry.users and time.time() - entry.stored <= folder_cache.ttl:
+                    continue
+                self._outstanding[user] = self._outstanding.get(user, 0) + 1
+                future = self._executor.submit(_prefetch, project_id, folder_id, user)
+                future.add_done_callback(lambda f, u=user: self._done(f, u))
+                futures.append(future)
+            self._futures[session] = futures
+        return len(futures)
+
+    def cancel(self, session: str) -> None:
+        """
+        Cancels the prefetches of the session that did not start yet
+        @param session: The client token of the browser session
+        """
+        with self._lock:
+            futures = self._futures.pop(session, [])
+        for future in futures:
+            future.cancel()
+
+    def _done(self, future: Future, user: str) -> None:
+        with self._lock:
+            self._outstanding[user] -= 1
+            if self._outstanding[user] <= 0:
+                del self._outstanding[user]
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f'prefetch failed: {future.exception()}')
+
+
+
+def _prefetch(project_id: str, folder_id: str, user: str) -> None:
+    # the prefetches wait behind the folders the users are expanding
+    with background():
+        get_folder_contents(project_id, folder_id, user)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,234 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Profiles the event handlers of the app when PROFILING=True.
+
+The time of every handler, the time spent in the APS calls it made, the computed vars it sent and the size of its
+state deltas are shown live on /api/metrics and saved to PROFILING_DUMP when the backend stops. Compare two dumps with
+`python -m shared_reflex_viewer.profiling before.json after.json`.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import atexit
+import contextvars
+import html
+import json
+import pathlib
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import decouple
+import reflex as rx
+
+import scheduler
+
+
+PROFILING = decouple.config('PROFILING', default=False, cast=bool)
+# the file the metrics are saved to when the backend stops
+PROFILING_DUMP = decouple.config('PROFILING_DUMP', default='')
+PROFILING_REFRESH_SECONDS = decouple.config('PROFILING_REFRESH_SECONDS', default=2, cast=int)
+
+
+@dataclass
+class HandlerStats:
+    count: int = 0
+    wall: float = 0.0
+    wall_max: float = 0.0
+    # the CPU time of the event loop thread while the handler ran, other tasks running meanwhile are included
+    cpu: float = 0.0
+    aps: float = 0.0
+    aps_calls: int = 0
+    delta_bytes: int = 0
+    delta_bytes_max: int = 0
+    # the number of times every computed var was sent
+    computed: Dict[str, int] = field(default_factory=dict)
+
+    def row(self, name: str) -> Dict[str, Any]:
+        n = max(self.count, 1)
+        return {
+            'handler': name,
+            'count': self.count,
+            'wall_ms': round(self.wall * 1000 / n, 2),
+            'wall_max_ms': round(self.wall_max * 1000, 2),
+            'cpu_ms': round(self.cpu * 1000 / n, 2),
+            'aps_ms': round(self.aps * 1000 / n, 2),
+            'aps_calls': round(self.aps_calls / n, 2),
+            'delta_bytes': self.delta_bytes // n,
+            'delta_bytes_max': self.delta_bytes_max,
+            'total_s': round(self.wall, 3),
+            'computed': dict(sorted(self.computed.items(), key=lambda c: -c[1])),
+        }
+
+
+@dataclass
+class _Measure:
+    name: str
+    started: float = field(default_factory=time.perf_counter)
+    cpu: float = field(default_factory=time.thread_time)
+    delta_bytes: int = 0
+    computed: Dict[str, int] = field(default_factory=dict)
+    aps: List[Tuple[str, float]] = field(default_factory=list)
+
+
+_measure: contextvars.ContextVar[Optional[_Measure]] = contextvars.ContextVar('measure', default=None)
+_lock = threading.Lock()
+_stats: Dict[str, HandlerStats] = {}
+_started = time.time()
+# the computed vars of every state class by full name
+_computed_vars: Dict[str, set] = {}
+
+
+def _computed_vars_of(state: Any) -> Dict[str, set]:
+    if len(_computed_vars) == 0:
+        classes = [type(state)]
+        while len(classes) > 0:
+            cls = classes.pop()
+            _computed_vars[cls.get_full_name()] = set(cls.computed_vars)
+            classes.extend(cls.get_substates())
+    return _computed_vars
+
+
+def _record(measure: _Measure) -> None:
+    wall = time.perf_counter() - measure.started
+    cpu = time.thread_time() - measure.cpu
+    with _lock:
+        stats = _stats.setdefault(measure.name, HandlerStats())
+        stats.count += 1
+        stats.wall += wall
+        stats.wall_max = max(stats.wall_max, wall)
+        stats.cpu += cpu
+        stats.aps += sum(seconds for _, seconds in measure.aps)
+        stats.aps_calls += len(measure.aps)
+        stats.delta_bytes += measure.delta_bytes
+        stats.delta_bytes_max = max(stats.delta_bytes_max, measure.delta_bytes)
+        for var, count in measure.computed.items():
+            stats.computed[var] = stats.computed.get(var, 0) + count
+
+
+class ProfilingMiddleware(rx.Middleware):
+    """
+    Measures the events from the preprocessing to their final update. The events of the background handlers return
+    immediately and are not measured, the APS calls are accounted through scheduler.aps_calls.
+    """
+
+    async def preprocess(self, app: Any, state: Any, event: Any) -> None:
+        measure = _Measure(event.name)
+        _measure.set(measure)
+        scheduler.aps_calls.set(measure.aps)
+        return None
+
+    async def postprocess(self, app: Any, state: Any, event: Any, update: Any) -> Any:
+        measure = _measure.get()
+        if measure is None or measure.name != event.name:
+            return update
+        measure.delta_bytes += len(update.json().encode('utf-8'))
+        computed_vars = _computed_vars_of(state)
+        for name, delta in update.delta.items():
+            for var in computed_vars.get(name, ()):
+                if var in delta:
+                    key = f'{name}.{var}'
+                    measure.computed[key] = measure.computed.get(key, 0) + 1
+        if update.final:
+            _record(measure)
+            _measure.set(None)
+            scheduler.aps_calls.set(None)
+        return update
+
+
+def snapshot() -> Dict[str, Any]:
+    """Returns the metrics of the handlers, the slowest in total first"""
+    with _lock:
+        rows = [s.row(name) for name, s in _stats.items()]
+    return {
+        'started': _started,
+        'seconds': round(time.time() - _started, 1),
+        'handlers': sorted(rows, key=lambda r: -r['total_s']),
+        'aps': scheduler.scheduler.stats(),
+    }
+
+
+def dump(path: str = None) -> None:
+    """
+    Saves the metrics to a JSON file
+    @param path: The file, PROFILING_DUMP if None
+    """
+    path = PROFILING_DUMP if path is None else path
+    if path != '':
+        pathlib.Path(path).write_text(json.dumps(snapshot(), indent=2))
+
+
+COLUMNS = ('handler', 'count', 'wall_ms', 'wall_max_ms', 'cpu_ms', 'aps_ms', 'aps_calls', 'delta_bytes',
+           'delta_bytes_max', 'total_s')
+
+
+async def metrics(request: Any) -> Any:
+    """
+    The live metrics page, the JSON with ?format=json
+    @param request: The starlette request
+    @return: The response
+    """
+    from starlette.responses import HTMLResponse, JSONResponse
+
+    data = snapshot()
+    if request.query_params.get('format') == 'json':
+        return JSONResponse(data)
+    rows = []
+    for r in data['handlers']:
+        cells = ''.join(f'<td>{html.escape(str(r[c]))}</td>' for c in COLUMNS)
+        computed = ', '.join(f'{html.escape(k.split(".")[-1])} {v}' for k, v in r['computed'].items())
+        rows.append(f'<tr>{cells}<td>{computed}</td></tr>')
+    head = ''.join(f'<th>{c}</th>' for c in COLUMNS)
+    return HTMLResponse(
+        f'<html><head><meta http-equiv="refresh" content="{PROFILING_REFRESH_SECONDS}"><title>Metrics</title></head>'
+        f'<body><h3>Event handlers, {data["seconds"]}s</h3><table border="1" cellpadding="4">'
+        f'<tr>{head}<th>computed vars sent</th></tr>{"".join(rows)}</table></body></html>'
+    )
+
+
+def install(app: Any) -> None:
+    """
+    Adds the middleware and the metrics endpoint to the app if PROFILING is True
+    @param app: The reflex app
+    """
+    if not PROFILING:
+        return
+    # the middleware after the first one returning an update is skipped, the profiler returns it unchanged
+    app.add_middleware(ProfilingMiddleware(), index=0)
+    app.api.add_api_route('/api/metrics', metrics, methods=['GET'])
+    atexit.register(dump)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dumps', nargs='+', type=pathlib.Path)
+    args = parser.parse_args()
+
+    dumps = [{r['handler']: r for r in json.loads(p.read_text())['handlers']} for p in args.dumps]
+    print('\t'.join(['handler'] + [f'{c} {i}' for i in range(len(dumps)) for c in ('count', 'wall_ms', 'aps_ms', 'delta_bytes')]))
+    for name in sorted(set().union(*dumps), key=lambda n: -dumps[0].get(n, {}).get('total_s', 0)):
+        values = [str(d.get(name, {}).get(c, '')) for d in dumps for c in ('count', 'wall_ms', 'aps_ms', 'delta_bytes')]
+        print('\t'.join([name] + values))
+
+
+if __name__ == '__main__':
+    main()
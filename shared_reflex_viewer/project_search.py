@@ -0,0 +1,199 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import decouple
+import httpx
+
+import aps
+from scheduler import INTERACTIVE, scheduler
+from shared_reflex_viewer import catalog
+from shared_reflex_viewer.cache import SharedCache
+from shared_reflex_viewer.search_index import match_score
+
+
+SEARCH_WORKERS = decouple.config('SEARCH_WORKERS', default=16, cast=int)
+SEARCH_PROJECT_TIMEOUT = decouple.config('SEARCH_PROJECT_TIMEOUT', default=10, cast=float)
+SEARCH_CACHE_TTL = decouple.config('SEARCH_CACHE_TTL', default=120, cast=int)
+# the maximum number of hits of a project and of a search
+SEARCH_MAX_RESULTS = decouple.config('SEARCH_MAX_RESULTS', default=50, cast=int)
+
+# the complete results by user and query, the results differ by user as every user sees different projects
+search_cache = SharedCache('project_search', ttl=SEARCH_CACHE_TTL, stale_ttl=0, max_bytes=8 * 1024 * 1024)
+
+
+@dataclass
+class SearchProgress:
+    """The merged results of a search after every project answered."""
+    query: str
+    hits: List[Dict[str, str]] = field(default_factory=list)
+    projects: int = 0
+    searched: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    cached: bool = False
+    done: bool = False
+
+
+def rank(hits: Dict[str, Dict[str, Any]], query: str, limit: int = SEARCH_MAX_RESULTS) -> List[Dict[str, str]]:
+    """
+    Ranks the hits by how the name matches the query and then by the last modification, the most recent first
+    @param hits: The hits by item id
+    @param query: The lower case query
+    @param limit: The maximum number of hits
+    @return: The best hits
+    """
+    ranked = sorted(hits.values(), key=lambda h: h['modified'], reverse=True)
+    # the sort is stable, the most recent hits stay first within the same score
+    ranked.sort(key=lambda h: -match_score(h['name'].lower(), query))
+    return ranked[:limit]
+
+
+def merge(hits: Dict[str, Dict[str, Any]], versions: List[Dict[str, Any]]) -> None:
+    """
+    Adds the versions found in a project to the hits, keeping the latest version of every item
+    @param hits: The hits by item id
+    @param versions: The versions returned by the search
+    """
+    for v in versions:
+        old = hits.get(v['id'])
+        if old is None or int(v['version']) > int(old['version']):
+            hits[v['id']] = v
+
+
+class ProjectSearch:
+    """
+    Fans a query out to the search endpoint of the top folders of every project of a user. At most `workers` projects
+    are searched at the same time and a project that does not answer within `timeout` seconds is skipped.
+    """
+
+    def __init__(self, user: Optional[str], query: str, workers: int = SEARCH_WORKERS,
+                 timeout: float = SEARCH_PROJECT_TIMEOUT):
+        self.user = user
+        self.query = query.strip()
+        self.workers = workers
+        self.timeout = timeout
+
+    async def run(self) -> AsyncIterator[SearchProgress]:
+        """
+        Searches the projects, the results of the previous search of the same query are returned from the cache
+        @return: The merged results after every project, the last one is done
+        """
+        started = time.perf_counter()
+        progress = SearchProgress(self.query)
+        q = self.query.lower()
+        if len(q) == 0:
+            progress.done = True
+            yield progress
+            return
+        # the cache has no stale TTL, only the fresh results are returned
+        found = search_cache.lookup((self.user, q), self.user) if self.user is not None else None
+        if found is not None:
+            progress.hits, progress.projects = found[0]['hits'], found[0]['projects']
+            progress.searched, progress.cached, progress.done = progress.projects, True, True
+            yield progress
+            return
+        listed = await asyncio.to_thread(catalog.list_catalog, self.user)
+        folders: Dict[str, List[str]] = {}
+        for f in listed['folders']:
+            folders.setdefault(f['project_id'], []).append(f['id'])
+        names = {p['id']: p['name'] for p in listed['projects']}
+        progress.projects = len(folders)
+        hits: Dict[str, Dict[str, Any]] = {}
+        semaphore = asyncio.Semaphore(self.workers)
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+
+            async def search(project_id: str) -> List[Dict[str, Any]]:
+                async with semaphore:
+                    found = await asyncio.wait_for(
+                        asyncio.gather(*[self._search_folder(client, project_id, f) for f in folders[project_id]]),
+                        self.timeout
+                    )
+                project = names.get(project_id, '')
+                return [{**v, 'project_id': project_id, 'project': project} for fs in found for v in fs]
+
+            tasks = [asyncio.create_task(search(p)) for p in folders]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    try:
+                        merge(hits, await task)
+                    except Exception as ex:
+                        progress.errors += 1
+                        logging.warning(f'search of "{self.query}" in a project failed: {ex!r}')
+                    progress.searched += 1
+                    progress.hits = rank(hits, q)
+                    progress.elapsed = time.perf_counter() - started
+                    progress.done = progress.searched == progress.projects
+                    yield progress
+            finally:
+                for task in tasks:
+                    task.cancel()
+        if progress.projects == 0:
+            progress.done = True
+            yield progress
+        # the searches with errors are not cached, the failed projects are searched again next time
+        if progress.errors == 0 and self.user is not None:
+            search_cache.put((self.user, q), {'hits': progress.hits, 'projects': progress.projects}, self.user)
+
+    async def _search_folder(self, client: httpx.AsyncClient, project_id: str, folder_id: str) -> List[Dict[str, Any]]:
+        url = f'{catalog.DATA_ENDPOINT}/{project_id}/folders/{folder_id}/search'
+        params: Optional[Dict[str, Any]] = {'filter[attributes.displayName]-contains': self.query}
+        found = []
+        while url is not None and len(found) < SEARCH_MAX_RESULTS:
+            resp = await scheduler.arequest(client, 'GET', url, priority=INTERACTIVE,
+                                            headers={'Authorization': aps.token.Value}, params=params)
+            if resp.status_code in (403, 404):
+                # the folders the user cannot read are not searched
+                return found
+            resp.raise_for_status()
+            j = resp.json()
+            for v in j.get('data', []):
+                if v.get('type') != 'versions':
+                    continue
+                attributes = v.get('attributes', {})
+                relationships = v.get('relationships', {})
+                item_id = relationships.get('item', {}).get('data', {}).get('id')
+                if item_id is None:
+                    continue
+                found.append({
+                    'id': item_id,
+                    'name': attributes.get('displayName', attributes.get('name', '')),
+                    'version': str(attributes.get('versionNumber', 0)),
+                    'modified': attributes.get('lastModifiedTime', ''),
+                    'urn': relationships.get('derivatives', {}).get('data', {}).get('id', ''),
+                })
+            url = j.get('links', {}).get('next', {}).get('href')
+            params = None
+        return found
+
+
+def search(user: Optional[str], query: str) -> AsyncIterator[SearchProgress]:
+    """
+    Searches the name of the files of all the projects of a user
+    @param user: The id of the user
+    @param query: The text to look for
+    @return: The merged results after every project
+    """
+    return ProjectSearch(user, query).run()
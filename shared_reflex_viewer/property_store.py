@@ -0,0 +1,234 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import gzip
+import json
+import pathlib
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import model_derivative
+
+
+# (attribute, operator, value)
+Condition = Tuple[str, str, str]
+
+OPERATORS = ('!=', '>=', '<=', '=', '~', '>', '<')
+
+
+def parse_query(text: str) -> List[Condition]:
+    """
+    Parses a query like "Category = Ducts and System Type ~ Supply" into conditions
+    @param text: The query, the conditions are joined by "and", the operators are =, !=, ~ (contains), >, >=, <, <=
+    @return: The conditions
+    """
+    conditions = []
+    for part in re.split(r'\s+and\s+', text.strip(), flags=re.IGNORECASE):
+        if len(part) == 0:
+            continue
+        for op in OPERATORS:
+            if op in part:
+                attr, value = part.split(op, 1)
+                conditions.append((attr.strip(), op, value.strip().strip('"\'')))
+                break
+        else:
+            raise ValueError(f'Invalid condition: "{part}"')
+    return conditions
+
+
+class PropertyStore:
+    """
+    A columnar, dictionary-encoded store of the properties of a model.
+
+    Every (dbId, attribute, value) triple is a row of three int32 columns sorted by attribute, so the rows of an
+    attribute are a contiguous slice. Conditions are evaluated once per distinct value into a lookup table and then
+    applied to the slice with a single vectorized gather.
+    """
+
+    def __init__(self, dbids: np.ndarray, attrs: np.ndarray, values: np.ndarray, attr_names: List[str],
+                 value_names: List[str], objects: np.ndarray, external_ids: List[str]):
+        order = np.lexsort((dbids, attrs))
+        self.dbids = dbids[order]
+        self.attrs = attrs[order]
+        self.values = values[order]
+        self.attr_names = attr_names
+        self.value_names = value_names
+        # the dbIds of the objects and their external ids, in the same order
+        self.objects = objects
+        self.external_ids = external_ids
+        self._attr_codes = {a: i for i, a in enumerate(attr_names)}
+        self._value_codes = {v: i for i, v in enumerate(value_names)}
+        self._offsets = np.searchsorted(self.attrs, np.arange(len(attr_names) + 1))
+        self._numbers = np.array([_to_float(v) for v in value_names], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.dbids)
+
+    @classmethod
+    def from_objects(cls, objects: Iterable[Dict[str, Any]]) -> 'PropertyStore':
+        """
+        Builds the store from the objects of the Model Derivative properties endpoint
+        @param objects: The {"objectid", "externalId", "properties"} objects
+        @return: The store
+        """
+        attr_codes: Dict[str, int] = {}
+        value_codes: Dict[str, int] = {}
+        dbids, attrs, values, object_ids = array('i'), array('i'), array('i'), array('i')
+        external_ids = []
+        for obj in objects:
+            dbid = obj['objectid']
+            object_ids.append(dbid)
+            external_ids.append(obj.get('externalId', ''))
+            for group in obj.get('properties', {}).values():
+                if not isinstance(group, dict):
+                    continue
+                for name, value in group.items():
+                    if isinstance(value, list):
+                        value = ', '.join(str(v) for v in value)
+                    dbids.append(dbid)
+                    attrs.append(attr_codes.setdefault(name, len(attr_codes)))
+                    values.append(value_codes.setdefault(str(value), len(value_codes)))
+        return cls(np.frombuffer(dbids, dtype=np.int32), np.frombuffer(attrs, dtype=np.int32),
+                   np.frombuffer(values, dtype=np.int32), list(attr_codes), list(value_codes),
+                   np.frombuffer(object_ids, dtype=np.int32), external_ids)
+
+    def save(self, path: pathlib.Path) -> None:
+        np.savez(path.with_suffix('.npz'), dbids=self.dbids, attrs=self.attrs, values=self.values, objects=self.objects)
+        with gzip.open(path.with_suffix('.names.json.gz'), 'wt', encoding='utf-8') as f:
+            json.dump({'attrs': self.attr_names, 'values': self.value_names, 'external_ids': self.external_ids}, f)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional['PropertyStore']:
+        if not path.with_suffix('.npz').exists() or not path.with_suffix('.names.json.gz').exists():
+            return None
+        arrays = np.load(path.with_suffix('.npz'))
+        with gzip.open(path.with_suffix('.names.json.gz'), 'rt', encoding='utf-8') as f:
+            names = json.load(f)
+        return cls(arrays['dbids'], arrays['attrs'], arrays['values'], names['attrs'], names['values'],
+                   arrays['objects'], names['external_ids'])
+
+    def _slice(self, attr: str) -> slice:
+        code = self._attr_codes.get(attr)
+        if code is None:
+            return slice(0, 0)
+        return slice(self._offsets[code], self._offsets[code + 1])
+
+    def _lookup(self, op: str, value: str, s: slice) -> np.ndarray:
+        """Returns a boolean per distinct value telling if it satisfies the condition"""
+        if op in ('>', '>=', '<', '<='):
+            number = _to_float(value)
+            with np.errstate(invalid='ignore'):
+                return {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal}[op](
+                    self._numbers, number)
+        lookup = np.zeros(len(self.value_names), dtype=bool)
+        if op == '~':
+            v = value.lower()
+            # only the distinct values of the attribute need the string comparison
+            codes = np.unique(self.values[s])
+            lookup[[c for c in codes if v in self.value_names[c].lower()]] = True
+        else:
+            code = self._value_codes.get(value)
+            if code is not None:
+                lookup[code] = True
+            if op == '!=':
+                lookup = ~lookup
+        return lookup
+
+    def filter(self, conditions: Sequence[Condition]) -> np.ndarray:
+        """
+        Returns the sorted dbIds that satisfy all the conditions
+        @param conditions: The (attribute, operator, value) conditions
+        @return: The dbIds
+        """
+        result = None
+        for attr, op, value in conditions:
+            s = self._slice(attr)
+            # the rows of an attribute are sorted by dbId, dropping the repeats is enough to make them unique
+            ids = self.dbids[s][self._lookup(op, value, s)[self.values[s]]]
+            ids = ids[np.concatenate(([True], ids[1:] != ids[:-1]))] if len(ids) > 0 else ids
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+            if len(result) == 0:
+                break
+        return result if result is not None else np.unique(self.objects)
+
+    def group_by(self, attr: str, dbids: np.ndarray = None, limit: int = 20) -> List[Tuple[str, int]]:
+        """
+        Counts the objects by the value of an attribute
+        @param attr: The attribute
+        @param dbids: The optional sorted dbIds the count is restricted to
+        @param limit: The maximum number of values returned
+        @return: The (value, count) pairs, the most frequent first
+        """
+        s = self._slice(attr)
+        values = self.values[s]
+        if dbids is not None:
+            values = values[np.isin(self.dbids[s], dbids, assume_unique=False)]
+        counts = np.bincount(values, minlength=len(self.value_names))
+        top = np.argsort(counts)[::-1][:limit]
+        return [(self.value_names[i], int(counts[i])) for i in top if counts[i] > 0]
+
+
+def _to_float(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+_lock = threading.Lock()
+# the stores by (urn, guid, derivative version)
+_stores: OrderedDict[Tuple[str, str, str], PropertyStore] = OrderedDict()
+MAX_STORES = 4
+
+
+def get_store(urn: str, guid: str, version: str = None) -> PropertyStore:
+    """
+    Returns the store of a viewable, built from the properties cache the first time and then kept next to it. The
+    stores are kept by derivative version, a model translated again is loaded again.
+    @param urn: The base64 encoded URN
+    @param guid: The viewable GUID
+    @param version: The derivative version, read from the manifest if None
+    @return: The store
+    """
+    if version is None:
+        version = model_derivative.get_derivative_version(urn)
+    key = (urn, guid, version)
+    with _lock:
+        if key in _stores:
+            _stores.move_to_end(key)
+            return _stores[key]
+    path = model_derivative.cache_properties(urn, guid)
+    store = PropertyStore.load(path)
+    if store is None:
+        store = PropertyStore.from_objects(model_derivative.read_properties(path))
+        store.save(path)
+    with _lock:
+        # the stores of the older versions of the viewable are never used again
+        for k in [k for k in _stores if k[:2] == key[:2] and k != key]:
+            del _stores[k]
+        _stores[key] = store
+        while len(_stores) > MAX_STORES:
+            _stores.popitem(last=False)
+    return store
@@ -0,0 +1,303 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import heapq
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from shared_reflex_viewer.snapshot import Snapshot
+
+
+@dataclass
+class SearchHit:
+    """A node matching a query with its ancestors from the root down."""
+    id: str
+    name: str
+    is_folder: bool
+    score: float
+    path: List[Tuple[str, str]]
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Returns the trigrams of a lower case text, padded so that the start of the text has its own trigrams
+    @param text: The text
+    @return: The trigrams
+    """
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def match_score(lower: str, q: str) -> float:
+    """
+    Scores an exact match of a query in a name
+    @param lower: The lower case name
+    @param q: The lower case query
+    @return: 1 for the whole name, 0.9 for a prefix, 0.8 for the start of a word, 0.7 for a substring, 0 otherwise
+    """
+    if lower.startswith(q):
+        return 1.0 if len(lower) == len(q) else 0.9
+    if re.search(rf'\b{re.escape(q)}', lower):
+        return 0.8
+    if q in lower:
+        return 0.7
+    return 0.0
+
+
+class NameIndex:
+    """
+    An inverted index over node names supporting prefix, substring and fuzzy queries.
+
+    Substring candidates come from the intersection of the trigram posting lists and are then verified, names
+    shorter than three characters are looked up by the prefix of their words first and then in the trigrams that
+    contain them. At most MAX_CANDIDATES candidates are verified, the names starting with the query first, then those
+    with a word starting with it, then the other substrings, the shortest first.
+    Fuzzy matches are ranked by the Dice coefficient of the trigram sets and only computed when the exact matches do
+    not fill the results.
+    """
+
+    # trigrams shared by more than this fraction of the nodes are skipped by the fuzzy matching
+    COMMON_TRIGRAM = 0.2
+    # the candidates verified by a search at most, a short query can match most of the nodes of a large project
+    MAX_CANDIDATES = 2000
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._nodes: Dict[str, Tuple[Optional[str], str, bool]] = {}
+        self._children: Dict[Optional[str], Set[str]] = {}
+        self._lower: Dict[str, str] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._short: Dict[str, Set[str]] = {}
+        self.snapshot: str = ''
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def add(self, oid: str, parent: Optional[str], name: str, is_folder: bool) -> None:
+        """
+        Adds or renames a node
+        @param oid: The node id
+        @param parent: The id of the parent folder
+        @param name: The display name
+        @param is_folder: True for folders
+        """
+        with self._lock:
+            previous = self._nodes.get(oid)
+            if previous is not None and previous[0] != parent:
+                self._children.get(previous[0], set()).discard(oid)
+            self._nodes[oid] = (parent, name, is_folder)
+            self._children.setdefault(parent, set()).add(oid)
+            if previous is not None:
+                if previous[1] == name:
+                    return
+                self._unindex(oid, self._lower[oid])
+            lower = name.lower()
+            self._lower[oid] = lower
+            for t in trigrams(lower):
+                self._trigrams.setdefault(t, set()).add(oid)
+            for p in self._word_prefixes(lower):
+                self._short.setdefault(p, set()).add(oid)
+
+    def add_listing(self, folder_id: str, contents: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Replaces the contents of a folder with a listing as returned by folders.get_folder_contents, the nodes no
+        longer listed are removed with their sub trees
+        @param folder_id: The folder id
+        @param contents: The "folders" and "items" maps
+        """
+        with self._lock:
+            listed = set(contents['folders']) | set(contents['items'])
+            # a node moved to a folder listed before is already a child of that folder
+            for oid in [i for i in self._children.get(folder_id, ()) if i not in listed]:
+                self.remove(oid)
+            for k, v in contents['folders'].items():
+                self.add(k, folder_id, v['name'], True)
+            for k, v in contents['items'].items():
+                self.add(k, folder_id, v['name'], False)
+
+    def add_snapshot(self, snapshot: Snapshot) -> None:
+        """
+        Adds the nodes of a crawled snapshot, once per snapshot
+        @param snapshot: The snapshot
+        """
+        with self._lock:
+            if self.snapshot == snapshot.created:
+                return
+            self.snapshot = snapshot.created
+            for oid, (parent, name, is_folder) in snapshot.nodes.items():
+                self.add(oid, parent, name, is_folder)
+
+    def remove(self, oid: str) -> None:
+        """
+        Removes a node and the nodes below it, e.g. when a webhook reports that it was deleted
+        @param oid: The node id
+        """
+        with self._lock:
+            if oid not in self._nodes:
+                return
+            self._children.get(self._nodes[oid][0], set()).discard(oid)
+            stack = [oid]
+            while len(stack) > 0:
+                i = stack.pop()
+                if self._nodes.pop(i, None) is None:
+                    continue
+                self._unindex(i, self._lower.pop(i))
+                stack.extend(self._children.pop(i, ()))
+
+    def _unindex(self, oid: str, lower: str) -> None:
+        for t in trigrams(lower):
+            posting = self._trigrams[t]
+            posting.discard(oid)
+            if len(posting) == 0:
+                del self._trigrams[t]
+        for p in self._word_prefixes(lower):
+            posting = self._short[p]
+            posting.discard(oid)
+            if len(posting) == 0:
+                del self._short[p]
+
+    def path(self, oid: str) -> Optional[List[Tuple[str, str]]]:
+        """
+        Returns the ids and names of the ancestors of a node from the root down, the node excluded
+        @param oid: The node id
+        @return: The ancestors, None if the node is not in the index, e.g. removed since it was found
+        """
+        with self._lock:
+            if oid not in self._nodes:
+                return None
+            path = []
+            parent = self._nodes[oid][0]
+            while parent is not None and parent in self._nodes and len(path) < 256:
+                path.append((parent, self._nodes[parent][1]))
+                parent = self._nodes[parent][0]
+            return path[::-1]
+
+    def search(self, query: str, limit: int = 20, fuzzy: bool = True) -> List[SearchHit]:
+        """
+        Returns the nodes whose names match the query, best first
+        @param query: The text to look for, case insensitive
+        @param limit: The maximum number of hits
+        @param fuzzy: If True the results are completed with approximate matches
+        @return: The hits
+        """
+        q = query.strip().lower()
+        if len(q) == 0:
+            return []
+        with self._lock:
+            scores = {}
+            budget = self.MAX_CANDIDATES
+            for tier in self._candidates(q):
+                if len(tier) > budget:
+                    tier = heapq.nsmallest(budget, tier, key=lambda oid: len(self._lower[oid]))
+                for oid in tier:
+                    score = match_score(self._lower[oid], q)
+                    if score > 0:
+                        scores[oid] = score
+                budget -= len(tier)
+                if budget <= 0:
+                    break
+            if fuzzy and len(scores) < limit and len(q) >= 3:
+                for oid, similarity in self._fuzzy(q, limit * 4):
+                    if oid not in scores and similarity >= 0.4:
+                        scores[oid] = 0.6 * similarity
+            best = heapq.nsmallest(limit, scores.items(), key=lambda s: (-s[1], len(self._lower[s[0]]), self._lower[s[0]]))
+            return [SearchHit(id=oid, name=self._nodes[oid][1], is_folder=self._nodes[oid][2], score=score,
+                              path=self.path(oid)) for oid, score in best]
+
+    def _candidates(self, q: str) -> Iterator[Set[str]]:
+        """Yields the candidates of a query in tiers, those likely to start with the query first"""
+        # the padded trigrams of the first characters of a name or of a word, see trigrams
+        name_start = self._trigrams.get(f'  {q[0]}', set())
+        word_start = self._trigrams.get(f' {q[:2]}', set()) if len(q) >= 2 else set()
+        if len(q) < 3:
+            candidates = self._short.get(q, set())
+            starts = candidates & name_start
+            yield starts
+            yield candidates - starts
+            # the substrings inside the words, only looked up when the prefixes leave room for more candidates
+            inside = set()
+            for t, posting in self._trigrams.items():
+                if q in t:
+                    inside |= posting
+            yield inside - candidates
+            return
+        # the padded trigrams only match at the boundaries of a name, a substring can be anywhere
+        inner = [t for t in trigrams(q) if t[0] != ' ' and t[-1] != ' ']
+        postings = sorted((self._trigrams.get(t, set()) for t in inner), key=len)
+        if len(postings) == 0 or len(postings[0]) == 0:
+            return
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates &= p
+            if len(candidates) == 0:
+                return
+        words = candidates & word_start
+        starts = words & name_start
+        yield starts
+        yield words - starts
+        yield candidates - words
+
+    def _fuzzy(self, q: str, limit: int) -> List[Tuple[str, float]]:
+        grams = trigrams(q)
+        common = max(len(self._nodes) * self.COMMON_TRIGRAM, 100)
+        shared = Counter()
+        for t in grams:
+            posting = self._trigrams.get(t, ())
+            if len(posting) <= common:
+                shared.update(posting)
+        results = []
+        for oid, n in shared.most_common(limit):
+            results.append((oid, 2 * n / (len(grams) + len(trigrams(self._lower[oid])))))
+        return results
+
+    @staticmethod
+    def _word_prefixes(lower: str) -> Set[str]:
+        prefixes = set()
+        for word in re.findall(r'\w+', lower):
+            prefixes.add(word[:1])
+            prefixes.add(word[:2])
+        prefixes.add(lower[:1])
+        prefixes.add(lower[:2])
+        return prefixes
+
+
+_lock = threading.Lock()
+_indexes: Dict[Tuple[str, str], NameIndex] = {}
+
+
+def get_index(project_id: str, user: Optional[str]) -> NameIndex:
+    """
+    Returns the index of the nodes a user loaded in a project, shared by all the sessions of the user and seeded
+    with the snapshot the user crawled if there is one
+    @param project_id: The ACC project id
+    @param user: The user id
+    @return: The index, an empty one that is not kept for a user without id
+    """
+    if user is None:
+        return NameIndex()
+    with _lock:
+        index = _indexes.setdefault((project_id, user), NameIndex())
+    snapshot = Snapshot.load(project_id)
+    if snapshot is not None and snapshot.user == user:
+        index.add_snapshot(snapshot)
+    return index
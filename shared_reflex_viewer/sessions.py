@@ -0,0 +1,278 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import decouple
+import numpy as np
+
+from shared_reflex_viewer import dbid_sets
+
+try:
+    from reflex.state import _substate_key
+except ImportError:
+    # the states are keyed by the client token only before reflex 0.4.4
+    _substate_key = lambda token, state: token
+
+
+# maximum number of camera updates per second sent by the presenter and to each follower
+CAMERA_SYNC_RATE = decouple.config('CAMERA_SYNC_RATE', default=10, cast=float)
+# the positions are rounded to this step in model units, the directions to 1e-4 and the field of view to 0.01 degrees
+CAMERA_SYNC_POSITION_STEP = decouple.config('CAMERA_SYNC_POSITION_STEP', default=0.001, cast=float)
+# the sessions without updates from the presenter for this long are closed
+SESSION_IDLE_SECONDS = decouple.config('SESSION_IDLE_SECONDS', default=3600, cast=float)
+
+PRESENTER = 'presenter'
+FOLLOWER = 'follower'
+# the dbId sets shared with the followers
+CHANNELS = ('selected', 'isolated', 'hidden')
+
+
+def encode(seq: int, old: List[int], new: List[int]) -> List[int]:
+    """
+    Encodes the changes from a camera frame to another.
+
+    A frame is the quantized position, target, up vector and field of view of the camera followed by the normal and the
+    distance of every section plane. The update is [seq, length, index, value, index, value, ...] with only the values
+    that changed, the update from an empty frame is the snapshot.
+    @param seq: The sequence number of the update
+    @param old: The frame the receiver has
+    @param new: The frame to send
+    @return: The update
+    """
+    update = [seq, len(new)]
+    for i, v in enumerate(new):
+        if i >= len(old) or old[i] != v:
+            update.extend((i, v))
+    return update
+
+
+def apply(frame: List[int], update: List[int]) -> List[int]:
+    """
+    Applies an update made by encode
+    @param frame: The frame of the receiver
+    @param update: The update
+    @return: The new frame
+    """
+    new = (frame + [0] * update[1])[:update[1]]
+    for i in range(2, len(update) - 1, 2):
+        new[update[i]] = update[i + 1]
+    return new
+
+
+def encode_sets(seq: int, old: Dict[str, np.ndarray], new: Dict[str, np.ndarray]) -> Dict[str, List[str]]:
+    """
+    Encodes the changes from a selection to another.
+
+    The update maps every channel that changed to the dbIds added and removed, encoded by dbid_sets, and "seq" to the
+    sequence number. The update from an empty selection is the snapshot.
+    @param seq: The sequence number of the update
+    @param old: The dbIds by channel the receiver has
+    @param new: The dbIds by channel to send
+    @return: The update, empty if nothing changed
+    """
+    update = {}
+    for channel in CHANNELS:
+        added, removed = dbid_sets.diff(old.get(channel, dbid_sets.EMPTY), new.get(channel, dbid_sets.EMPTY))
+        if len(added) > 0 or len(removed) > 0:
+            update[channel] = [dbid_sets.encode(added), dbid_sets.encode(removed)]
+    if len(update) > 0:
+        update['seq'] = [str(seq)]
+    return update
+
+
+def apply_sets(sets: Dict[str, np.ndarray], update: Dict[str, List[str]]) -> Dict[str, np.ndarray]:
+    """
+    Applies an update made by encode_sets
+    @param sets: The dbIds by channel of the receiver
+    @param update: The update
+    @return: The new dbIds by channel
+    """
+    new = dict(sets)
+    for channel in CHANNELS:
+        if channel in update:
+            added, removed = update[channel]
+            new[channel] = dbid_sets.patch(sets.get(channel, dbid_sets.EMPTY),
+                                           dbid_sets.decode(added), dbid_sets.decode(removed))
+    return new
+
+
+class SharedSession:
+    """
+    A presenter and the followers of its camera and of its selection.
+
+    The presenter updates replace the frame and the selection of the session, a single task sends the latest ones to the
+    followers at most CAMERA_SYNC_RATE times per second, encoded against what each follower received last. The updates
+    made in between are never queued, so a slow follower only skips frames.
+    """
+
+    def __init__(self, session_id: str, presenter: str, state: type, rate: float = CAMERA_SYNC_RATE):
+        self.session_id = session_id
+        self.presenter = presenter
+        self.state = state
+        self.interval = 1 / rate
+        self.urn = ''
+        self.frame: List[int] = []
+        self.sets: Dict[str, np.ndarray] = {}
+        self.seq = 0
+        self.updated = time.monotonic()
+        # the urn, the frame and the selection last sent to every follower
+        self.followers: Dict[str, Tuple[str, List[int], Dict[str, np.ndarray]]] = {}
+        self.sent = 0
+        self.skipped = 0
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def publish(self, update: List[int], urn: str) -> None:
+        if len(update) < 2:
+            return
+        self.frame = apply(self.frame, update)
+        self._changed_by_presenter(urn)
+
+    def publish_selection(self, update: Dict[str, List[str]], urn: str) -> None:
+        self.sets = apply_sets(self.sets, update)
+        self._changed_by_presenter(urn)
+
+    def _changed_by_presenter(self, urn: str) -> None:
+        self.urn = urn
+        self.updated = time.monotonic()
+        if self._changed.is_set():
+            self.skipped += 1
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def join(self, token: str) -> Tuple[str, List[int], Dict[str, List[str]]]:
+        """
+        Adds a follower
+        @param token: The client token of the follower
+        @return: The urn and the snapshots of the camera and of the selection
+        """
+        self.seq += 1
+        self.followers[token] = (self.urn, list(self.frame), self.sets)
+        return self.urn, encode(self.seq, [], self.frame), encode_sets(self.seq, {}, self.sets)
+
+    def leave(self, token: str) -> None:
+        self.followers.pop(token, None)
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), SESSION_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                if time.monotonic() - self.updated >= SESSION_IDLE_SECONDS:
+                    logging.info(f'session {self.session_id} closed after {SESSION_IDLE_SECONDS}s without updates')
+                    self._task = None
+                    await end(self.session_id)
+                    return
+                continue
+            self._changed.clear()
+            started = loop.time()
+            await self._broadcast()
+            await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+
+    async def _broadcast(self) -> None:
+        self.seq += 1
+        urn, frame, sets = self.urn, list(self.frame), self.sets
+        sends = []
+        # the followers that received the same selection share the encoded changes, usually all of them
+        selections: Dict[int, Dict[str, List[str]]] = {}
+        for token, (sent_urn, sent_frame, sent_sets) in list(self.followers.items()):
+            update = encode(self.seq, sent_frame, frame)
+            if id(sent_sets) not in selections:
+                selections[id(sent_sets)] = encode_sets(self.seq, sent_sets, sets) if sent_sets is not sets else {}
+            selection = selections[id(sent_sets)]
+            if len(update) > 2 or len(selection) > 0 or sent_urn != urn:
+                sends.append(self._send(token, urn if sent_urn != urn else None, update if len(update) > 2 else None,
+                                        selection or None))
+                self.followers[token] = (urn, frame, sets)
+        if len(sends) > 0:
+            await asyncio.gather(*sends)
+            self.sent += len(sends)
+
+    async def _send(self, token: str, urn: Optional[str], update: Optional[List[int]],
+                    selection: Optional[Dict[str, List[str]]]) -> None:
+        from shared_reflex_viewer.shared_reflex_viewer import app
+
+        try:
+            async with app.modify_state(_substate_key(token, self.state)) as root:
+                state = await root.get_state(self.state)
+                if state.session_id != self.session_id:
+                    # the follower left or joined another session
+                    self.leave(token)
+                    return
+                state.follow_update(urn, update, selection)
+        except Exception as ex:
+            logging.warning(f'follower {token} of session {self.session_id} dropped: {ex}')
+            self.leave(token)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'followers': len(self.followers), 'seq': self.seq, 'sent': self.sent, 'skipped': self.skipped}
+
+
+_sessions: Dict[str, SharedSession] = {}
+
+
+def start(presenter: str, state: type) -> str:
+    """
+    Opens a session presented by a browser
+    @param presenter: The client token of the presenter
+    @param state: The state class with the follow_update method
+    @return: The session id to share with the followers
+    """
+    session_id = uuid.uuid4().hex[:8]
+    _sessions[session_id] = SharedSession(session_id, presenter, state)
+    return session_id
+
+
+def get_session(session_id: str) -> Optional[SharedSession]:
+    return _sessions.get(session_id)
+
+
+async def end(session_id: str) -> None:
+    """
+    Closes a session and detaches its followers
+    @param session_id: The session id
+    """
+    session = _sessions.pop(session_id, None)
+    if session is None:
+        return
+    session.close()
+    from shared_reflex_viewer.shared_reflex_viewer import app
+
+    for token in list(session.followers):
+        try:
+            async with app.modify_state(_substate_key(token, session.state)) as root:
+                state = await root.get_state(session.state)
+                if state.session_id == session_id:
+                    state.session_id = ''
+                    state.session_role = ''
+        except Exception as ex:
+            logging.warning(f'follower {token} of session {session_id} not detached: {ex}')
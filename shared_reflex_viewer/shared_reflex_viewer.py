@@ -17,13 +17,25 @@ __author__ = "Paolo Emilio Serra - paolo.serra@autodesk.com"
 __copyright__ = "2024"
 __version__ = "1.0.0"
 
+import asyncio
 import logging
 from typing import Any
 
 import reflex as rx
 import urllib
 import aps
+import model_derivative
 from shared_reflex_viewer import styles
+from shared_reflex_viewer import property_store
+from shared_reflex_viewer import model_diff
+from shared_reflex_viewer import sessions
+from shared_reflex_viewer import profiling
+from shared_reflex_viewer import webhooks
+from shared_reflex_viewer import thumbnails
+from shared_reflex_viewer import catalog
+from shared_reflex_viewer import project_search
+from shared_reflex_viewer import derivative_proxy
+from shared_reflex_viewer import spatial_index
 
 from shared_reflex_viewer.document_viewer import viewer
 
@@ -34,24 +46,107 @@ token = aps.token
 class State(rx.State):
     aps_token: str = rx.LocalStorage("{}", name="aps_token")
     urn: str = ''
+    guid: str = ''
+    # the derivative version of the loaded properties, see property_store.get_store
+    _version: str = ''
+    properties_status: str = ''
+    query: str = ''
+    query_status: str = ''
+    group_by: str = 'Category'
+    group_counts: list[tuple[str, int]] = []
+    selection: list[int] = []
+    selection_mode: str = ''
+    compare_urn: str = ''
+    diff_status: str = ''
+    theming: dict[str, list[int]] = {}
     model: str = 'STR'
-
-    models: list[tuple[str, str]] = [
-        ('STR', 'dXJuOmFkc2sud2lwcHJvZDpmcy5maWxlOnZmLm1xNV9mVlJGUjV1SU1Cd29sUHNNLXc_dmVyc2lvbj0x'),
-        ('MEP', 'dXJuOmFkc2sud2lwcHJvZDpmcy5maWxlOnZmLmh5MElubDV6VHA2dGEzUGxOUDlwTEE_dmVyc2lvbj0x')
-    ]
+    session_input: str = ''
+    session_id: str = ''
+    # "presenter", "follower" or "" when the camera is not shared
+    session_role: str = ''
+    session_status: str = ''
+    # the last camera update received from the presenter, see sessions.encode
+    camera_update: list[int] = []
+    # the last selection update received from the presenter, see sessions.encode_sets
+    selection_update: dict[str, list[str]] = {}
+    # the URL the viewer posts the bounds of the elements to, empty when the backend already has them
+    bounds_url: str = ''
+    # the meters of the "near" spatial query
+    spatial_distance: str = '2'
+    spatial_status: str = ''
+
+    # the (label, urn) of the models in the top folders of the projects of the user, see catalog.list_catalog
+    models: list[tuple[str, str]] = []
+    # the files of all the projects matching the search, see project_search.rank
+    search_text: str = ''
+    search_results: list[dict[str, str]] = []
+    search_status: str = ''
 
     def login(self):
         global token
         fp = self.router.page.full_raw_path
         parsed = urllib.parse.urlparse(fp)
         if len(parsed.query) == 0:
-            return
+            return self._show_models()
         code = urllib.parse.parse_qs(parsed.query).get("code", [""])[0]
         if len(code) > 0:
             if not aps.is_token_valid():
-                token = aps.get_3_legged_token(("data:read",), code)
+                token = aps.get_3_legged_token(("data:read", "data:search"), code)
         self.aps_token = repr(token)
+        return self._show_models()
+
+    def _show_models(self):
+        if aps.token.Access is None:
+            return
+        # the catalog of the user of the stored token is listed when the backend starts
+        cached = catalog.peek_catalog(aps.get_user_id())
+        if cached is None:
+            return State.load_catalog
+        self.models = catalog.model_choices(cached)
+
+    @rx.background
+    async def load_catalog(self):
+        """Lists the models of the projects of the user"""
+        try:
+            listed = await asyncio.to_thread(catalog.list_catalog, aps.get_user_id())
+        except Exception as ex:
+            logging.exception(ex)
+            return
+        async with self:
+            self.models = catalog.model_choices(listed)
+
+    def set_search_text(self, text: str):
+        self.search_text = text
+        return State.search_projects
+
+    @rx.background
+    async def search_projects(self):
+        """Searches the files of all the projects, the results are shown as the projects answer"""
+        async with self:
+            text = self.search_text
+            if text.strip() == '':
+                self.search_results = []
+                self.search_status = ''
+                return
+            self.search_status = 'Searching...'
+        results = project_search.search(aps.get_user_id(), text)
+        try:
+            async for progress in results:
+                async with self:
+                    if self.search_text != text:
+                        # a newer search replaced this one
+                        return
+                    self.search_results = progress.hits
+                    status = f'{len(progress.hits)} files, {progress.searched}/{progress.projects} projects'
+                    if progress.errors > 0:
+                        status += f', {progress.errors} not answering'
+                    self.search_status = status + (' (cached)' if progress.cached else '')
+        except Exception as ex:
+            logging.exception(ex)
+            async with self:
+                self.search_status = f'Search failed: {ex}'
+        finally:
+            await results.aclose()
 
     @rx.var
     def access(self) -> str:
@@ -63,8 +158,256 @@ class State(rx.State):
         global token
         return str(token.Expires)
 
+    def _reset_model(self, urn: str):
+        self.urn = urn
+        self.guid = ''
+        self._version = ''
+        self.selection = []
+        self.selection_mode = ''
+        self.group_counts = []
+        self.theming = {}
+        self.diff_status = ''
+        self.bounds_url = ''
+        self.spatial_status = ''
+
     def set_urn(self, e: str):
-        self.urn = e
+        self._reset_model(e)
+        return State.load_properties
+
+    async def present(self):
+        """Shares the camera of this browser in a new session"""
+        await self.leave_session()
+        self.session_id = sessions.start(self.router.session.client_token, State)
+        self.session_role = sessions.PRESENTER
+        self.session_status = f'Presenting session {self.session_id}'
+
+    async def follow(self):
+        """Follows the camera of the session typed in the session input"""
+        session = sessions.get_session(self.session_input.strip())
+        if session is None:
+            self.session_status = f'Session {self.session_input} not found'
+            return
+        await self.leave_session()
+        urn, camera, selection = session.join(self.router.session.client_token)
+        self.session_id = session.session_id
+        self.session_role = sessions.FOLLOWER
+        self.session_status = f'Following session {self.session_id}'
+        self.camera_update = camera
+        self.selection_update = selection
+        if urn != '' and urn != self.urn:
+            self._reset_model(urn)
+            return State.load_properties
+
+    async def leave_session(self):
+        if self.session_role == sessions.PRESENTER:
+            await sessions.end(self.session_id)
+        elif self.session_role == sessions.FOLLOWER:
+            session = sessions.get_session(self.session_id)
+            if session is not None:
+                session.leave(self.router.session.client_token)
+        self.session_id = ''
+        self.session_role = ''
+        self.session_status = ''
+        self.camera_update = []
+        self.selection_update = {}
+
+    def publish_camera(self, update: list[int]):
+        """
+        Receives the camera updates of the presenter, already throttled, quantized and encoded by the viewer
+        @param update: The update, see sessions.encode
+        """
+        session = sessions.get_session(self.session_id)
+        if self.session_role != sessions.PRESENTER or session is None:
+            return
+        session.publish(update, self.urn)
+
+    def publish_selection(self, update: dict[str, list[str]]):
+        """
+        Receives the selected, isolated and hidden dbIds of the presenter, encoded by the viewer
+        @param update: The update, see sessions.encode_sets
+        """
+        session = sessions.get_session(self.session_id)
+        if self.session_role != sessions.PRESENTER or session is None:
+            return
+        try:
+            session.publish_selection(update, self.urn)
+        except ValueError as ex:
+            logging.warning(f'invalid selection update from {self.router.session.client_token}: {ex}')
+
+    def follow_update(self, urn: str | None, camera: list[int] | None, selection: dict[str, list[str]] | None):
+        """
+        Called by the session to update the model, the camera and the selection of a follower
+        @param urn: The model of the presenter, None if it did not change
+        @param camera: The camera update, None if the camera did not change
+        @param selection: The selection update, None if the selection did not change
+        """
+        if urn is not None and urn != self.urn:
+            self._reset_model(urn)
+            self.properties_status = ''
+        if camera is not None:
+            self.camera_update = camera
+        if selection is not None:
+            self.selection_update = selection
+
+    @rx.background
+    async def load_properties(self):
+        """Caches the properties of the viewable of the selected model on disk"""
+        async with self:
+            urn = self.urn
+            self.properties_status = 'Loading properties...'
+        guid, version = '', ''
+        try:
+            guid = await asyncio.to_thread(model_derivative.get_viewable_guid, urn)
+            manifest, stale = await asyncio.to_thread(model_derivative.get_manifest, urn)
+            version = model_derivative.derivative_version(manifest)
+            store = await asyncio.to_thread(property_store.get_store, urn, guid, version)
+            status = f'{len(store.objects)} objects, {len(store)} properties'
+            if stale:
+                status += ' (cached manifest, APS not answering)'
+        except Exception as ex:
+            logging.exception(ex)
+            status = f'Properties not available: {ex}'
+        bounds = ''
+        try:
+            index = await asyncio.to_thread(spatial_index.get_index, urn)
+            if index is None:
+                bounds = spatial_index.bounds_url(urn)
+                spatial = 'Indexing the elements when the model is loaded...'
+            else:
+                spatial = f'{len(index)} elements indexed'
+        except Exception as ex:
+            logging.exception(ex)
+            spatial = f'Spatial index not available: {ex}'
+        async with self:
+            if self.urn == urn:
+                self.guid = guid or ''
+                self._version = version
+                self.properties_status = status
+                self.bounds_url = bounds
+                self.spatial_status = spatial
+
+    def bounds_reported(self, elements: int):
+        """
+        Called by the viewer once the backend indexed the bounds of the elements of the selected model
+        @param elements: The number of elements with geometry
+        """
+        self.bounds_url = ''
+        self.spatial_status = f'{elements} elements indexed'
+
+    @rx.background
+    async def compare(self):
+        """Colors the elements of the selected model added or changed since the model to compare with"""
+        async with self:
+            urn, old_urn = self.urn, self.compare_urn
+            if urn == '' or old_urn == '' or urn == old_urn:
+                return
+            self.diff_status = 'Comparing...'
+
+        def run():
+            old = property_store.get_store(old_urn, model_derivative.get_viewable_guid(old_urn))
+            new = property_store.get_store(urn, model_derivative.get_viewable_guid(urn))
+            return model_diff.diff(old, new)
+
+        try:
+            result = await asyncio.to_thread(run)
+        except Exception as ex:
+            logging.exception(ex)
+            async with self:
+                self.diff_status = f'Comparison failed: {ex}'
+            return
+        async with self:
+            if self.urn != urn:
+                return
+            # the removed elements do not exist in the selected model, they are only counted
+            self.theming = {
+                styles.plant: result.added.tolist(),
+                styles.gold: result.changed.tolist(),
+            }
+            s = result.summary()
+            self.diff_status = f'{s["added"]} added, {s["changed"]} changed, {s["removed"]} removed'
+            if s['unmatched'] > 0:
+                self.diff_status += f', {s["unmatched"]} without external id not compared'
+
+    @rx.background
+    async def apply_query(self, mode: str):
+        """
+        Runs the query on the properties of the selected model and pushes the matching dbIds to the viewer
+        @param mode: "isolate", "highlight", "fit" or "" to clear
+        """
+        async with self:
+            if mode == '' or self.guid == '':
+                self.selection = []
+                self.selection_mode = ''
+                self.group_counts = []
+                self.query_status = ''
+                return
+            urn, guid, version, query, group_by = self.urn, self.guid, self._version or None, self.query, self.group_by
+
+        def run():
+            store = property_store.get_store(urn, guid, version)
+            dbids = store.filter(property_store.parse_query(query))
+            return dbids, store.group_by(group_by, dbids)
+
+        try:
+            dbids, counts = await asyncio.to_thread(run)
+        except ValueError as ex:
+            async with self:
+                self.query_status = str(ex)
+            return
+        except Exception as ex:
+            logging.exception(ex)
+            async with self:
+                self.query_status = f'Query failed: {ex}'
+            return
+        async with self:
+            if self.urn != urn:
+                return
+            self.selection = dbids.tolist()
+            self.selection_mode = mode
+            self.group_counts = counts
+            self.query_status = f'{len(dbids)} elements'
+
+    @rx.background
+    async def apply_spatial(self, mode: str):
+        """
+        Isolates the elements around the selected ones, e.g. the elements in a room found by the query
+        @param mode: "inside" the box of the selection, "near" within the distance from it or the "nearest" ones
+        """
+        async with self:
+            urn, selection = self.urn, list(self.selection)
+            try:
+                distance = float(self.spatial_distance)
+            except ValueError:
+                self.spatial_status = f'Invalid distance: {self.spatial_distance}'
+                return
+            if len(selection) == 0:
+                self.spatial_status = 'Select the elements to start from with the query first'
+                return
+
+        def run():
+            index = spatial_index.get_index(urn)
+            if index is None:
+                raise ValueError('The elements of the model are not indexed yet')
+            if mode == 'inside':
+                return index.inside(selection)
+            if mode == 'near':
+                return index.near(selection, distance)
+            return index.nearest_to(selection)
+
+        try:
+            found = await asyncio.to_thread(run)
+        except Exception as ex:
+            logging.exception(ex)
+            async with self:
+                self.spatial_status = str(ex)
+            return
+        async with self:
+            if self.urn != urn:
+                return
+            # the elements the query started from stay visible
+            self.selection = sorted(set(selection) | set(found.tolist()))
+            self.selection_mode = 'isolate'
+            self.spatial_status = f'{len(found)} elements {mode}'
 
 
 def create_viewer_old(urn: str) -> rx.Component:
@@ -137,6 +480,19 @@ def create_viewer() -> rx.Component:
         access=State.access,
         expires=State.expires,
         urn=State.urn,
+        selection=State.selection,
+        selection_mode=State.selection_mode,
+        theming=State.theming,
+        camera_role=State.session_role,
+        camera_update=State.camera_update,
+        camera_interval=int(1000 / sessions.CAMERA_SYNC_RATE),
+        camera_step=sessions.CAMERA_SYNC_POSITION_STEP,
+        selection_update=State.selection_update,
+        derivative_proxy=derivative_proxy.proxy_url(),
+        bounds_url=State.bounds_url,
+        on_camera_change=State.publish_camera,
+        on_selection_change=State.publish_selection,
+        on_bounds_report=State.bounds_reported,
         width="100%",
         height="600px",
     )
@@ -161,7 +517,7 @@ def menu_button() -> rx.Component:
             rx.chakra.menu_list(
                 rx.chakra.menu_item(
                     rx.chakra.text('Log In'),
-                    on_click=rx.redirect(aps.get_code_address(('data:read', )), external=False)
+                    on_click=rx.redirect(aps.get_code_address(('data:read', 'data:search')), external=False)
                 ),
                 rx.chakra.menu_divider(),
                 rx.chakra.menu_item(
@@ -176,13 +532,156 @@ def menu_button() -> rx.Component:
     )
 
 
+def query_bar() -> rx.Component:
+    """The property query of the selected model, e.g. "Category = Revit Ducts and System Type ~ Supply".
+
+    Returns:
+        The query bar component.
+    """
+    return rx.chakra.vstack(
+        rx.chakra.hstack(
+            rx.chakra.input(
+                placeholder='Category = Revit Ducts and System Type ~ Supply',
+                value=State.query,
+                on_change=State.set_query,
+            ),
+            rx.chakra.button('Isolate', on_click=State.apply_query('isolate')),
+            rx.chakra.button('Highlight', on_click=State.apply_query('highlight')),
+            rx.chakra.button('Fit', on_click=State.apply_query('fit')),
+            rx.chakra.button('Clear', on_click=State.apply_query('')),
+        ),
+        rx.chakra.hstack(
+            rx.chakra.text(State.query_status),
+            rx.foreach(
+                State.group_counts,
+                lambda c: rx.chakra.badge(f'{c[0]}: {c[1]}')
+            ),
+        ),
+        width='100%',
+    )
+
+
+def model_item(model: rx.Var) -> rx.Component:
+    """
+    An item of the model pickers with the thumbnail of the model, loaded when the list is opened.
+
+    Returns:
+        The select item component.
+    """
+    return rx.select.item(
+        rx.chakra.hstack(
+            rx.image(src=thumbnails.thumbnail_url(model[1]), loading='lazy', width='50px', height='50px',
+                     alt=''),
+            rx.chakra.text(model[0]),
+        ),
+        value=model[1],
+    )
+
+
+def compare_bar() -> rx.Component:
+    """Compares the selected model with another version, added elements are green and changed ones gold.
+
+    Returns:
+        The compare bar component.
+    """
+    return rx.chakra.hstack(
+        rx.select.root(
+            rx.select.trigger(placeholder='Compare with'),
+            rx.select.content(
+                rx.select.group(
+                    rx.foreach(
+                        State.models,
+                        model_item
+                    )
+                )
+            ),
+            on_change=State.set_compare_urn,
+        ),
+        rx.chakra.button('Compare', on_click=State.compare),
+        rx.chakra.text(State.diff_status),
+    )
+
+
+def spatial_bar() -> rx.Component:
+    """Isolates the elements inside, near or nearest to the elements found by the query.
+
+    Returns:
+        The spatial bar component.
+    """
+    return rx.chakra.hstack(
+        rx.chakra.button('Inside', on_click=State.apply_spatial('inside')),
+        rx.chakra.input(
+            value=State.spatial_distance,
+            on_change=State.set_spatial_distance,
+            width='5em',
+        ),
+        rx.chakra.button('Near (m)', on_click=State.apply_spatial('near')),
+        rx.chakra.button('Nearest', on_click=State.apply_spatial('nearest')),
+        rx.chakra.text(State.spatial_status),
+    )
+
+
+def session_bar() -> rx.Component:
+    """Presents the camera of this browser to the others, or follows the camera of a presenter.
+
+    Returns:
+        The session bar component.
+    """
+    return rx.chakra.hstack(
+        rx.chakra.input(
+            placeholder='Session',
+            value=State.session_input,
+            on_change=State.set_session_input,
+            width='12em',
+        ),
+        rx.chakra.button('Present', on_click=State.present),
+        rx.chakra.button('Follow', on_click=State.follow),
+        rx.chakra.button('Leave', on_click=State.leave_session),
+        rx.chakra.text(State.session_status),
+    )
+
+
+def search_bar() -> rx.Component:
+    """Searches the files of all the projects of the user and opens the one clicked.
+
+    Returns:
+        The search bar component.
+    """
+    return rx.chakra.vstack(
+        rx.chakra.hstack(
+            rx.debounce_input(
+                rx.chakra.input(
+                    placeholder='Search all projects',
+                    value=State.search_text,
+                    on_change=State.set_search_text,
+                    width='24em',
+                ),
+                debounce_timeout=300,
+            ),
+            rx.chakra.text(State.search_status),
+        ),
+        rx.foreach(
+            State.search_results,
+            lambda h: rx.chakra.button(
+                f'{h["name"]} - {h["project"]}',
+                variant='ghost',
+                size='sm',
+                is_disabled=h['urn'] == '',
+                on_click=State.set_urn(h['urn']),
+            )
+        ),
+        align_items='start',
+        max_height='300px',
+        overflow_y='auto',
+    )
+
+
 def get_style_sheet() -> rx.Component:
     return rx.html('<link rel="stylesheet" href="https://developer.api.autodesk.com/modelderivative/v2/viewers/7.*/style.min.css" type="text/css">')
 
 
-def index() -> rx.Component:
-    global token
-    return rx.chakra.vstack(
+def get_viewer_scripts() -> rx.Component:
+    return rx.fragment(
         rx.script(
             src="https://developer.api.autodesk.com/viewingservice/v2/viewers/three.min.js",
             strategy="beforeInteractive",
@@ -192,6 +691,13 @@ def index() -> rx.Component:
             strategy="beforeInteractive",
         ),
         get_style_sheet(),
+    )
+
+
+def index() -> rx.Component:
+    global token
+    return rx.chakra.vstack(
+        get_viewer_scripts(),
         rx.fragment(
             rx.chakra.heading("APS Viewer", font_size="2em"),
             rx.select.root(
@@ -200,12 +706,18 @@ def index() -> rx.Component:
                     rx.select.group(
                         rx.foreach(
                             State.models,
-                            lambda x: rx.select.item(x[0], value=x[1])
+                            model_item
                         )
                     )
                 ),
                 on_change=State.set_urn,
             ),
+            rx.chakra.text(State.properties_status),
+            query_bar(),
+            spatial_bar(),
+            search_bar(),
+            compare_bar(),
+            session_bar(),
             menu_button(),
         ),
         create_viewer(),
@@ -216,3 +728,9 @@ def index() -> rx.Component:
 # Create app instance and add index page.
 app = rx.App()
 app.add_page(index, route='/', description='Autodesk Consulting', title='APS Viewer')
+app.api.add_api_route('/api/webhooks', webhooks.receive, methods=['POST'])
+app.api.add_api_route('/api/thumbnails/{urn}', thumbnails.serve, methods=['GET'])
+app.api.add_api_route('/api/bounds/{urn}', spatial_index.receive, methods=['POST'])
+profiling.install(app)
+catalog.install(app)
+derivative_proxy.install(app)
@@ -0,0 +1,231 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import decouple
+
+
+SNAPSHOT_DIR = pathlib.Path(decouple.config(
+    'SNAPSHOT_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.snapshots')
+))
+# the seconds the fresh listings merged into a snapshot wait before the snapshot is saved, the saves are coalesced
+SNAPSHOT_SAVE_SECONDS = decouple.config('SNAPSHOT_SAVE_SECONDS', default=30, cast=float)
+
+# id -> (parent id, name, is folder)
+Nodes = Dict[str, Tuple[Optional[str], str, bool]]
+
+
+def snapshot_path(project_id: str) -> pathlib.Path:
+    return SNAPSHOT_DIR / f'{project_id}.jsonl.gz'
+
+
+def checkpoint_path(project_id: str) -> pathlib.Path:
+    return SNAPSHOT_DIR / f'{project_id}.checkpoint.jsonl.gz'
+
+
+def write_nodes(path: pathlib.Path, header: Dict[str, Any], nodes: Nodes) -> None:
+    """
+    Writes a gzipped JSON lines file, the header first and then one [id, parent, name, is_folder] array per node
+    @param path: The destination file, replaced atomically
+    @param header: The metadata of the file
+    @param nodes: The nodes by id
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # the merges and the crawler can save the same snapshot at the same time from different threads
+    temp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with gzip.open(temp, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+            for oid, (parent, name, is_folder) in nodes.items():
+                f.write(json.dumps([oid, parent, name, is_folder], separators=(',', ':')) + '\n')
+        os.replace(temp, path)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+def read_nodes(path: pathlib.Path) -> Tuple[Dict[str, Any], Nodes]:
+    """
+    Reads a file written by write_nodes
+    @param path: The file
+    @return: The header and the nodes by id
+    """
+    nodes = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        for line in f:
+            oid, parent, name, is_folder = json.loads(line)
+            nodes[oid] = (parent, name, is_folder)
+    return header, nodes
+
+
+@dataclass
+class Snapshot:
+    """The folder hierarchy of a project as crawled by a user."""
+    project_id: str
+    root_id: str
+    user: str
+    created: str
+    nodes: Nodes
+    # the folders whose contents were listed, the others were still pending when the snapshot was taken
+    listed: set = field(default_factory=set)
+    # the folders the crawl failed to list, their sub trees are missing until they are listed again
+    failed: set = field(default_factory=set)
+    children: Dict[str, List[str]] = field(default_factory=dict)
+    _lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    def __post_init__(self):
+        for oid, (parent, _, _) in self.nodes.items():
+            if parent is not None:
+                self.children.setdefault(parent, []).append(oid)
+
+    def listing(self, folder_id: str, user: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Returns the contents of a folder in the format of folders.fetch_folder_contents
+        @param folder_id: The folder id
+        @param user: The user browsing the folder, only the user that crawled the project can see the snapshot
+        @return: The contents or None if the folder is not in the snapshot
+        """
+        if user != self.user or folder_id not in self.listed:
+            return None
+        contents = {'folders': {}, 'items': {}}
+        with self._lock:
+            for oid in self.children.get(folder_id, []):
+                _, name, is_folder = self.nodes[oid]
+                contents['folders' if is_folder else 'items'][oid] = {'name': name}
+        return contents
+
+    @property
+    def complete(self) -> bool:
+        return len(self.failed) == 0
+
+    def merge_listing(self, folder_id: str, contents: Dict[str, Dict[str, Any]], user: str) -> bool:
+        """
+        Replaces the contents of a folder with a fresh listing and saves the snapshot a little later. The nodes that
+        are no longer listed are removed with their sub trees, the nodes listed elsewhere before are moved.
+        @param folder_id: The folder id
+        @param contents: The "folders" and "items" maps of folders.fetch_folder_contents
+        @param user: The user the folder was listed for, only the listings of the user that crawled the project count
+        @return: True if the snapshot changed
+        """
+        if user != self.user:
+            return False
+        fresh = {k: (folder_id, v['name'], True) for k, v in contents['folders'].items()}
+        fresh.update({k: (folder_id, v['name'], False) for k, v in contents['items'].items()})
+        with self._lock:
+            if folder_id not in self.nodes:
+                return False
+            old = self.children.get(folder_id, [])
+            unchanged = len(old) == len(fresh) and all(self.nodes.get(k) == v for k, v in fresh.items())
+            if folder_id in self.listed and unchanged:
+                return False
+            for oid in old:
+                if oid not in fresh:
+                    self._drop(oid)
+            for oid, node in fresh.items():
+                parent = self.nodes.get(oid, (folder_id,))[0]
+                if parent != folder_id and parent in self.children:
+                    self.children[parent].remove(oid)
+                self.nodes[oid] = node
+            self.children[folder_id] = list(fresh)
+            self.listed.add(folder_id)
+            self.failed.discard(folder_id)
+        _save_later(self)
+        return True
+
+    def _drop(self, oid: str) -> None:
+        stack = [oid]
+        while len(stack) > 0:
+            i = stack.pop()
+            self.nodes.pop(i, None)
+            self.listed.discard(i)
+            self.failed.discard(i)
+            stack.extend(self.children.pop(i, []))
+
+    def save(self) -> None:
+        with self._lock:
+            header = {'project_id': self.project_id, 'root_id': self.root_id, 'user': self.user,
+                      'created': self.created, 'listed': sorted(self.listed), 'failed': sorted(self.failed)}
+            nodes = dict(self.nodes)
+        write_nodes(snapshot_path(self.project_id), header, nodes)
+        with _lock:
+            _snapshots[self.project_id] = (snapshot_path(self.project_id).stat().st_mtime, self)
+
+    @classmethod
+    def create(cls, project_id: str, root_id: str, user: str, nodes: Nodes, listed: Iterable[str],
+               failed: Iterable[str] = ()) -> 'Snapshot':
+        return Snapshot(project_id=project_id, root_id=root_id, user=user, created=str(datetime.datetime.now()),
+                        nodes=nodes, listed=set(listed), failed=set(failed))
+
+    @classmethod
+    def load(cls, project_id: str) -> Optional['Snapshot']:
+        """
+        Returns the snapshot of the project, kept in memory until the file changes
+        @param project_id: The ACC project id
+        @return: The snapshot or None if the project was never crawled
+        """
+        path = snapshot_path(project_id)
+        if not path.exists():
+            return None
+        mtime = path.stat().st_mtime
+        with _lock:
+            cached = _snapshots.get(project_id)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        header, nodes = read_nodes(path)
+        snapshot = Snapshot(project_id=header['project_id'], root_id=header['root_id'], user=header['user'],
+                            created=header['created'], nodes=nodes, listed=set(header['listed']),
+                            failed=set(header.get('failed', [])))
+        with _lock:
+            _snapshots[project_id] = (mtime, snapshot)
+        return snapshot
+
+
+_lock = threading.Lock()
+_snapshots: Dict[str, Tuple[float, Snapshot]] = {}
+# the snapshots waiting to be saved after a merge
+_saves: Dict[str, threading.Timer] = {}
+
+
+def _save_later(snapshot: Snapshot) -> None:
+    def save():
+        with _lock:
+            _saves.pop(snapshot.project_id, None)
+        try:
+            snapshot.save()
+        except OSError as ex:
+            logging.warning(f'snapshot of {snapshot.project_id} not saved: {ex}')
+
+    with _lock:
+        if snapshot.project_id in _saves:
+            return
+        timer = threading.Timer(SNAPSHOT_SAVE_SECONDS, save)
+        timer.daemon = True
+        _saves[snapshot.project_id] = timer
+    timer.start()
@@ -0,0 +1,451 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+The spatial index of the elements of a model, for questions like "which elements lie inside this room" or "what is
+within 2 m of this pipe".
+
+The viewer computes the world bounding box of every element with geometry once, after the model is loaded, and posts
+them to the backend, which keeps them per URN and derivative version. The queries return dbIds the viewer can isolate.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import decouple
+import numpy as np
+
+import model_derivative
+from shared_reflex_viewer import derivative_proxy
+
+
+SPATIAL_DIR = pathlib.Path(decouple.config(
+    'SPATIAL_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.spatial')
+))
+# the largest number of element bounds accepted from a viewer
+SPATIAL_MAX_ELEMENTS = decouple.config('SPATIAL_MAX_ELEMENTS', default=5_000_000, cast=int)
+# the number of children of a node of the tree
+NODE_CAPACITY = 16
+# the float64 header of the bounds posted by the viewer: count, meters per model unit and global offset
+HEADER_SIZE = 5
+MAX_INDEXES = 4
+
+
+def _centers(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, :3] + boxes[:, 3:]) * 0.5
+
+
+def _str_order(boxes: np.ndarray, capacity: int) -> np.ndarray:
+    """
+    Returns the Sort-Tile-Recursive order of boxes: the boxes are cut in slabs along x, every slab in slabs along y
+    and every one of those is sorted along z, so that every run of `capacity` boxes is a compact node
+    @param boxes: The (n, 6) boxes
+    @param capacity: The number of boxes of a node
+    @return: The permutation of the boxes
+    """
+    n = len(boxes)
+    centers = _centers(boxes)
+    slabs = max(1, int(np.ceil(np.ceil(n / capacity) ** (1 / 3))))
+    x = np.empty(n, dtype=np.int64)
+    x[np.argsort(centers[:, 0], kind='stable')] = np.arange(n) * slabs // n
+    order = np.lexsort((centers[:, 1], x))
+    # the rank of every box along y within its x slab
+    sizes = np.bincount(x, minlength=slabs)
+    first = np.cumsum(sizes) - sizes
+    sorted_x = x[order]
+    y = np.empty(n, dtype=np.int64)
+    y[order] = (np.arange(n) - first[sorted_x]) * slabs // np.maximum(sizes[sorted_x], 1)
+    return np.lexsort((centers[:, 2], y, x))
+
+
+def _expand(first: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """Returns the concatenated ranges [first, first + count)"""
+    offsets = np.cumsum(count) - count
+    return np.repeat(first - offsets, count) + np.arange(int(count.sum()))
+
+
+def box_distance(boxes: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """Returns the distances between boxes and a box, 0 where they touch"""
+    gap = np.maximum(np.maximum(box[:3] - boxes[:, 3:], boxes[:, :3] - box[3:]), 0)
+    return np.sqrt((gap * gap).sum(axis=1))
+
+
+def _farthest_distance(boxes: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """Returns the largest distance between a box and the points of boxes, every element of a node is closer"""
+    gap = np.maximum(np.maximum(box[:3] - boxes[:, :3], boxes[:, 3:] - box[3:]), 0)
+    return np.sqrt((gap * gap).sum(axis=1))
+
+
+def ray_entry(boxes: np.ndarray, origin: np.ndarray, inverse: np.ndarray, max_distance: float) -> np.ndarray:
+    """Returns the distances along a ray where it enters boxes, inf for the boxes it misses"""
+    with np.errstate(invalid='ignore'):
+        t1 = (boxes[:, :3] - origin) * inverse
+        t2 = (boxes[:, 3:] - origin) * inverse
+    # a ray parallel to an axis and inside the slab of a box gives 0 * inf, it never leaves that slab
+    near = np.where(np.isnan(t1), -np.inf, np.minimum(t1, t2)).max(axis=1)
+    far = np.where(np.isnan(t1), np.inf, np.maximum(t1, t2)).min(axis=1)
+    near = np.maximum(near, 0)
+    return np.where((near <= far) & (near <= max_distance), near, np.inf)
+
+
+class SpatialIndex:
+    """
+    A packed R-tree of the bounding boxes of the elements of a model, bulk loaded with Sort-Tile-Recursive.
+
+    The boxes are float32 rows of min x, y, z and max x, y, z in meters, relative to the global offset of the model.
+    Every level of the tree is a set of arrays and the children of a node are a contiguous range of the level below,
+    so a query visits the tree one level at a time testing all the candidate nodes of a level in one vectorized step.
+    """
+
+    def __init__(self, dbids: np.ndarray, boxes: np.ndarray, offset: Sequence[float] = (0, 0, 0),
+                 capacity: int = NODE_CAPACITY):
+        order = _str_order(boxes, capacity) if len(boxes) > 0 else np.arange(0)
+        self.dbids = np.ascontiguousarray(dbids[order], dtype=np.int32)
+        self.boxes = np.ascontiguousarray(boxes[order], dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.capacity = capacity
+        self._rows = np.argsort(self.dbids, kind='stable')
+        # the levels from the leaves up: the boxes of the nodes, their first child, their number of children and of
+        # elements, the children of the leaves are the elements
+        self.levels: List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+        boxes, elements = self.boxes, np.ones(len(self.boxes), dtype=np.int64)
+        while len(boxes) > capacity:
+            first = np.arange(0, len(boxes), capacity)
+            count = np.diff(np.append(first, len(boxes)))
+            nodes = np.concatenate((np.minimum.reduceat(boxes[:, :3], first), np.maximum.reduceat(boxes[:, 3:], first)),
+                                   axis=1)
+            elements = np.add.reduceat(elements, first)
+            # the nodes are sorted for the level above, their children stay where they are
+            order = _str_order(nodes, capacity)
+            boxes, first, count, elements = nodes[order], first[order], count[order], elements[order]
+            self.levels.append((boxes, first, count, elements))
+
+    def __len__(self) -> int:
+        return len(self.dbids)
+
+    def _search(self, test: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        Returns the rows of the elements whose boxes pass a test, the test must pass for every box containing them
+        @param test: Returns a boolean per box
+        @return: The rows of the elements
+        """
+        if len(self.levels) == 0:
+            rows = np.arange(len(self.boxes))
+        else:
+            rows = np.arange(len(self.levels[-1][0]))
+            for boxes, first, count, _ in reversed(self.levels):
+                rows = rows[test(boxes[rows])]
+                rows = _expand(first[rows], count[rows])
+        return rows[test(self.boxes[rows])]
+
+    def query_box(self, box: Sequence[float], contained: bool = False) -> np.ndarray:
+        """
+        Returns the elements inside a box
+        @param box: The min x, y, z and max x, y, z
+        @param contained: True for the elements completely inside the box, False for those touching it
+        @return: The sorted dbIds
+        """
+        box = np.asarray(box, dtype=np.float32)
+
+        def overlaps(boxes: np.ndarray) -> np.ndarray:
+            return np.all((boxes[:, :3] <= box[3:]) & (boxes[:, 3:] >= box[:3]), axis=1)
+
+        rows = self._search(overlaps)
+        if contained:
+            inside = self.boxes[rows]
+            rows = rows[np.all((inside[:, :3] >= box[:3]) & (inside[:, 3:] <= box[3:]), axis=1)]
+        return np.sort(self.dbids[rows])
+
+    def within(self, box: Sequence[float], distance: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the elements within a distance from a box
+        @param box: The min x, y, z and max x, y, z
+        @param distance: The distance in meters
+        @return: The dbIds and their distances, the closest first
+        """
+        box = np.asarray(box, dtype=np.float32)
+        rows = self._search(lambda boxes: box_distance(boxes, box) <= distance)
+        distances = box_distance(self.boxes[rows], box)
+        order = np.argsort(distances, kind='stable')
+        return self.dbids[rows[order]], distances[order]
+
+    def ray(self, origin: Sequence[float], direction: Sequence[float],
+            max_distance: float = np.inf) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the elements whose boxes a ray crosses
+        @param origin: The start of the ray
+        @param direction: The direction of the ray, not necessarily normalized
+        @param max_distance: The length of the ray in meters
+        @return: The dbIds and the distances where the ray enters their boxes, the closest first
+        """
+        origin = np.asarray(origin, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64)
+        direction = direction / np.linalg.norm(direction)
+        with np.errstate(divide='ignore'):
+            inverse = 1 / direction
+        rows = self._search(lambda boxes: ray_entry(boxes, origin, inverse, max_distance) < np.inf)
+        distances = ray_entry(self.boxes[rows], origin, inverse, max_distance)
+        order = np.argsort(distances, kind='stable')
+        return self.dbids[rows[order]], distances[order].astype(np.float32)
+
+    def nearest(self, box: Sequence[float], k: int = 10,
+                max_distance: float = np.inf) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the elements closest to a box or to a point. At every level the nodes farther than the k-th closest
+        elements can be are dropped, the bound comes from the farthest distance of the nodes and their sizes.
+        @param box: The min x, y, z and max x, y, z, or the x, y, z of a point
+        @param k: The number of elements
+        @param max_distance: The largest distance in meters
+        @return: The dbIds and their distances, the closest first
+        """
+        box = np.asarray(box, dtype=np.float32)
+        if len(box) == 3:
+            box = np.concatenate((box, box))
+        if len(self.levels) == 0:
+            rows = np.arange(len(self.boxes))
+        else:
+            rows = np.arange(len(self.levels[-1][0]))
+            for boxes, first, count, elements in reversed(self.levels):
+                nodes = boxes[rows]
+                farthest = _farthest_distance(nodes, box)
+                order = np.argsort(farthest)
+                enough = np.searchsorted(np.cumsum(elements[rows][order]), k)
+                bound = min(farthest[order[enough]] if enough < len(order) else np.inf, max_distance)
+                rows = rows[box_distance(nodes, box) <= bound]
+                rows = _expand(first[rows], count[rows])
+        distances = box_distance(self.boxes[rows], box)
+        keep = distances <= max_distance
+        rows, distances = rows[keep], distances[keep]
+        if len(rows) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[top], distances[top]
+        order = np.argsort(distances, kind='stable')
+        return self.dbids[rows[order]], distances[order]
+
+    def bounds(self, dbids: Sequence[int]) -> Optional[np.ndarray]:
+        """
+        Returns the box around some elements
+        @param dbids: The dbIds
+        @return: The min x, y, z and max x, y, z, None if no element has geometry
+        """
+        boxes = self.element_boxes(dbids)
+        if len(boxes) == 0:
+            return None
+        return np.concatenate((boxes[:, :3].min(axis=0), boxes[:, 3:].max(axis=0)))
+
+    def element_boxes(self, dbids: Sequence[int]) -> np.ndarray:
+        """Returns the boxes of the elements with geometry among some dbIds"""
+        dbids = np.asarray(dbids, dtype=np.int32)
+        if len(self._rows) == 0:
+            return self.boxes[:0]
+        positions = np.minimum(np.searchsorted(self.dbids, dbids, sorter=self._rows), len(self._rows) - 1)
+        rows = self._rows[positions]
+        return self.boxes[rows[self.dbids[rows] == dbids]]
+
+    def near(self, dbids: Sequence[int], distance: float) -> np.ndarray:
+        """
+        Returns the elements within a distance from any of some elements, without them
+        @param dbids: The dbIds of the reference elements
+        @param distance: The distance in meters
+        @return: The sorted dbIds
+        """
+        found = [self.within(box, distance)[0] for box in self.element_boxes(dbids)]
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.setdiff1d(np.unique(np.concatenate(found)), dbids)
+
+    def inside(self, dbids: Sequence[int]) -> np.ndarray:
+        """
+        Returns the elements completely inside the box around some elements, e.g. a room or a level, without them
+        @param dbids: The dbIds of the reference elements
+        @return: The sorted dbIds
+        """
+        box = self.bounds(dbids)
+        if box is None:
+            return np.zeros(0, dtype=np.int32)
+        return np.setdiff1d(self.query_box(box, contained=True), dbids)
+
+    def nearest_to(self, dbids: Sequence[int], k: int = 10) -> np.ndarray:
+        """
+        Returns the elements closest to the box around some elements, without them
+        @param dbids: The dbIds of the reference elements
+        @param k: The number of elements
+        @return: The dbIds, the closest first
+        """
+        box = self.bounds(dbids)
+        if box is None:
+            return np.zeros(0, dtype=np.int32)
+        found, _ = self.nearest(box, k + len(dbids))
+        return found[~np.isin(found, dbids)][:k]
+
+    def save(self, path: pathlib.Path) -> None:
+        # written aside and then renamed, the readers never see a partial file, several viewers can post the bounds
+        # of the same version at the same time
+        temp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with temp.open('wb') as f:
+                np.savez(f, dbids=self.dbids, boxes=self.boxes, offset=self.offset)
+            temp.replace(path)
+        finally:
+            temp.unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional['SpatialIndex']:
+        if not path.exists():
+            return None
+        arrays = np.load(path)
+        return cls(arrays['dbids'], arrays['boxes'], arrays['offset'])
+
+
+def parse_bounds(body: bytes) -> SpatialIndex:
+    """
+    Builds the index of the bounds posted by the viewer: a float64 header with the number of elements, the meters per
+    model unit and the global offset, then the int32 dbIds and the float32 world boxes in model units
+    @param body: The little endian request body
+    @return: The index
+    @raise ValueError: If the body is malformed
+    """
+    if len(body) < HEADER_SIZE * 8:
+        raise ValueError('The bounds have no header')
+    header = np.frombuffer(body, dtype='<f8', count=HEADER_SIZE)
+    n, scale = int(header[0]), float(header[1])
+    if n < 0 or n > SPATIAL_MAX_ELEMENTS:
+        raise ValueError(f'{n} elements, at most {SPATIAL_MAX_ELEMENTS} are accepted')
+    if len(body) != HEADER_SIZE * 8 + 28 * n:
+        raise ValueError(f'{len(body)} bytes do not hold the bounds of {n} elements')
+    if not np.isfinite(scale) or scale <= 0:
+        raise ValueError(f'Invalid unit scale {scale}')
+    dbids = np.frombuffer(body, dtype='<i4', count=n, offset=HEADER_SIZE * 8).astype(np.int32)
+    boxes = np.frombuffer(body, dtype='<f4', count=6 * n, offset=HEADER_SIZE * 8 + 4 * n).reshape(n, 6)
+    valid = np.all(np.isfinite(boxes), axis=1) & np.all(boxes[:, :3] <= boxes[:, 3:], axis=1)
+    return SpatialIndex(dbids[valid], (boxes[valid] * scale).astype(np.float32), header[2:] * scale)
+
+
+def bounds_path(urn: str, version: str) -> pathlib.Path:
+    key = hashlib.sha1(f'{urn}:{version}'.encode('utf-8')).hexdigest()
+    return SPATIAL_DIR / f'{key}.npz'
+
+
+def has_bounds(urn: str, version: str) -> bool:
+    return (urn, version) in _indexes or bounds_path(urn, version).exists()
+
+
+_lock = threading.Lock()
+_indexes: OrderedDict[Tuple[str, str], SpatialIndex] = OrderedDict()
+
+
+def _keep(key: Tuple[str, str], index: SpatialIndex) -> None:
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+
+
+def get_index(urn: str, version: str = None) -> Optional[SpatialIndex]:
+    """
+    Returns the index of a model, built from the bounds saved by a viewer the first time and then kept in memory
+    @param urn: The base64 encoded URN
+    @param version: The derivative version, the current one if None
+    @return: The index, None if no viewer reported the bounds of this version yet
+    """
+    if version is None:
+        version = model_derivative.get_derivative_version(urn)
+    key = (urn, version)
+    with _lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    index = SpatialIndex.load(bounds_path(urn, version))
+    if index is not None:
+        _keep(key, index)
+    return index
+
+
+def store_bounds(urn: str, version: str, body: bytes) -> SpatialIndex:
+    """
+    Indexes and saves the bounds of a model version
+    @param urn: The base64 encoded URN
+    @param version: The derivative version
+    @param body: The bounds posted by the viewer, see parse_bounds
+    @return: The index
+    """
+    index = parse_bounds(body)
+    SPATIAL_DIR.mkdir(parents=True, exist_ok=True)
+    index.save(bounds_path(urn, version))
+    _keep((urn, version), index)
+    return index
+
+
+def bounds_url(urn: str) -> str:
+    """Returns the URL the viewer posts the bounds of a model to"""
+    import reflex as rx
+
+    return f'{rx.config.get_config().api_url}/api/bounds/{urn}'
+
+
+async def _read_body(request: Any, limit: int) -> Optional[bytes]:
+    """Returns the body of a request, None if it is larger than the limit, also when it is chunked"""
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def receive(request: Any) -> Any:
+    """
+    The endpoint of the bounds posted by the viewer, the token of the viewer must be able to read the model
+    @param request: The starlette request
+    @return: The JSON response with the number of indexed elements
+    """
+    from starlette.responses import JSONResponse, Response
+
+    urn = request.path_params['urn']
+    authorization = request.headers.get('authorization', '')
+    if authorization == '':
+        return Response(status_code=401)
+    limit = HEADER_SIZE * 8 + 28 * SPATIAL_MAX_ELEMENTS
+    length = request.headers.get('content-length', '')
+    if length.isdigit() and int(length) > limit:
+        return Response(status_code=413)
+    try:
+        manifest = await asyncio.to_thread(derivative_proxy.authorize, urn, authorization)
+    except Exception as ex:
+        status = getattr(getattr(ex, 'response', None), 'status_code', None)
+        return Response(status_code=status if status in (401, 403, 404) else 502)
+    body = await _read_body(request, limit)
+    if body is None:
+        return Response(status_code=413)
+    try:
+        index = await asyncio.to_thread(store_bounds, urn, model_derivative.derivative_version(manifest), body)
+    except ValueError as ex:
+        logging.warning(f'bounds of {urn} rejected: {ex}')
+        return JSONResponse({'error': str(ex)}, status_code=400)
+    return JSONResponse({'elements': len(index)})
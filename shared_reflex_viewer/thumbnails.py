@@ -0,0 +1,192 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import hashlib
+import logging
+import pathlib
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import decouple
+import httpx
+import requests
+
+import aps
+import model_derivative
+from scheduler import INTERACTIVE, scheduler
+from shared_reflex_viewer.cache import DiskCache
+
+
+THUMBNAIL_DIR = pathlib.Path(decouple.config(
+    'THUMBNAIL_DIR', default=str(pathlib.Path(tempfile.gettempdir()) / 'autodesk.consulting.thumbnails')
+))
+THUMBNAIL_CACHE_MAX_BYTES = decouple.config('THUMBNAIL_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+THUMBNAIL_WORKERS = decouple.config('THUMBNAIL_WORKERS', default=8, cast=int)
+# the requests received within this window are fetched together
+THUMBNAIL_BATCH_SECONDS = decouple.config('THUMBNAIL_BATCH_SECONDS', default=0.02, cast=float)
+# the seconds the browsers keep a thumbnail before checking its ETag again
+THUMBNAIL_MAX_AGE = decouple.config('THUMBNAIL_MAX_AGE', default=3600, cast=int)
+# the sizes APS renders
+SIZES = (100, 200, 400)
+DEFAULT_SIZE = 100
+
+
+def cache_key(urn: str, version: str, size: int) -> str:
+    return hashlib.sha1(f'{urn}:{version}:{size}'.encode('utf-8')).hexdigest()
+
+
+class ThumbnailService:
+    """
+    Fetches the thumbnails of the derivatives. The requests arriving together, usually the thumbnails of a page, are
+    fetched as one batch with at most `workers` concurrent requests, and a thumbnail requested again while it is being
+    fetched is fetched once.
+    """
+
+    def __init__(self, cache: DiskCache = None, workers: int = THUMBNAIL_WORKERS,
+                 batch_seconds: float = THUMBNAIL_BATCH_SECONDS):
+        self.cache = cache if cache is not None else DiskCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_MAX_BYTES, '.png')
+        self.workers = workers
+        self.batch_seconds = batch_seconds
+        self.fetched = 0
+        self.hits = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._batch: List[Tuple[str, str, int]] = []
+        self._flush: Optional[asyncio.TimerHandle] = None
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=self.workers))
+        elif self._loop is not loop:
+            raise RuntimeError('The thumbnail service is bound to another event loop')
+
+    async def get(self, urn: str, size: int = DEFAULT_SIZE) -> Tuple[Optional[pathlib.Path], str]:
+        """
+        Returns the thumbnail of a derivative
+        @param urn: The base64 encoded URN
+        @param size: 100, 200 or 400 pixels
+        @return: The PNG file, None if the derivative has no thumbnail, and the version of the derivative
+        """
+        self._start()
+        try:
+            version = await asyncio.to_thread(model_derivative.get_derivative_version, urn)
+        except requests.HTTPError as ex:
+            if ex.response is not None and ex.response.status_code == 404:
+                return None, ''
+            raise
+        key = cache_key(urn, version, size)
+        path = await asyncio.to_thread(self.cache.get, key)
+        if path is not None:
+            self.hits += 1
+            return path, version
+        if key not in self._pending:
+            self._pending[key] = self._loop.create_future()
+            self._batch.append((key, urn, size))
+            if self._flush is None:
+                self._flush = self._loop.call_later(self.batch_seconds, self._fetch_batch)
+        return await asyncio.shield(self._pending[key]), version
+
+    def _fetch_batch(self) -> None:
+        batch, self._batch, self._flush = self._batch, [], None
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def fetch(key: str, urn: str, size: int) -> None:
+            future = self._pending[key]
+            try:
+                async with semaphore:
+                    path = await self._fetch(key, urn, size)
+                future.set_result(path)
+            except Exception as ex:
+                logging.warning(f'thumbnail of {urn} not available: {ex}')
+                future.set_exception(ex)
+            finally:
+                self._pending.pop(key, None)
+
+        for key, urn, size in batch:
+            self._loop.create_task(fetch(key, urn, size))
+
+    async def _fetch(self, key: str, urn: str, size: int) -> Optional[pathlib.Path]:
+        resp = await scheduler.arequest(
+            self._client, 'GET', f'{model_derivative.ENDPOINT}/{urn}/thumbnail', priority=INTERACTIVE,
+            headers={'Authorization': aps.token.Value}, params={'width': size, 'height': size}
+        )
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        self.fetched += 1
+        return await asyncio.to_thread(self.cache.put, key, resp.content)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'fetched': self.fetched, 'hits': self.hits, 'pending': len(self._pending), 'bytes': self.cache.size}
+
+
+service = ThumbnailService()
+
+
+def thumbnail_url(urn: Any, size: int = DEFAULT_SIZE, version: str = '') -> Any:
+    """
+    Returns the URL of the thumbnail of a derivative on the backend
+    @param urn: The base64 encoded URN, or a Var of it
+    @param size: 100, 200 or 400 pixels
+    @param version: The version of the derivative if known, see model_derivative.derivative_version, the browsers
+    keep the thumbnails with a version forever
+    @return: The URL, a Var if the urn is a Var
+    """
+    import reflex as rx
+
+    url = f'{rx.config.get_config().api_url}/api/thumbnails/{urn}?size={size}'
+    return url if version == '' else f'{url}&v={version}'
+
+
+async def serve(request: Any) -> Any:
+    """
+    The endpoint of the thumbnails, the ETag is the version of the derivative. The browsers keep the thumbnails for
+    THUMBNAIL_MAX_AGE seconds, or forever when the URL has the version in the "v" parameter.
+    @param request: The starlette request
+    @return: The PNG response
+    """
+    from starlette.responses import FileResponse, Response
+
+    urn = request.path_params['urn']
+    try:
+        size = int(request.query_params.get('size', DEFAULT_SIZE))
+    except ValueError:
+        size = DEFAULT_SIZE
+    size = min(SIZES, key=lambda s: abs(s - size))
+    try:
+        path, version = await service.get(urn, size)
+    except Exception as ex:
+        logging.warning(f'thumbnail of {urn} failed: {ex}')
+        return Response(status_code=502, headers={'Cache-Control': 'no-store'})
+    if path is None:
+        return Response(status_code=404, headers={'Cache-Control': 'public, max-age=300'})
+    etag = f'"{version}-{size}"'
+    immutable = request.query_params.get('v') == version
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable' if immutable else f'public, max-age={THUMBNAIL_MAX_AGE}',
+    }
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type='image/png', headers=headers)
@@ -0,0 +1,106 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+from typing import Any, Dict, Iterable, List, Tuple
+
+import decouple
+
+
+# the size of the serialized tree nodes above which collapsed folders are evicted even if recently used
+TREE_STATE_MAX_BYTES = decouple.config('TREE_STATE_MAX_BYTES', default=2 * 1024 * 1024, cast=int)
+# the seconds after which a collapsed folder is evicted
+TREE_STATE_IDLE_SECONDS = decouple.config('TREE_STATE_IDLE_SECONDS', default=600, cast=int)
+
+
+def node_size(node: Any) -> int:
+    """
+    Returns the size in bytes of a tree node as it is sent to the browser
+    @param node: The ResourceType node
+    @return: The size
+    """
+    return len(node.json())
+
+
+def measure(data: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Returns the size in bytes and the number of nodes of a tree
+    @param data: The nodes by id
+    @return: The size and the count
+    """
+    return sum(node_size(n) for n in data.values()), len(data)
+
+
+def collapse(data: Dict[str, Any], oid: str) -> List[Any]:
+    """
+    Removes the descendants of a folder and turns it back into a lazy node
+    @param data: The nodes by id
+    @param oid: The id of the folder
+    @return: The removed nodes
+    """
+    node = data[oid]
+    removed = []
+    stack = list(node.children)
+    while stack:
+        child = data.pop(stack.pop(), None)
+        if child is not None:
+            removed.append(child)
+            stack.extend(child.children)
+    node.children = []
+    node.is_loading = True
+    return removed
+
+
+def evict(data: Dict[str, Any], expanded: Iterable[str], keep: Iterable[str], last_used: Dict[str, float],
+          now: float, tree_bytes: int, idle_seconds: float = TREE_STATE_IDLE_SECONDS,
+          max_bytes: int = TREE_STATE_MAX_BYTES) -> Tuple[List[Any], int]:
+    """
+    Collapses the loaded folders that are not expanded, least recently used first. Idle folders are always
+    collapsed, the others only while the tree is larger than the cap. The ancestors of the expanded and kept folders
+    are never collapsed, that would remove them.
+    @param data: The nodes by id
+    @param expanded: The ids of the folders expanded in the browser
+    @param keep: The ids of the folders that must not be collapsed
+    @param last_used: The last time each folder was selected or toggled
+    @param now: The current time
+    @param tree_bytes: The current size of the tree
+    @param idle_seconds: The seconds after which a collapsed folder is evicted
+    @param max_bytes: The size above which collapsed folders are evicted even if recently used
+    @return: The removed nodes and the size of the tree after the eviction
+    """
+    protected = set()
+    for oid in set(expanded) | set(keep):
+        while oid is not None and oid in data and oid not in protected:
+            protected.add(oid)
+            oid = data[oid].parent
+    candidates = sorted(
+        (oid for oid, node in data.items() if node.is_folder and not node.is_loading and oid not in protected),
+        key=lambda o: last_used.get(o, 0)
+    )
+    removed = []
+    for oid in candidates:
+        if oid not in data:
+            continue
+        if now - last_used.get(oid, 0) < idle_seconds and tree_bytes <= max_bytes:
+            break
+        tree_bytes -= node_size(data[oid])
+        evicted = collapse(data, oid)
+        tree_bytes += node_size(data[oid]) - sum(node_size(n) for n in evicted)
+        removed.extend(evicted)
+    return removed, tree_bytes
@@ -1,81 +1,460 @@
 from __future__ import annotations
+import asyncio
 import logging
 import pathlib
 import pprint
+import time
 from copy import copy
 
 import reflex as rx
 
 import api.crud.objects
-import autodesk.consulting.aps.data_management
+import aps
+import translation_jobs
+from breaker import CircuitOpenError, open_circuits
 from reflex_weave_mui import *
 from reflex_weave_mui.icon import NAMES_MAP, ICON_NAMES
 from reflex_weave_mui.tree import ResourceType
 from components import styles
 from components import utils
+from shared_reflex_viewer.folders import folder_cache, get_folder_contents
+from shared_reflex_viewer.prefetch import prefetcher
+from shared_reflex_viewer import tree_memory
+from shared_reflex_viewer.crawler import ProjectCrawler
+from shared_reflex_viewer.snapshot import Snapshot
+from shared_reflex_viewer.search_index import get_index
+from shared_reflex_viewer import versions
+from shared_reflex_viewer import webhooks
+from shared_reflex_viewer import thumbnails
+from shared_reflex_viewer import catalog
+from shared_reflex_viewer.shared_reflex_viewer import State, create_viewer, get_viewer_scripts
 
 
 class TreeWeaveState(rx.State):
     resources: dict[str, list[ResourceType]] = {}
-    project_id: str = '<xxxxx>'
+    project_id: str = ''
+    # the (name, id) of the projects of the user, see catalog.list_catalog
+    projects: list[tuple[str, str]] = []
     root_id: str = ''
     data: dict[str, ResourceType] = {}
+    expanded: list[str] = []
+    selected: str = ''
+    search_query: str = ''
+    search_hits: list[dict[str, str]] = []
+    search_status: str = ''
+    # the tip version, derivative URN, translation status and version of the derivatives of the files by item id,
+    # flagged as stale when the status comes from a cached manifest while APS is not answering
+    files: dict[str, dict] = {}
+    tree_bytes: int = 0
+    tree_nodes: int = 0
+    crawling: bool = False
+    crawl_progress: str = ''
+    translating: bool = False
+    translation_progress: str = ''
+    # the APS services that are unavailable while cached data is shown
+    aps_status: str = ''
+    # why the selected file did not open in the viewer
+    file_status: str = ''
+    _last_used: dict[str, float] = {}
 
     async def get_project_files_folder(self):
         if self.project_id == '':
             return
         with rx.session() as db:
             try:
-                project = await api.crud.objects.project.get_item(db, acc_id=self.project_id)
-                self.data = {
-                    project.root_folder: ResourceType(
-                        id=project.root_folder,
-                        name='Project Files',
-                        paretn=None,
+                # the projects of the catalog are opened without a database record
+                root_folder = catalog.root_folder(aps.get_user_id(), self.project_id)
+                if root_folder == '':
+                    project = await api.crud.objects.project.get_item(db, acc_id=self.project_id)
+                    root_folder = project.root_folder
+            except Exception as ex:
+                logging.exception(ex)
+                self.aps_status = f'Project {self.project_id} not found'
+                return
+        self.data = {
+            root_folder: ResourceType(
+                id=root_folder,
+                name='Project Files',
+                paretn=None,
+                is_folder=True,
+                is_loading=True,
+                children=[]
+            )
+        }
+        self.root_id = root_folder
+        self._last_used = {}
+        # the root loaded from the snapshot is not idle
+        self._touch([self.root_id])
+        self.tree_bytes, self.tree_nodes = tree_memory.measure(self.data)
+        try:
+            user = aps.get_user_id()
+            webhooks.watch(self.project_id, self.router.session.client_token, user, TreeWeaveState)
+            get_index(self.project_id, user).add(self.root_id, None, 'Project Files', True)
+            # a crawled project opens with the root folder already expanded
+            snapshot = Snapshot.load(self.project_id)
+            if snapshot is not None and snapshot.root_id == self.root_id:
+                if self._load_folder(self.root_id, user):
+                    return TreeWeaveState.refresh_stale(self.root_id)
+        except Exception as ex:
+            # the root folder is still expanded on demand
+            logging.exception(ex)
+            self.aps_status = f'The project tree is not fully loaded: {ex}'
+
+    @rx.background
+    async def load_projects(self):
+        """Lists the projects of the user, from the catalog warmed when the backend starts"""
+        if aps.token.Access is None:
+            return
+        try:
+            listed = await asyncio.to_thread(lambda: catalog.list_catalog(aps.get_user_id()))
+        except Exception as ex:
+            logging.exception(ex)
+            return
+        async with self:
+            self.projects = catalog.project_choices(listed)
+
+    def open_project(self, project_id: str):
+        self.project_id = project_id
+        self.expanded = []
+        self.selected = ''
+        self.files = {}
+        return TreeWeaveState.get_project_files_folder
+
+    async def handle_on_node_select(self, oid):
+        parent = self.data[oid]
+        user = aps.get_user_id()
+        self.selected = oid
+        try:
+            stale = self._load_folder(oid, user)
+        except CircuitOpenError as ex:
+            # the user never listed the folder, there is nothing cached to show
+            self.aps_status = str(ex)
+            return
+        self.aps_status = aps_status()
+        self._touch([oid])
+        self._evict(oid)
+        # users often drill one level further, warm the cache with the sub folders of the selected one and drop
+        # what was queued for the previous selection
+        prefetcher.prefetch(
+            self.router.session.client_token,
+            user,
+            self.project_id,
+            [i for i in parent.children if self.data[i].is_folder and self.data[i].is_loading]
+        )
+        if not parent.is_folder:
+            return await self._open_file(oid, user)
+        events = [TreeWeaveState.refresh_stale(oid)] if stale else []
+        if any(not self.data[i].is_folder and i not in self.files for i in parent.children):
+            events.append(TreeWeaveState.resolve_files(oid))
+        return events
+
+    @rx.background
+    async def refresh_stale(self, oid: str):
+        """Applies the fresh listing of a folder shown from the snapshot or from a stale cache entry once it arrives"""
+        async with self:
+            project_id = self.project_id
+        future = folder_cache.pending((project_id, oid))
+        if future is None:
+            return
+        # the revalidation logs its errors and keeps the stale entry
+        await asyncio.wrap_future(future)
+
+        def lookup():
+            # a user without id has no cached listings, see folders.get_folder_contents
+            user = aps.get_user_id()
+            return folder_cache.lookup((project_id, oid), user) if user is not None else None
+
+        found = await asyncio.to_thread(lookup)
+        if found is None:
+            return
+        async with self:
+            if self.project_id == project_id:
+                self.refresh_folder(oid, found[0])
+
+    @rx.background
+    async def resolve_files(self, oid: str):
+        """Resolves the files of a folder to their derivative URNs, so that they open without extra requests"""
+        async with self:
+            project_id = self.project_id
+        try:
+            resolved = await asyncio.to_thread(lambda: versions.resolve_folder(project_id, oid, aps.get_user_id()))
+        except Exception as ex:
+            logging.exception(ex)
+            return
+        async with self:
+            self.files.update(resolved)
+
+    @rx.background
+    async def translate_folder(self):
+        """Submits the translation of the files of the selected folder that were never translated or failed"""
+        async with self:
+            if self.translating or self.selected not in self.data or not self.data[self.selected].is_folder:
+                return
+            pending = {
+                i: self.files[i]['urn'] for i in self.data[self.selected].children
+                if i in self.files and self.files[i]['urn'] != '' and self.files[i]['status'] in ('n/a', 'failed')
+            }
+            if len(pending) == 0:
+                return
+            self.translating = True
+        results = await asyncio.gather(
+            *(translation_jobs.tracker.submit(urn) for urn in pending.values()), return_exceptions=True
+        )
+        for urn, result in zip(pending.values(), results):
+            if isinstance(result, Exception):
+                logging.warning(f'translation of {urn} not submitted: {result}')
+        # the progress of all the jobs comes from the single polling loop of the tracker
+        version = -1
+        while True:
+            version = await translation_jobs.tracker.wait(version, timeout=30)
+            jobs = translation_jobs.tracker.jobs(pending.values())
+            async with self:
+                for oid, urn in pending.items():
+                    if urn in jobs and oid in self.files:
+                        # the translation changes the derivatives, their thumbnail is revalidated until resolved again
+                        self.files[oid] = {
+                            **self.files[oid], 'status': jobs[urn].status, 'progress': jobs[urn].progress,
+                            'derivative': '', 'stale': False
+                        }
+                finished = sum(j.finished for j in jobs.values())
+                self.translation_progress = f'{finished} of {len(jobs)} translations finished'
+            if finished == len(jobs):
+                break
+        async with self:
+            self.translating = False
+
+    async def _open_file(self, oid: str, user: str):
+        name = self.data[oid].name
+        if oid not in self.files:
+            # the file was selected before its folder was resolved
+            try:
+                resolved = await asyncio.to_thread(
+                    versions.resolve_folder, self.project_id, self.data[oid].parent, user, [oid]
+                )
+            except Exception as ex:
+                logging.exception(ex)
+                self.file_status = f'{name} cannot be opened: {ex}'
+                return
+            self.files.update(resolved)
+        file = self.files.get(oid)
+        if file is None or file['urn'] == '':
+            self.file_status = f'{name} has no derivative to view'
+            return
+        cached = ' (cached)' if file.get('stale', False) else ''
+        if file['status'] != 'success':
+            self.file_status = f'{name} cannot be viewed, its translation is {file["status"]}{cached}'
+            return
+        self.file_status = ''
+        state = await self.get_state(State)
+        return state.set_urn(file['urn'])
+
+    def _load_folder(self, oid: str, user: str) -> bool:
+        """
+        Adds the contents of a folder to the tree the first time it is expanded
+        @param oid: The folder id
+        @param user: The id of the user
+        @return: True if the contents are stale and being revalidated, see refresh_stale
+        """
+        parent = self.data[oid]
+        if parent.is_folder and parent.is_loading:
+            contents, stale = get_folder_contents(self.project_id, oid, user)
+            get_index(self.project_id, user).add_listing(oid, contents)
+            self._merge_listing(oid, contents)
+            return stale
+        return False
+
+    def _merge_listing(self, oid: str, contents: dict):
+        parent = self.data[oid]
+        parent_bytes = tree_memory.node_size(parent)
+        added = []
+        for k, v in contents['folders'].items():
+            if k not in self.data:
+                data = {
+                    k: ResourceType(
+                        id=k,
+                        name=v['name'],
+                        parent=oid,
                         is_folder=True,
                         is_loading=True,
                         children=[]
                     )
                 }
-            except:
-                return
+                self.data.update(data)
+                parent.children.append(k)
+                added.append(k)
+        for k, v in contents['items'].items():
+            if k not in self.data:
+                data = {
+                    k: ResourceType(
+                        id=k,
+                        name=v['name'],
+                        parent=oid,
+                        is_folder=False,
+                        is_loading=False,
+                        children=[]
+                    )
+                }
+                self.data.update(data)
+                parent.children.append(k)
+                added.append(k)
+        parent.is_loading = False
+        # group the folders first and then the files and sort alphabetically
+        sorted_children_ids = sorted([i for i in parent.children if self.data[i].is_folder], key=lambda d: self.data[d].name)
+        sorted_children_ids.extend(sorted([i for i in parent.children if not self.data[i].is_folder], key=lambda d: self.data[d].name))
+        parent.children = sorted_children_ids
+        self.tree_bytes += tree_memory.node_size(parent) - parent_bytes
+        self.tree_bytes += sum(tree_memory.node_size(self.data[i]) for i in added)
+        self.tree_nodes = len(self.data)
+
+    @rx.var
+    def folder_files(self) -> list[dict[str, str]]:
+        """The files of the selected folder resolved to a derivative, with the URLs of their thumbnails"""
+        if self.selected not in self.data or not self.data[self.selected].is_folder:
+            return []
+        files = []
+        for i in self.data[self.selected].children:
+            file = self.files.get(i, {})
+            urn = file.get('urn', '')
+            if urn != '':
+                name = self.data[i].name + (' (cached)' if file.get('stale', False) else '')
+                thumbnail = thumbnails.thumbnail_url(urn, version=file.get('derivative', ''))
+                files.append({'id': i, 'name': name, 'thumbnail': thumbnail})
+        return files
 
-    def handle_on_node_select(self, oid):
+    def is_loaded(self, oid: str) -> bool:
+        return oid in self.data and self.data[oid].is_folder and not self.data[oid].is_loading
+
+    def refresh_folder(self, oid: str, contents: dict, item_id: str = ''):
+        """
+        Applies a fresh listing of a loaded folder, called when a webhook reports that the folder changed
+        @param oid: The folder id
+        @param contents: The "folders" and "items" of the folder
+        @param item_id: The item whose versions changed, its derivative is resolved again
+        """
+        if not self.is_loaded(oid):
+            return
         parent = self.data[oid]
-        if parent.is_folder and parent.is_loading:
-            for k, v in autodesk.consulting.aps.data_management.get_folder_maps(project_id=self.project_id, folder_id=oid).items():
-                if k not in self.data:
-                    data = {
-                        k: ResourceType(
-                            id=k,
-                            name=v['name'],
-                            parent=oid,
-                            is_folder=True,
-                            is_loading=True,
-                            children=[]
-                        )
-                    }
-                    self.data.update(data)
-                    parent.children.append(k)
-            for k, v in autodesk.consulting.aps.data_management.get_items_maps(project_id=self.project_id, folder_id=oid).items():
-                if k not in self.data:
-                    data = {
-                        k: ResourceType(
-                            id=k,
-                            name=v['name'],
-                            parent=oid,
-                            is_folder=False,
-                            is_loading=False,
-                            children=[]
-                        )
-                    }
-                    self.data.update(data)
-                    parent.children.append(k)
-            parent.is_loading = False
-            # group the folders first and then the files and sort alphabetically
-            sorted_children_ids = sorted([i for i in parent.children if self.data[i].is_folder], key=lambda d: self.data[d].name)
-            sorted_children_ids.extend(sorted([i for i in parent.children if not self.data[i].is_folder], key=lambda d: self.data[d].name))
-            parent.children = sorted_children_ids
+        listed = set(contents['folders']) | set(contents['items'])
+        for i in [i for i in parent.children if i not in listed]:
+            if self.data[i].is_folder:
+                for node in tree_memory.collapse(self.data, i):
+                    self.tree_bytes -= tree_memory.node_size(node)
+                    self.files.pop(node.id, None)
+                    self._last_used.pop(node.id, None)
+            self.tree_bytes -= tree_memory.node_size(self.data.pop(i))
+            self.files.pop(i, None)
+            self._last_used.pop(i, None)
+            if self.selected == i:
+                self.selected = ''
+        parent.children = [i for i in parent.children if i in listed]
+        self.expanded = [i for i in self.expanded if i in self.data]
+        for k, v in {**contents['folders'], **contents['items']}.items():
+            if k in self.data and self.data[k].name != v['name']:
+                self.data[k].name = v['name']
+        self.files.pop(item_id, None)
+        get_index(self.project_id, aps.get_user_id()).add_listing(oid, contents)
+        self._merge_listing(oid, contents)
+
+    def update_translation(self, urn: str, status: str) -> bool:
+        """
+        Updates the translation status of the files with a derivative URN, called by the webhooks
+        @param urn: The base64 encoded URN
+        @param status: The new status
+        @return: True if a file was updated
+        """
+        updated = False
+        for oid, file in list(self.files.items()):
+            if file['urn'] == urn and status != '' and file['status'] != status:
+                self.files[oid] = {**file, 'status': status, 'derivative': '', 'stale': False}
+                updated = True
+        return updated
+
+    def handle_on_node_toggle(self, node_ids: list[str]):
+        self._touch([i for i in node_ids if i not in self.expanded] + [i for i in self.expanded if i not in node_ids])
+        self.expanded = node_ids
+        self._evict()
+
+    def search(self, query: str):
+        """Looks for the query in the names of the nodes loaded by the user or crawled in the project"""
+        self.search_query = query
+        self.search_status = ''
+        hits = get_index(self.project_id, aps.get_user_id()).search(query)
+        self.search_hits = [
+            {'id': h.id, 'name': h.name, 'path': ' / '.join(name for _, name in h.path)} for h in hits
+        ]
+
+    def expand_to(self, oid: str):
+        """Loads and expands the ancestors of a node and selects it"""
+        user = aps.get_user_id()
+        path = get_index(self.project_id, user).path(oid)
+        if path is None:
+            # a refresh of its folder removed the node after it was found
+            self.search_hits = [h for h in self.search_hits if h['id'] != oid]
+            self.search_status = 'Not found, it was deleted or moved'
+            return
+        ancestors = [i for i, _ in path]
+        for i in ancestors:
+            if i not in self.data:
+                break
+            self._load_folder(i, user)
+        self._touch(ancestors)
+        self.expanded = self.expanded + [i for i in ancestors if i not in self.expanded]
+        if oid in self.data:
+            self.selected = oid
+
+    @rx.background
+    async def crawl_project(self):
+        """Crawls the whole project into a snapshot that later sessions load instantly"""
+        async with self:
+            if self.crawling or self.root_id == '':
+                return
+            user = aps.get_user_id()
+            # the snapshot is only shown to the user that crawled it
+            if user is None:
+                self.crawl_progress = 'Sign in with an Autodesk account to crawl the project'
+                return
+            self.crawling = True
+            crawler = ProjectCrawler(self.project_id, self.root_id, user)
+        task = asyncio.get_running_loop().run_in_executor(None, crawler.run)
+        while not task.done():
+            await asyncio.sleep(1)
+            async with self:
+                p = crawler.progress
+                self.crawl_progress = f'{p.folders} folders, {p.items} items, {p.pending} pending, {p.errors} errors in {p.elapsed:.0f}s'
+        try:
+            snapshot = await task
+        except Exception as ex:
+            logging.exception(ex)
+            snapshot = None
+        async with self:
+            self.crawling = False
+            if snapshot is not None and not snapshot.complete:
+                self.crawl_progress += f', {len(snapshot.failed)} folders not listed, crawl again to retry them'
+
+    def _touch(self, node_ids: list[str]):
+        now = time.time()
+        for i in node_ids:
+            self._last_used[i] = now
+
+    def _evict(self, oid: str = None):
+        """Turns the collapsed folders that were not used for a while back into lazy nodes"""
+        keep = [oid] if oid is not None else []
+        removed, self.tree_bytes = tree_memory.evict(
+            self.data, self.expanded, keep, self._last_used, time.time(), self.tree_bytes
+        )
+        if len(removed) > 0:
+            for node in removed:
+                self._last_used.pop(node.id, None)
+            self.expanded = [i for i in self.expanded if i in self.data]
+            self.tree_nodes = len(self.data)
+            logging.info(f'evicted {len(removed)} tree nodes, {self.tree_nodes} nodes and {self.tree_bytes} bytes left')
+
+
+def aps_status() -> str:
+    circuits = open_circuits()
+    if len(circuits) == 0:
+        return ''
+    return f'APS {", ".join(circuits)} unavailable, showing cached data'
 
 
 def example(name: str, component: rx.Component) -> rx.Component:
@@ -95,19 +474,122 @@ def render_tree():
         root_id='xxxxx',  # TreeWeaveState.root_id,
         data=TreeWeaveState.data,
         on_node_select=TreeWeaveState.handle_on_node_select,
+        on_node_toggle=TreeWeaveState.handle_on_node_toggle,
+        expanded=TreeWeaveState.expanded,
+        selected=TreeWeaveState.selected,
+    )
+
+
+def render_projects():
+    return rx.select.root(
+        rx.select.trigger(placeholder='Select Project'),
+        rx.select.content(
+            rx.select.group(
+                rx.foreach(
+                    TreeWeaveState.projects,
+                    lambda p: rx.select.item(p[0], value=p[1])
+                )
+            )
+        ),
+        value=TreeWeaveState.project_id,
+        on_change=TreeWeaveState.open_project,
+    )
+
+
+def render_search():
+    return stack(
+        rx.debounce_input(
+            rx.input(
+                placeholder='Search by name',
+                value=TreeWeaveState.search_query,
+                on_change=TreeWeaveState.search,
+            ),
+            debounce_timeout=300,
+        ),
+        text(TreeWeaveState.search_status),
+        rx.foreach(
+            TreeWeaveState.search_hits,
+            lambda h: rx.button(
+                text(h['name']),
+                text(h['path']),
+                variant='ghost',
+                on_click=TreeWeaveState.expand_to(h['id']),
+            )
+        ),
+    )
+
+
+def render_files():
+    # the browser requests the thumbnails scrolled into view only
+    return rx.flex(
+        rx.foreach(
+            TreeWeaveState.folder_files,
+            lambda f: rx.button(
+                rx.image(src=f['thumbnail'], loading='lazy', width='100px', height='100px', alt=''),
+                text(f['name']),
+                variant='ghost',
+                on_click=TreeWeaveState.handle_on_node_select(f['id']),
+                height='auto',
+                flex_direction='column',
+            )
+        ),
+        wrap='wrap',
+        max_height='400px',
+        overflow_y='auto',
     )
 
 
 @rx.page(route='/tree', title='Recursive tree')
 def index() -> rx.Component:
     return container(
+        rx.cond(
+            TreeWeaveState.aps_status != '',
+            text(TreeWeaveState.aps_status),
+        ),
+        example(
+            'Project',
+            render_projects()
+        ),
+        example(
+            'Search',
+            render_search()
+        ),
         example(
             'Autodesk Docs folder tree',
             render_tree()
         ),
+        example(
+            'Files',
+            stack(
+                text(TreeWeaveState.file_status),
+                render_files(),
+            )
+        ),
+        example(
+            'Viewer',
+            rx.fragment(get_viewer_scripts(), create_viewer())
+        ),
+        example(
+            'Translations',
+            stack(
+                rx.button('Translate folder', on_click=TreeWeaveState.translate_folder, disabled=TreeWeaveState.translating),
+                text(TreeWeaveState.translation_progress),
+            )
+        ),
         example(
             'Root ID',
             text(TreeWeaveState.root_id)
         ),
-        on_mount=TreeWeaveState.get_project_files_folder
+        example(
+            'Tree state',
+            text(f'{TreeWeaveState.tree_nodes} nodes, {TreeWeaveState.tree_bytes} bytes')
+        ),
+        example(
+            'Project snapshot',
+            stack(
+                rx.button('Crawl project', on_click=TreeWeaveState.crawl_project, disabled=TreeWeaveState.crawling),
+                text(TreeWeaveState.crawl_progress),
+            )
+        ),
+        on_mount=[TreeWeaveState.load_projects, TreeWeaveState.get_project_files_folder]
     )
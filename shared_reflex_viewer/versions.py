@@ -0,0 +1,129 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Sequence
+
+import decouple
+import requests
+
+import aps
+import model_derivative
+from scheduler import scheduler
+from shared_reflex_viewer.cache import SharedCache
+from shared_reflex_viewer.folders import folder_cache
+
+
+ENDPOINT = 'https://developer.api.autodesk.com/data/v1/projects'
+
+version_cache = SharedCache('versions', ttl=decouple.config('VERSION_CACHE_TTL', default=300, cast=int))
+
+_executor = ThreadPoolExecutor(max_workers=decouple.config('MANIFEST_WORKERS', default=8, cast=int),
+                               thread_name_prefix='manifests')
+
+
+def fetch_tip_versions(project_id: str, folder_id: str) -> Dict[str, Dict[str, str]]:
+    """
+    Lists the tip versions of the items of a folder, one request per page of the folder contents
+    @param project_id: The ACC project id, with or without the "b." prefix
+    @param folder_id: The folder id
+    @return: The {"version", "urn"} of the tip version by item id, the urn is the base64 derivative URN
+    """
+    project_id = project_id if project_id.startswith('b.') else f'b.{project_id}'
+    url = f'{ENDPOINT}/{project_id}/folders/{folder_id}/contents'
+    params = {'filter[type]': 'items'}
+    tips = {}
+    while url is not None:
+        resp = scheduler.get(url, headers={'Authorization': aps.token.Value}, params=params)
+        resp.raise_for_status()
+        j = resp.json()
+        # the tip versions of the items in the page are in the "included" section
+        for version in j.get('included', []):
+            if version.get('type') != 'versions':
+                continue
+            relationships = version.get('relationships', {})
+            item_id = relationships.get('item', {}).get('data', {}).get('id')
+            if item_id is None:
+                continue
+            tips[item_id] = {
+                'version': version['id'],
+                'urn': relationships.get('derivatives', {}).get('data', {}).get('id', ''),
+            }
+        url = j.get('links', {}).get('next', {}).get('href')
+        params = None
+    return tips
+
+
+def get_translation_status(urn: str) -> Dict[str, Any]:
+    """
+    Returns the translation status of a derivative from its cached manifest
+    @param urn: The base64 derivative URN
+    @return: The {"status", "derivative", "stale"}, the status is "success", "inprogress", "pending", "failed",
+    "timeout" or "n/a" if the file was never translated, the derivative is the version of the derivatives, see
+    model_derivative.derivative_version, and stale is True if the manifest is stale, see model_derivative.get_manifest
+    """
+    if urn == '':
+        return {'status': 'n/a', 'derivative': '', 'stale': False}
+    try:
+        manifest, stale = model_derivative.get_manifest(urn)
+    except requests.HTTPError as ex:
+        if ex.response is not None and ex.response.status_code == 404:
+            return {'status': 'n/a', 'derivative': '', 'stale': False}
+        raise
+    return {
+        'status': manifest.get('status', 'n/a'),
+        'derivative': model_derivative.derivative_version(manifest),
+        'stale': stale,
+    }
+
+
+def resolve_folder(project_id: str, folder_id: str, user: Optional[str],
+                   item_ids: Optional[Sequence[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Resolves the files of a folder to their tip version, derivative URN and translation status. The versions come
+    from the cached folder listing, or from one paginated listing when the folder was shown from a crawled snapshot,
+    and the manifests are fetched concurrently, both are cached.
+    @param project_id: The ACC project id
+    @param folder_id: The folder id
+    @param user: The id of the user browsing the folder, None if unknown
+    @param item_ids: The items to resolve, all the items of the folder if None
+    @return: The {"version", "urn", "status", "derivative", "stale"} by item id, see get_translation_status
+    """
+    found = folder_cache.lookup((project_id, folder_id), user) if user is not None else None
+    items = found[0]['items'] if found is not None else {}
+    if found is not None and all('urn' in v for v in items.values()):
+        tips = {k: {'version': v['version'], 'urn': v['urn']} for k, v in items.items()}
+    else:
+        # the snapshot listings only have the names
+        loader = lambda: fetch_tip_versions(project_id, folder_id)
+        tips = loader() if user is None else version_cache.get((project_id, folder_id), loader, user=user)[0]
+    if item_ids is not None:
+        tips = {k: v for k, v in tips.items() if k in item_ids}
+
+    def status(urn: str) -> Dict[str, Any]:
+        try:
+            return get_translation_status(urn)
+        except Exception as ex:
+            logging.warning(f'manifest of {urn} not available: {ex}')
+            return {'status': 'unknown', 'derivative': '', 'stale': False}
+
+    statuses = _executor.map(status, [v['urn'] for v in tips.values()])
+    return {k: {**v, **s} for (k, v), s in zip(tips.items(), statuses)}
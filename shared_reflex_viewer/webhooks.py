@@ -0,0 +1,317 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Receives the APS webhook events and keeps the caches and the open trees up to date.
+
+Subscribe a project folder with `python -m shared_reflex_viewer.webhooks subscribe <folder urn> <callback url>`.
+The events received are saved in WEBHOOK_RECORD_DIR when it is set, and can be sent again to a local backend with
+`python -m shared_reflex_viewer.webhooks replay <files> --url http://localhost:8000/api/webhooks`.
+"""
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import pathlib
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import decouple
+import requests
+
+import aps
+import model_derivative
+import translation_jobs
+from scheduler import scheduler
+from shared_reflex_viewer.folders import folder_cache, refresh_folder_contents
+from shared_reflex_viewer.versions import version_cache
+
+try:
+    from reflex.state import _substate_key
+except ImportError:
+    # the states are keyed by the client token only before reflex 0.4.4
+    _substate_key = lambda token, state: token
+
+
+ENDPOINT = 'https://developer.api.autodesk.com/webhooks/v1'
+# the secret shared with APS to sign the events, the events are rejected when it is empty
+WEBHOOK_SECRET = decouple.config('WEBHOOK_SECRET', default='')
+WEBHOOK_RECORD_DIR = decouple.config('WEBHOOK_RECORD_DIR', default='')
+
+FOLDER_EVENTS = (
+    'dm.version.added', 'dm.version.modified', 'dm.version.deleted', 'dm.version.moved',
+    'dm.folder.added', 'dm.folder.modified', 'dm.folder.deleted', 'dm.folder.moved',
+)
+DERIVATIVE_EVENTS = ('extraction.finished', 'extraction.updated')
+
+
+def sign(body: bytes, secret: str = None) -> str:
+    """
+    Returns the signature of an event as APS sends it in the x-adsk-signature header
+    @param body: The raw body of the event
+    @param secret: The secret, WEBHOOK_SECRET if None
+    @return: The "sha1hash=<hex>" signature
+    """
+    secret = WEBHOOK_SECRET if secret is None else secret
+    return 'sha1hash=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha1).hexdigest()
+
+
+def verify_signature(body: bytes, signature: Optional[str], secret: str = None) -> bool:
+    secret = WEBHOOK_SECRET if secret is None else secret
+    if secret == '' or signature is None:
+        return False
+    return hmac.compare_digest(sign(body, secret), signature)
+
+
+# the client token, the user and the state class of the sessions browsing each project
+_sessions: Dict[str, Dict[str, Tuple[str, type]]] = {}
+# the events being handled, the loop keeps only weak references to its tasks
+_tasks: Set[asyncio.Task] = set()
+
+
+def watch(project_id: str, client_token: str, user: Optional[str], state: type) -> None:
+    """
+    Registers a browser session to be updated by the events of a project
+    @param project_id: The ACC project id
+    @param client_token: The client token of the session
+    @param user: The id of the user of the session
+    @param state: The state class holding the tree
+    """
+    for sessions in _sessions.values():
+        sessions.pop(client_token, None)
+    _sessions.setdefault(project_id.removeprefix('b.'), {})[client_token] = (user, state)
+
+
+def _project_keys(project_id: str) -> List[str]:
+    """The project id is used with and without the "b." prefix"""
+    project_id = project_id.removeprefix('b.')
+    return [project_id, f'b.{project_id}']
+
+
+def invalidate(event: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Drops the cached entries affected by an event
+    @param event: The webhook event
+    @return: What the event is about: "event", "project", "folder", "item" or "urn"
+    """
+    name = event.get('hook', {}).get('event', '')
+    payload = event.get('payload', {})
+    if name in FOLDER_EVENTS:
+        project_id = payload.get('project', '').removeprefix('b.')
+        folders = {payload.get('parentFolderUrn', '')}
+        if name.startswith('dm.folder.'):
+            folders.add(payload.get('source', ''))
+        folders.discard('')
+        for key in _project_keys(project_id):
+            for folder_id in folders:
+                folder_cache.invalidate((key, folder_id))
+                version_cache.invalidate((key, folder_id))
+        return {'event': name, 'project': project_id, 'folder': payload.get('parentFolderUrn', ''),
+                'item': payload.get('lineageUrn', '') if name.startswith('dm.version.') else ''}
+    if name in DERIVATIVE_EVENTS:
+        urn = payload.get('URN') or event.get('resourceUrn', '')
+        model_derivative.manifest_cache.invalidate(urn)
+        model_derivative.manifest_cache.invalidate((urn, 'metadata'))
+        return {'event': name, 'urn': urn, 'status': str(payload.get('Status', '')).lower()}
+    return {'event': name}
+
+
+async def update_sessions(change: Dict[str, str]) -> int:
+    """
+    Applies an event to the trees of the sessions browsing the project
+    @param change: The result of invalidate
+    @return: The number of sessions updated
+    """
+    from shared_reflex_viewer.shared_reflex_viewer import app
+
+    if change.get('folder'):
+        sessions = list(_sessions.get(change['project'], {}).items())
+    elif change.get('urn'):
+        sessions = [s for p in _sessions.values() for s in p.items()]
+    else:
+        return 0
+    updated = 0
+    listings: Dict[str, Dict[str, Any]] = {}
+    for client_token, (user, state_cls) in sessions:
+        try:
+            key = _substate_key(client_token, state_cls)
+            if change.get('folder'):
+                async with app.modify_state(key) as root:
+                    state = await root.get_state(state_cls)
+                    loaded = state.is_loaded(change['folder'])
+                    project_id = state.project_id
+                if not loaded:
+                    continue
+                # the sessions of the same user share the listing, which is loaded outside of the state lock
+                owner = user if user is not None else client_token
+                if owner not in listings:
+                    listings[owner] = await asyncio.to_thread(
+                        refresh_folder_contents, project_id, change['folder'], user
+                    )
+                async with app.modify_state(key) as root:
+                    state = await root.get_state(state_cls)
+                    state.refresh_folder(change['folder'], listings[owner], change.get('item', ''))
+            else:
+                async with app.modify_state(key) as root:
+                    state = await root.get_state(state_cls)
+                    if not state.update_translation(change['urn'], change.get('status', '')):
+                        continue
+            updated += 1
+        except Exception as ex:
+            logging.warning(f'session {client_token} not updated by {change["event"]}: {ex}')
+    return updated
+
+
+async def handle_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Invalidates the caches affected by an event and updates the sessions browsing the project
+    @param event: The webhook event
+    @return: The change and the number of sessions updated
+    """
+    change = invalidate(event)
+    if change.get('urn'):
+        translation_jobs.tracker.poll_now(change['urn'])
+    updated = await update_sessions(change)
+    logging.info(f'webhook {change}: {updated} sessions updated')
+    return {**change, 'sessions': updated}
+
+
+async def receive(request: Any) -> Any:
+    """
+    The endpoint APS posts the events to
+    @param request: The starlette request
+    @return: The JSON response
+    """
+    from starlette.responses import JSONResponse
+
+    body = await request.body()
+    if not verify_signature(body, request.headers.get('x-adsk-signature')):
+        return JSONResponse({'error': 'invalid signature'}, status_code=401)
+    try:
+        event = json.loads(body)
+    except ValueError:
+        event = None
+    if not isinstance(event, dict):
+        return JSONResponse({'error': 'invalid JSON'}, status_code=400)
+    if WEBHOOK_RECORD_DIR != '':
+        folder = pathlib.Path(WEBHOOK_RECORD_DIR)
+        folder.mkdir(parents=True, exist_ok=True)
+        name = event.get('hook', {}).get('event', 'event')
+        (folder / f'{time.time_ns()}-{name}.json').write_bytes(body)
+    # APS retries the events that are not acknowledged quickly, the sessions are updated in the background
+    task = asyncio.create_task(handle_event(event))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return JSONResponse({'status': 'accepted'})
+
+
+def set_secret(secret: str = None) -> None:
+    """
+    Registers the secret APS uses to sign the events of the application
+    @param secret: The secret, WEBHOOK_SECRET if None
+    """
+    secret = WEBHOOK_SECRET if secret is None else secret
+    headers = {'Authorization': aps.token.Value}
+    resp = scheduler.post(f'{ENDPOINT}/tokens', headers=headers, json={'token': secret})
+    if resp.status_code == 400:
+        # a secret is already registered
+        resp = scheduler.request('PUT', f'{ENDPOINT}/tokens/@me', headers=headers, json={'token': secret})
+    resp.raise_for_status()
+
+
+def subscribe(folder_urn: str, callback_url: str, events: Iterable[str] = FOLDER_EVENTS) -> List[str]:
+    """
+    Subscribes to the data management events of a folder and of its sub folders
+    @param folder_urn: The folder id, usually the project files folder
+    @param callback_url: The public URL of the /api/webhooks endpoint
+    @param events: The events
+    @return: The hook locations
+    """
+    hooks = []
+    for event in events:
+        resp = scheduler.post(f'{ENDPOINT}/systems/data/events/{event}/hooks',
+                              headers={'Authorization': aps.token.Value},
+                              json={'callbackUrl': callback_url, 'scope': {'folder': folder_urn},
+                                    'hookAttribute': {'hierarchy': True}})
+        if resp.status_code != 409:
+            resp.raise_for_status()
+        hooks.append(resp.headers.get('Location', ''))
+    return hooks
+
+
+def subscribe_derivatives(callback_url: str, workflow: str = None, events: Iterable[str] = DERIVATIVE_EVENTS) -> List[str]:
+    """
+    Subscribes to the translation events of the jobs submitted with a workflow id
+    @param callback_url: The public URL of the /api/webhooks endpoint
+    @param workflow: The workflow id, TRANSLATION_WORKFLOW if None
+    @param events: The events
+    @return: The hook locations
+    """
+    workflow = translation_jobs.TRANSLATION_WORKFLOW if workflow is None else workflow
+    hooks = []
+    for event in events:
+        resp = scheduler.post(f'{ENDPOINT}/systems/derivative/events/{event}/hooks',
+                              headers={'Authorization': aps.token.Value},
+                              json={'callbackUrl': callback_url, 'scope': {'workflow': workflow}})
+        if resp.status_code != 409:
+            resp.raise_for_status()
+        hooks.append(resp.headers.get('Location', ''))
+    return hooks
+
+
+def replay(paths: Iterable[pathlib.Path], url: str, secret: str = None) -> None:
+    """
+    Posts recorded events to a backend, signed like APS does
+    @param paths: The JSON files of the events
+    @param url: The URL of the /api/webhooks endpoint
+    @param secret: The secret, WEBHOOK_SECRET if None
+    """
+    for path in paths:
+        body = pathlib.Path(path).read_bytes()
+        resp = requests.post(url, data=body, headers={'Content-Type': 'application/json',
+                                                       'x-adsk-signature': sign(body, secret)})
+        print(f'{path}: {resp.status_code} {resp.text}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    s = commands.add_parser('subscribe')
+    s.add_argument('folder_urn')
+    s.add_argument('callback_url')
+    r = commands.add_parser('replay')
+    r.add_argument('files', nargs='+', type=pathlib.Path)
+    r.add_argument('--url', default='http://localhost:8000/api/webhooks')
+    args = parser.parse_args()
+
+    if args.command == 'subscribe':
+        set_secret()
+        print(subscribe(args.folder_urn, args.callback_url))
+        if translation_jobs.TRANSLATION_WORKFLOW != '':
+            print(subscribe_derivatives(args.callback_url))
+    else:
+        replay(sorted(args.files), args.url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+from shared_reflex_viewer.cache import SharedCache
+
+
+def test_users_with_different_listings_never_see_each_other():
+    cache = SharedCache('test-users')
+    listings = {'A': ['hubA'], 'B': ['hubB']}
+    calls = []
+
+    def loader(user):
+        calls.append(user)
+        return listings[user]
+
+    assert cache.get('hubs', lambda: loader('A'), user='A') == (['hubA'], False)
+    assert cache.get('hubs', lambda: loader('B'), user='B') == (['hubB'], False)
+    assert cache.get('hubs', lambda: loader('A'), user='A') == (['hubA'], False)
+    assert cache.get('hubs', lambda: loader('B'), user='B') == (['hubB'], False)
+    assert calls == ['A', 'B', 'A', 'B']
+    assert cache.lookup('hubs', 'C') is None
+
+
+def test_users_with_the_same_listing_share_it():
+    cache = SharedCache('test-shared')
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return ['hub']
+
+    cache.get('hubs', loader, user='A')
+    cache.get('hubs', loader, user='B')
+    assert cache.get('hubs', loader, user='A') == (['hub'], False)
+    assert cache.get('hubs', loader, user='B') == (['hub'], False)
+    assert len(calls) == 2
@@ -0,0 +1,83 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+from typing import Dict, List
+
+import numpy as np
+
+from shared_reflex_viewer.model_diff import diff
+from shared_reflex_viewer.property_store import PropertyStore
+
+
+def store(elements: Dict[int, tuple]) -> PropertyStore:
+    """Returns a store with a single "Mark" property from the (external id, mark) of every dbId"""
+    objects = np.array(sorted(elements), dtype=np.int32)
+    marks: List[str] = sorted({m for _, m in elements.values()})
+    return PropertyStore(
+        dbids=objects.copy(),
+        attrs=np.zeros(len(objects), dtype=np.int32),
+        values=np.array([marks.index(elements[o][1]) for o in objects], dtype=np.int32),
+        attr_names=['Mark'],
+        value_names=marks,
+        objects=objects,
+        external_ids=[elements[o][0] for o in objects],
+    )
+
+
+def test_unique_external_ids():
+    old = store({1: ('a', 'A1'), 2: ('b', 'B1'), 3: ('c', 'C1')})
+    new = store({10: ('a', 'A1'), 11: ('b', 'B2'), 12: ('d', 'D1')})
+    result = diff(old, new)
+    assert result.added.tolist() == [12]
+    assert result.removed.tolist() == [3]
+    assert result.changed.tolist() == [11]
+    assert result.changed_old.tolist() == [2]
+    assert result.property_changes() == {11: [('Mark', 'B1', 'B2')]}
+
+
+def test_duplicate_external_ids_are_matched_in_dbid_order():
+    old = store({1: ('a', 'A1'), 2: ('a', 'A2'), 3: ('a', 'A3'), 4: ('b', 'B1')})
+    new = store({10: ('a', 'A1'), 11: ('a', 'A2x'), 12: ('b', 'B1')})
+    result = diff(old, new)
+    # the two duplicates of the new version match the first two of the old one, the third is removed
+    assert result.added.tolist() == []
+    assert result.removed.tolist() == [3]
+    assert result.changed.tolist() == [11]
+    assert result.changed_old.tolist() == [2]
+    assert result.summary() == {'added': 0, 'removed': 1, 'changed': 1, 'unmatched': 0}
+
+
+def test_empty_external_ids_are_unmatched():
+    old = store({1: ('', 'X1'), 2: ('', 'X2'), 3: ('a', 'A1')})
+    new = store({10: ('', 'X1'), 11: ('a', 'A1'), 12: ('b', 'B1')})
+    result = diff(old, new)
+    assert result.added.tolist() == [12]
+    assert result.removed.tolist() == []
+    assert result.changed.tolist() == []
+    assert result.unmatched.tolist() == [10]
+    assert sorted(result.unmatched_old.tolist()) == [1, 2]
+    assert result.summary()['unmatched'] == 3
+
+
+def test_no_external_ids():
+    old = store({1: ('', 'X1')})
+    new = store({2: ('', 'X1')})
+    result = diff(old, new)
+    assert result.summary() == {'added': 0, 'removed': 0, 'changed': 0, 'unmatched': 2}
@@ -0,0 +1,67 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from shared_reflex_viewer import tree_memory
+
+
+@dataclass
+class Node:
+    """The fields of the tree nodes that the eviction reads"""
+    id: str
+    parent: Optional[str]
+    is_folder: bool = True
+    is_loading: bool = False
+    children: List[str] = field(default_factory=list)
+
+    def json(self) -> str:
+        return json.dumps(asdict(self))
+
+
+def tree() -> Dict[str, Node]:
+    """Returns root / a / b / c with every folder loaded"""
+    return {
+        'root': Node('root', None, children=['a']),
+        'a': Node('a', 'root', children=['b']),
+        'b': Node('b', 'a', children=['c']),
+        'c': Node('c', 'b'),
+    }
+
+
+def test_ancestors_of_expanded_folders_are_never_evicted():
+    data = tree()
+    size, _ = tree_memory.measure(data)
+    # only the deepest folder was used recently, its collapsed ancestors are idle
+    removed, _ = tree_memory.evict(data, ['c'], [], {'c': 1000}, 1000, size, idle_seconds=10)
+    assert removed == []
+    assert set(data) == {'root', 'a', 'b', 'c'}
+
+
+def test_idle_collapsed_folders_are_evicted():
+    data = tree()
+    size, _ = tree_memory.measure(data)
+    removed, size = tree_memory.evict(data, ['root'], [], {'root': 1000}, 1000, size, idle_seconds=10)
+    assert sorted(n.id for n in removed) == ['b', 'c']
+    assert set(data) == {'root', 'a'}
+    assert data['a'].is_loading and data['a'].children == []
+    assert size == tree_memory.measure(data)[0]
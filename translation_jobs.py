@@ -0,0 +1,272 @@
+# coding: utf-8
+# Author: paolo.serra@autodesk.com
+# Copyright (c) 2024 Autodesk, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+__author__ = 'Paolo Emilio Serra - paolo.serra@autodesk.com'
+__copyright__ = '2024'
+__version__ = '1.0.0'
+
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import decouple
+import httpx
+
+import aps
+import model_derivative
+from scheduler import BACKGROUND, INTERACTIVE, scheduler
+
+
+TRANSLATION_POLL_CONCURRENCY = decouple.config('TRANSLATION_POLL_CONCURRENCY', default=16, cast=int)
+TRANSLATION_POLL_MIN_SECONDS = decouple.config('TRANSLATION_POLL_MIN_SECONDS', default=5, cast=float)
+TRANSLATION_POLL_MAX_SECONDS = decouple.config('TRANSLATION_POLL_MAX_SECONDS', default=120, cast=float)
+TRANSLATION_TIMEOUT_SECONDS = decouple.config('TRANSLATION_TIMEOUT_SECONDS', default=6 * 3600, cast=float)
+# the workflow id of the jobs, the webhooks subscribed to it report when they finish
+TRANSLATION_WORKFLOW = decouple.config('TRANSLATION_WORKFLOW', default='')
+
+FINISHED = ('success', 'failed', 'timeout')
+
+
+@dataclass
+class TranslationJob:
+    """The state of the translation of a derivative as seen by the last poll of its manifest."""
+    urn: str
+    status: str = 'pending'
+    progress: str = ''
+    submitted: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+    polls: int = 0
+    error: str = ''
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def json(self) -> Dict[str, Any]:
+        return {'urn': self.urn, 'status': self.status, 'progress': self.progress, 'error': self.error}
+
+
+def backoff(polls: int, minimum: float = TRANSLATION_POLL_MIN_SECONDS,
+            maximum: float = TRANSLATION_POLL_MAX_SECONDS) -> float:
+    """
+    Returns the delay before the next poll of a manifest, exponential in the number of polls and with full jitter so
+    that the jobs submitted together do not keep polling together
+    @param polls: The number of polls without progress
+    @param minimum: The minimum delay in seconds
+    @param maximum: The maximum delay in seconds
+    @return: The delay in seconds
+    """
+    return random.uniform(minimum, min(maximum, minimum * 2 ** polls))
+
+
+def translation_payload(urn: str, formats: Sequence[str] = ('svf2',)) -> Dict[str, Any]:
+    payload = {
+        'input': {'urn': urn},
+        'output': {'formats': [{'type': f, 'views': ['2d', '3d']} for f in formats]},
+    }
+    if TRANSLATION_WORKFLOW != '':
+        payload['misc'] = {'workflow': TRANSLATION_WORKFLOW}
+    return payload
+
+
+class TranslationTracker:
+    """
+    Submits translation jobs and tracks them until they finish.
+
+    All the jobs are polled from a single task of the event loop that first uses the tracker. The due polls are kept in
+    a heap and at most `concurrency` manifests are requested at the same time over a shared connection pool, so that
+    thousands of pending translations cost a handful of sockets and no threads.
+    """
+
+    def __init__(self, concurrency: int = TRANSLATION_POLL_CONCURRENCY,
+                 min_delay: float = TRANSLATION_POLL_MIN_SECONDS, max_delay: float = TRANSLATION_POLL_MAX_SECONDS,
+                 timeout: float = TRANSLATION_TIMEOUT_SECONDS):
+        self.concurrency = concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._jobs: Dict[str, TranslationJob] = {}
+        # (due time, urn) of the next poll of every unfinished job
+        self._due: List[Tuple[float, str]] = []
+        self._version = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._changed: Optional[asyncio.Condition] = None
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._client = httpx.AsyncClient(
+                timeout=30, limits=httpx.Limits(max_connections=self.concurrency)
+            )
+            self._wakeup = asyncio.Event()
+            self._changed = asyncio.Condition()
+        elif self._loop is not loop:
+            raise RuntimeError('The translation tracker is bound to another event loop')
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, urn: str, formats: Sequence[str] = ('svf2',), force: bool = False) -> TranslationJob:
+        """
+        Submits the translation of a derivative and starts tracking it
+        @param urn: The base64 encoded URN of the source file
+        @param formats: The output formats
+        @param force: If True the derivatives are generated again even if they already exist
+        @return: The job
+        """
+        self._start()
+        job = self._jobs.get(urn)
+        if job is not None and not job.finished and not force:
+            return job
+        resp = await scheduler.arequest(
+            self._client, 'POST', f'{model_derivative.ENDPOINT}/job', priority=INTERACTIVE,
+            headers={'Authorization': aps.token.Value, 'x-ads-force': 'true' if force else 'false'},
+            json=translation_payload(urn, formats),
+        )
+        resp.raise_for_status()
+        job = TranslationJob(urn=urn)
+        self._jobs[urn] = job
+        # the manifest is requested right away, it tells if the derivatives already existed
+        self._schedule(urn, 0)
+        await self._notify()
+        logging.info(f'submitted the translation of {urn}: {resp.json().get("result")}')
+        return job
+
+    def track(self, urns: Iterable[str]) -> None:
+        """
+        Tracks translations submitted elsewhere
+        @param urns: The base64 encoded URNs
+        """
+        self._start()
+        for urn in urns:
+            if urn not in self._jobs or self._jobs[urn].finished:
+                self._jobs[urn] = TranslationJob(urn=urn)
+                self._schedule(urn, 0)
+
+    def poll_now(self, urn: str) -> None:
+        """
+        Polls the manifest of a tracked job right away, when a webhook reports that its translation changed
+        @param urn: The base64 encoded URN
+        """
+        job = self._jobs.get(urn)
+        if job is not None and not job.finished and self._wakeup is not None:
+            job.polls = 0
+            self._schedule(urn, 0)
+
+    def jobs(self, urns: Iterable[str] = None) -> Dict[str, TranslationJob]:
+        if urns is None:
+            return dict(self._jobs)
+        return {u: self._jobs[u] for u in urns if u in self._jobs}
+
+    @property
+    def version(self) -> int:
+        """A counter incremented every time a job changes"""
+        return self._version
+
+    async def wait(self, version: int, timeout: float = None) -> int:
+        """
+        Waits until a job changes
+        @param version: The version seen by the caller
+        @param timeout: The maximum wait in seconds
+        @return: The current version, equal to the given one on timeout
+        """
+        self._start()
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self._version != version), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self._version
+
+    def _schedule(self, urn: str, delay: float) -> None:
+        heapq.heappush(self._due, (time.monotonic() + delay, urn))
+        self._wakeup.set()
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        polls = set()
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while len(self._due) > 0 and self._due[0][0] <= now:
+                _, urn = heapq.heappop(self._due)
+                await semaphore.acquire()
+                task = asyncio.create_task(self._poll(self._jobs[urn]))
+                polls.add(task)
+                task.add_done_callback(lambda t: (semaphore.release(), polls.discard(t)))
+            delay = self._due[0][0] - time.monotonic() if len(self._due) > 0 else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, job: TranslationJob) -> None:
+        job.polls += 1
+        delay = None
+        try:
+            resp = await scheduler.arequest(
+                self._client, 'GET', f'{model_derivative.ENDPOINT}/{job.urn}/manifest', priority=BACKGROUND,
+                headers={'Authorization': aps.token.Value}
+            )
+            if resp.status_code == 429:
+                delay = float(resp.headers.get('Retry-After', self.max_delay))
+            elif resp.status_code == 404:
+                # the manifest appears a few seconds after the job is accepted
+                pass
+            else:
+                resp.raise_for_status()
+                manifest = resp.json()
+                progress = manifest.get('progress', '')
+                if progress != job.progress or manifest.get('status') != job.status:
+                    job.status = manifest.get('status', job.status)
+                    job.progress = progress
+                    job.updated = time.time()
+                    # a job that moves is polled again at the minimum rate
+                    job.polls = 0
+                    await self._notify()
+                if job.finished:
+                    await asyncio.to_thread(self._cache_manifest, job.urn, manifest)
+                    return
+        except Exception as ex:
+            job.error = str(ex)
+            logging.warning(f'manifest of {job.urn} not available: {ex}')
+        if time.time() - job.submitted > self.timeout:
+            job.status = 'timeout'
+            await self._notify()
+            return
+        self._schedule(job.urn, delay if delay is not None else backoff(job.polls, self.min_delay, self.max_delay))
+
+    @staticmethod
+    def _cache_manifest(urn: str, manifest: Dict[str, Any]) -> None:
+        # the user id can take a request to APS, this runs in a thread
+        user = aps.get_user_id()
+        if user is not None:
+            model_derivative.manifest_cache.put(urn, manifest, user=user)
+
+
+tracker = TranslationTracker()